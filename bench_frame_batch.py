@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+Compare getting decoded frames ready for the model the old way (OpenCV -> PIL -> PIL resize -> numpy)
+vs the numpy batch path (one contiguous RGB batch, cv2.resize straight to the model's input).
+Each path runs in its own process so the peak memory numbers don't muddle each other.
+
+Usage:
+    ./bench_frame_batch.py [REPEATS]
+"""
+
+import glob
+import resource
+import subprocess
+import sys
+import time
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from top_cat import (
+    THIS_SCRIPT_DIR,
+    cast_to_pil_imgs,
+    cast_to_rgb_batch,
+    extract_frames_from_im_or_video,
+    get_config,
+)
+
+# Same as deeplab.DeepLabModel.INPUT_SIZE, without having to import tensorflow
+INPUT_SIZE = 513
+
+
+def target_size(width, height):
+    resize_ratio = 1.0 * INPUT_SIZE / max(width, height)
+    return (int(resize_ratio * width), int(resize_ratio * height))
+
+
+def model_inputs_the_old_way(frames):
+    "What add_labels_for_image_to_post_d + DeepLabModel.run used to do"
+    to_ret = []
+    for pil_im in cast_to_pil_imgs(frames):
+        resized_image = pil_im.convert("RGB").resize(
+            target_size(*pil_im.size), Image.ANTIALIAS
+        )
+        to_ret.append([np.asarray(resized_image)])
+    return to_ret
+
+
+def model_inputs_from_numpy_batch(frames):
+    "cast_to_rgb_batch + DeepLabModel.run with an array"
+    to_ret = []
+    for frame in cast_to_rgb_batch(frames):
+        height, width = frame.shape[:2]
+        resized_image = cv2.resize(
+            frame, target_size(width, height), interpolation=cv2.INTER_AREA
+        )
+        to_ret.append(resized_image[np.newaxis])
+    return to_ret
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_one(how, video, repeats):
+    "Prints seconds (best of repeats) and how much the peak RSS grew while converting"
+    convert = {
+        "old": model_inputs_the_old_way,
+        "numpy": model_inputs_from_numpy_batch,
+    }[how]
+    frames = extract_frames_from_im_or_video(video, get_config("/dev/null"))
+    rss_before = peak_rss_mb()
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        convert(frames)
+        timings.append(time.perf_counter() - start)
+    print(f"{min(timings):.4f}\t{peak_rss_mb() - rss_before:.1f}")
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "--one":
+        run_one(sys.argv[2], sys.argv[3], int(sys.argv[4]))
+        return
+    repeats = sys.argv[1] if len(sys.argv) > 1 else "3"
+    print("clip\told_s\tnumpy_s\told_extra_peak_mb\tnumpy_extra_peak_mb")
+    for video in sorted(glob.glob(THIS_SCRIPT_DIR + "/imgs/*/*.mp4")):
+        results = {}
+        for how in ["old", "numpy"]:
+            results[how] = (
+                subprocess.check_output(
+                    [sys.executable, __file__, "--one", how, video, repeats], text=True
+                )
+                .strip()
+                .split("\t")
+            )
+        print(
+            f"{video.split('/imgs/')[-1]}\t{results['old'][0]}\t{results['numpy'][0]}"
+            f"\t{results['old'][1]}\t{results['numpy'][1]}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""
+Compare how long it takes to sample frames from the videos in imgs/ the old way
+(decode every frame, check each one against a list) vs extract_frames_from_im_or_video.
+
+Usage:
+    ./bench_frame_sampling.py [REPEATS]
+"""
+
+import glob
+import sys
+import time
+
+import cv2
+import numpy as np
+
+from top_cat import THIS_SCRIPT_DIR, extract_frames_from_im_or_video, get_config
+
+
+def extract_frames_the_old_way(media_file, config):
+    "What extract_frames_from_im_or_video used to do for videos"
+    to_ret = []
+    cap = cv2.VideoCapture(media_file)
+    frame_rate = cap.get(cv2.CAP_PROP_FPS)
+    frames_in_video = cap.get(cv2.CAP_PROP_FRAME_COUNT)
+    seconds_in_video = frames_in_video / frame_rate
+    if seconds_in_video > config["MAX_IMS_PER_VIDEO"]:
+        frames_to_grab = np.linspace(
+            0, frames_in_video - 1, num=config["MAX_IMS_PER_VIDEO"], dtype=int
+        )
+    else:
+        frames_to_grab = [int(f) for f in np.arange(0, frames_in_video, frame_rate)]
+    while cap.isOpened():
+        frame_id = cap.get(cv2.CAP_PROP_POS_FRAMES)
+        got_a_frame, frame = cap.read()
+        if not got_a_frame:
+            break
+        if int(frame_id) in frames_to_grab:
+            to_ret.append(frame)
+    cap.release()
+    return to_ret
+
+
+def time_it(func, repeats):
+    "Best of `repeats` runs, in seconds"
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        to_ret = func()
+        timings.append(time.perf_counter() - start)
+    return min(timings), to_ret
+
+
+def main():
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    config = get_config("/dev/null")
+    seek_config = {**config, "SEEK_MIN_FRAME_GAP": 0}
+    print("clip\told_s\tnew_s\tnew_always_seek_s\tsame_frames")
+    for video in sorted(glob.glob(THIS_SCRIPT_DIR + "/imgs/*/*.mp4")):
+        old_s, old_frames = time_it(
+            lambda: extract_frames_the_old_way(video, config), repeats
+        )
+        new_s, new_frames = time_it(
+            lambda: extract_frames_from_im_or_video(video, config), repeats
+        )
+        seek_s, seek_frames = time_it(
+            lambda: extract_frames_from_im_or_video(video, seek_config), repeats
+        )
+        same_frames = all(
+            np.array_equal(a, b) and np.array_equal(a, c)
+            for a, b, c in zip(old_frames, new_frames, seek_frames)
+        ) and len(old_frames) == len(new_frames) == len(seek_frames)
+        print(
+            f"{video.split('/imgs/')[-1]}\t{old_s:.3f}\t{new_s:.3f}\t{seek_s:.3f}\t{same_frames}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+"""
+How long does `import top_cat` take? Runs `python -X importtime -c "import top_cat"` a few times
+and shows the slowest imports, plus whether any of the heavy ones (that should only get imported
+once there's something to label) snuck back in.
+
+Usage:
+    ./bench_import_time.py [REPEATS] [TOP_N]
+"""
+
+import os
+import subprocess
+import sys
+
+# These should only get imported once there's something new to label
+HEAVY_MODULES = ["cv2", "numpy", "PIL", "tensorflow"]
+
+
+def get_import_times(module="top_cat"):
+    "{module name: cumulative microseconds} from one fresh interpreter"
+    stderr = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        check=True,
+        capture_output=True,
+        text=True,
+        cwd=os.path.dirname(os.path.realpath(__file__)),
+    ).stderr
+    import_times = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative_us, name = line.split("|")
+        import_times[name.strip()] = int(cumulative_us)
+    return import_times
+
+
+def main():
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    top_n = int(sys.argv[2]) if len(sys.argv) > 2 else 15
+    runs = [get_import_times() for _ in range(repeats)]
+    best = {name: min(run.get(name, 0) for run in runs) for name in runs[0]}
+    print(f"import top_cat: {best['top_cat'] / 1000:.1f} ms (best of {repeats})")
+    for name, cumulative_us in sorted(best.items(), key=lambda kv: -kv[1])[:top_n]:
+        print(f"{cumulative_us / 1000:8.1f} ms  {name}")
+    heavy = sorted(name for name in best if name.split(".")[0] in HEAVY_MODULES)
+    if heavy:
+        sys.exit(f"# Heavy modules imported by top_cat: {', '.join(heavy)}")
+
+
+if __name__ == "__main__":
+    main()
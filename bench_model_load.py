@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+How long does DeepLabModel take to load? Compares scanning the whole tarball like we used to,
+the first load with the graph cache (hash the tarball, extract, stash the graph),
+and later loads that mmap the cached graph. Every load runs in a fresh process.
+
+With no TARBALL, builds a stand in that's laid out like the real deeplabv3 ones:
+a big (incompressible) checkpoint followed by a frozen graph with a big constant in it.
+
+Usage:
+    ./bench_model_load.py [TARBALL] [REPEATS]
+"""
+
+import io
+import os
+import subprocess
+import sys
+import tarfile
+import time
+from tempfile import TemporaryDirectory
+
+import numpy as np
+
+# What each fresh process runs. {cache} is None or a directory
+LOAD_THE_OLD_WAY = """
+import os, tarfile
+import tensorflow as tf
+from deeplab import DeepLabModel
+graph_def = None
+tar_file = tarfile.open({tarball!r})
+for tar_info in tar_file.getmembers():
+    if DeepLabModel.FROZEN_GRAPH_NAME in os.path.basename(tar_info.name):
+        graph_def = tf.compat.v1.GraphDef.FromString(tar_file.extractfile(tar_info).read())
+        break
+graph = tf.Graph()
+with graph.as_default():
+    tf.import_graph_def(graph_def, name="")
+"""
+LOAD_WITH_CACHE = """
+from deeplab import DeepLabModel
+DeepLabModel({tarball!r}, {cache!r})
+"""
+JUST_IMPORT = """
+import deeplab
+"""
+
+
+def make_stand_in_tarball(path, checkpoint_mb=300, graph_mb=150):
+    import tensorflow as tf
+
+    graph = tf.Graph()
+    with graph.as_default():
+        image = tf.compat.v1.placeholder(
+            tf.uint8, [1, None, None, 3], name="ImageTensor"
+        )
+        weights = tf.constant(
+            np.random.rand(graph_mb * 1024 * 1024 // 4).astype(np.float32)
+        )
+        tf.identity(
+            tf.cast(image[..., 0], tf.int64) * 0
+            + tf.cast(tf.reduce_sum(weights) * 0, tf.int64),
+            name="SemanticPredictions",
+        )
+    graph_bytes = graph.as_graph_def().SerializeToString()
+    with tarfile.open(path, "w:gz", compresslevel=1) as tar_file:
+        for name, data in [
+            (
+                "stand_in/model.ckpt.data-00000-of-00001",
+                os.urandom(checkpoint_mb << 20),
+            ),
+            ("stand_in/frozen_inference_graph.pb", graph_bytes),
+        ]:
+            tar_info = tarfile.TarInfo(name)
+            tar_info.size = len(data)
+            tar_file.addfile(tar_info, io.BytesIO(data))
+
+
+def time_in_fresh_process(code):
+    start = time.perf_counter()
+    subprocess.run(
+        [sys.executable, "-c", code],
+        check=True,
+        cwd=os.path.dirname(os.path.realpath(__file__)),
+        stderr=subprocess.DEVNULL,
+    )
+    return time.perf_counter() - start
+
+
+def main():
+    temp_dir = TemporaryDirectory()
+    if len(sys.argv) > 1:
+        tarball = sys.argv[1]
+    else:
+        tarball = temp_dir.name + "/stand_in.tar.gz"
+        make_stand_in_tarball(tarball)
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    cache_dir = temp_dir.name + "/frozen_graphs"
+
+    import_s = min(time_in_fresh_process(JUST_IMPORT) for _ in range(repeats))
+    old_s = min(
+        time_in_fresh_process(LOAD_THE_OLD_WAY.format(tarball=tarball))
+        for _ in range(repeats)
+    )
+    first_cached_s = time_in_fresh_process(
+        LOAD_WITH_CACHE.format(tarball=tarball, cache=cache_dir)
+    )
+    warm_cached_s = min(
+        time_in_fresh_process(LOAD_WITH_CACHE.format(tarball=tarball, cache=cache_dir))
+        for _ in range(repeats)
+    )
+    print(f"tarball: {tarball} ({os.path.getsize(tarball) >> 20} MB)")
+    print("just_import_s\told_scan_s\tfirst_cached_s\twarm_cached_s")
+    print(f"{import_s:.2f}\t{old_s:.2f}\t{first_cached_s:.2f}\t{warm_cached_s:.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,32 @@
 # https://github.com/tensorflow/models/blob/master/research/deeplab/deeplab_demo.ipynb
 # Mostly taken from ^ but cleaned and modified a bit to be easier for me to use.
 
+import functools
+import hashlib
+import json
+import math
+import mmap
 import multiprocessing
 import os
 import tarfile
-from collections import Counter
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
 
+import cv2
 import numpy as np
 import tensorflow as tf
 from PIL import Image
 
+from frame_dedup import dedupe_frames, get_dedupe_func_given_config
+from label_aggregation import (
+    aggregate_label_scores,
+    get_aggregate_func_given_config,
+    get_near_cutoff_func_given_config,
+    get_settled_func_given_config,
+    seg_maps_to_score_matrix,
+)
+
 os.environ["TF_CPP_MIN_LOG_LEVEL"] = "3"
 tf.compat.v1.logging.set_verbosity(tf.compat.v1.logging.ERROR)
 
@@ -17,6 +34,59 @@ tf.compat.v1.logging.set_verbosity(tf.compat.v1.logging.ERROR)
 SCORE_CUTOFF = 0.05
 
 
+def write_atomically(path, data):
+    "Other processes (eg worker pool) only ever see the whole file or nothing"
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), delete=False) as f:
+        f.write(data)
+    os.replace(f.name, path)
+
+
+def get_tarball_checksum(tarball_path, graph_cache_dir):
+    """
+    sha1 of the tarball. Hashing a few hundred MB isn't free either,
+    so it's remembered by path, size and mtime in graph_cache_dir/checksums.json
+    """
+    checksums_path = os.path.join(graph_cache_dir, "checksums.json")
+    tarball_path = os.path.realpath(tarball_path)
+    tarball_stat = os.stat(tarball_path)
+    tarball_key = [tarball_stat.st_size, tarball_stat.st_mtime_ns]
+    try:
+        with open(checksums_path) as f:
+            checksums = json.load(f)
+    except (OSError, ValueError):
+        checksums = {}
+    if checksums.get(tarball_path, [None, None, None])[:2] == tarball_key:
+        return checksums[tarball_path][2]
+    sha1 = hashlib.sha1()
+    with open(tarball_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha1.update(chunk)
+    checksums[tarball_path] = tarball_key + [sha1.hexdigest()]
+    write_atomically(checksums_path, json.dumps(checksums).encode())
+    return sha1.hexdigest()
+
+
+def get_cached_graph_path(tarball_path, graph_cache_dir):
+    graph_cache_dir = os.path.expanduser(graph_cache_dir)
+    return os.path.join(
+        graph_cache_dir,
+        get_tarball_checksum(tarball_path, graph_cache_dir)
+        + "-frozen_inference_graph.pb",
+    )
+
+
+def load_graph_def(graph_path):
+    "Parse the graph straight out of an mmap of the file, no extra copy of the bytes"
+    graph_def = tf.compat.v1.GraphDef()
+    with open(graph_path, "rb") as f, mmap.mmap(
+        f.fileno(), 0, access=mmap.ACCESS_READ
+    ) as graph_mmap:
+        with memoryview(graph_mmap) as graph_bytes:
+            graph_def.ParseFromString(graph_bytes)
+    return graph_def
+
+
 class DeepLabModel(object):
     """Class to load deeplab model and run inference."""
 
@@ -52,94 +122,570 @@ class DeepLabModel(object):
     )
     # fmt: on
 
-    def __init__(self, tarball_path):
-        """Creates and loads pretrained deeplab model."""
+    def __init__(self, tarball_path, graph_cache_dir=None):
+        """Creates and loads pretrained deeplab model.
+
+        If graph_cache_dir is set, the frozen graph gets pulled out of the tarball once
+        and stashed there (keyed by the tarball's checksum) so later runs can skip the tarball.
+        """
         self.graph = tf.Graph()
 
-        graph_def = None
-        # Extract frozen graph from tar archive.
-        tar_file = tarfile.open(tarball_path)
-        for tar_info in tar_file.getmembers():
-            if self.FROZEN_GRAPH_NAME in os.path.basename(tar_info.name):
-                file_handle = tar_file.extractfile(tar_info)
-                graph_def = tf.compat.v1.GraphDef.FromString(file_handle.read())
-                break
+        cached_graph_path = None
+        if graph_cache_dir is not None:
+            cached_graph_path = get_cached_graph_path(tarball_path, graph_cache_dir)
+        if cached_graph_path is not None and os.path.exists(cached_graph_path):
+            graph_def = load_graph_def(cached_graph_path)
+        else:
+            graph_bytes = None
+            # Extract frozen graph from tar archive.
+            tar_file = tarfile.open(tarball_path)
+            for tar_info in tar_file:
+                if self.FROZEN_GRAPH_NAME in os.path.basename(tar_info.name):
+                    file_handle = tar_file.extractfile(tar_info)
+                    graph_bytes = file_handle.read()
+                    break
 
-        tar_file.close()
+            tar_file.close()
 
-        if graph_def is None:
-            raise RuntimeError("Cannot find inference graph in tar archive.")
+            if graph_bytes is None:
+                raise RuntimeError("Cannot find inference graph in tar archive.")
+            graph_def = tf.compat.v1.GraphDef.FromString(graph_bytes)
+            if cached_graph_path is not None:
+                write_atomically(cached_graph_path, graph_bytes)
 
         with self.graph.as_default():
             tf.import_graph_def(graph_def, name="")
 
         self.sess = tf.compat.v1.Session(graph=self.graph)
 
+        # Graphs from deeplab's export_model.py only take one image at a time (batch dim is 1)
+        input_shape = self.graph.get_tensor_by_name(self.INPUT_TENSOR_NAME).shape
+        self.max_batch_size = (
+            input_shape[0] if input_shape.rank and input_shape[0] is not None else None
+        )
+
+    def resize_for_model(self, image, input_size=None):
+        """Resizes an image so its longest side is INPUT_SIZE.
+
+        Args:
+          image: A PIL.Image object or an (height, width, 3) uint8 RGB array, raw input image.
+          input_size: Longest side to use instead of INPUT_SIZE (should be smaller).
+
+        Returns:
+          resized_image: (height, width, 3) uint8 RGB array.
+        """
+        if isinstance(image, np.ndarray):
+            height, width = image.shape[:2]
+        else:
+            width, height = image.size
+        resize_ratio = 1.0 * (input_size or self.INPUT_SIZE) / max(width, height)
+        target_size = (int(resize_ratio * width), int(resize_ratio * height))
+        if isinstance(image, np.ndarray):
+            # Straight from numpy to the model, no PIL copies along the way
+            return cv2.resize(image, target_size, interpolation=cv2.INTER_AREA)
+        return np.asarray(image.convert("RGB").resize(target_size, Image.ANTIALIAS))
+
     def run(self, image):
         """Runs inference on a single image.
 
         Args:
-          image: A PIL.Image object, raw input image.
+          image: A PIL.Image object or an (height, width, 3) uint8 RGB array, raw input image.
 
         Returns:
           resized_image: RGB image resized from original input image.
           seg_map: Segmentation map of `resized_image`.
         """
-        width, height = image.size
-        resize_ratio = 1.0 * self.INPUT_SIZE / max(width, height)
-        target_size = (int(resize_ratio * width), int(resize_ratio * height))
-        resized_image = image.convert("RGB").resize(target_size, Image.ANTIALIAS)
+        resized_image = self.resize_for_model(image)
         batch_seg_map = self.sess.run(
             self.OUTPUT_TENSOR_NAME,
-            feed_dict={self.INPUT_TENSOR_NAME: [np.asarray(resized_image)]},
+            feed_dict={self.INPUT_TENSOR_NAME: resized_image[np.newaxis]},
         )
         seg_map = batch_seg_map[0]
         return resized_image, seg_map
 
+    def run_batch(self, images, batch_size=1, input_size=None):
+        """Runs inference on a bunch of images, up to batch_size per session run.
+
+        Images in the same batch get letterboxed (zero padded on the bottom and right)
+        to a common size and their seg maps get cropped back down to the valid region.
+        Similar sized images are batched together to keep the padding down.
+
+        Args:
+          images: PIL.Image objects or (height, width, 3) uint8 RGB arrays (or one (n, height, width, 3) array).
+          batch_size: Most images to send to the model at once. Capped by what the graph takes.
+          input_size: Shrink images to this (longest side) instead of INPUT_SIZE.
+
+        Returns:
+          seg_maps: Segmentation map for each image, in the same order as images.
+        """
+        if self.max_batch_size is not None:
+            batch_size = min(batch_size, self.max_batch_size)
+        batch_size = max(1, int(batch_size))
+        resized_images = [self.resize_for_model(image, input_size) for image in images]
+        order = sorted(
+            range(len(resized_images)), key=lambda i: resized_images[i].shape[:2]
+        )
+        seg_maps = [None] * len(resized_images)
+        for start in range(0, len(order), batch_size):
+            batch_ids = order[start : start + batch_size]
+            height = max(resized_images[i].shape[0] for i in batch_ids)
+            width = max(resized_images[i].shape[1] for i in batch_ids)
+            batch = np.zeros((len(batch_ids), height, width, 3), dtype=np.uint8)
+            for i, batch_image in zip(batch_ids, batch):
+                im_height, im_width = resized_images[i].shape[:2]
+                batch_image[:im_height, :im_width] = resized_images[i]
+            batch_seg_map = self.sess.run(
+                self.OUTPUT_TENSOR_NAME, feed_dict={self.INPUT_TENSOR_NAME: batch}
+            )
+            for i, seg_map in zip(batch_ids, batch_seg_map):
+                im_height, im_width = resized_images[i].shape[:2]
+                seg_maps[i] = seg_map[:im_height, :im_width]
+        return seg_maps
+
+
+# Frames get shrunk down to this (longest side) anyways. top_cat.py uses this to pick what to download
+INPUT_SIZE = DeepLabModel.INPUT_SIZE
+
+
+# Percent of pixels per label averaged over frames, dropping anything under SCORE_CUTOFF
+default_aggregate = functools.partial(
+    aggregate_label_scores, default_cutoff=SCORE_CUTOFF
+)
+
+
+def combine_frame_label_fractions(label_fractions_per_frame, aggregate=None):
+    "label_fractions_per_frame is a (frames, labels) matrix, see seg_map_label_fractions"
+    return (aggregate or default_aggregate)(
+        np.asarray(label_fractions_per_frame).reshape(
+            -1, len(DeepLabModel.LABEL_NAMES)
+        ),
+        DeepLabModel.LABEL_NAMES.tolist(),
+    )
+
+
+def get_label_proportions(model, seg_maps, aggregate=None, frame_counts=None):
+    """
+    What fraction of the pixels (averaged over frames by default) is each label?
+    frame_counts is how many frames each seg map stands for (see frame_dedup), 1 each by default.
+    """
+    label_fractions = seg_maps_to_score_matrix(seg_maps, len(model.LABEL_NAMES))
+    if frame_counts is not None:
+        label_fractions = np.repeat(label_fractions, frame_counts, axis=0)
+    return combine_frame_label_fractions(label_fractions, aggregate)
 
-def get_labels_from_frames_deeplab(model, frames_in_video):
-    # Counter can also keep track of fractional values
-    proportion_label_in_post = Counter()
-    for frame in frames_in_video:
-        resized_im, seg_map = model.run(frame)
-        # unique_labels = np.unique(seg_map)
-        labels, num_pixels = np.unique(seg_map, return_counts=True)
-        labels_text = [model.LABEL_NAMES[label] for label in labels]
-        proportion_label_in_post += Counter(
-            dict(
-                zip(labels_text, 1.0 * num_pixels / seg_map.size / len(frames_in_video))
+
+def get_labels_from_frames_deeplab(
+    model,
+    frames_in_video,
+    batch_size=1,
+    aggregate=None,
+    is_settled=None,
+    dedupe=None,
+    cascade=None,
+):
+    "frames_in_video is a list of PIL images or a (frames, height, width, 3) uint8 RGB array"
+    return get_labels_for_posts_deeplab(
+        model, [frames_in_video], batch_size, aggregate, is_settled, dedupe, cascade
+    )[0]
+
+
+def get_labels_for_posts_deeplab(
+    model,
+    frames_per_post,
+    batch_size=1,
+    aggregate=None,
+    is_settled=None,
+    dedupe=None,
+    cascade=None,
+):
+    """
+    Labels for several posts at once, so frames from different posts can share a batch.
+    dedupe (see frame_dedup.dedupe_frames) lets near duplicate frames share one run through the model.
+    With a cascade (see DeepLabCascade) most posts only get a quick first pass.
+    """
+    if cascade is not None:
+        return cascade.label_many(
+            model, frames_per_post, batch_size, aggregate, is_settled, dedupe
+        )
+    return [
+        combine_frame_label_fractions(label_fractions, aggregate)
+        for label_fractions in get_label_fractions_for_posts(
+            model, frames_per_post, batch_size, is_settled, dedupe
+        )
+    ]
+
+
+def get_label_fractions_for_posts(
+    model, frames_per_post, batch_size=1, is_settled=None, dedupe=None, input_size=None
+):
+    "(frames, labels) matrix of label fractions for each post. See get_labels_for_posts_deeplab"
+    frames_and_counts_per_post = [
+        (dedupe or dedupe_frames)(frames) for frames in frames_per_post
+    ]
+    if is_settled is not None:
+        return get_label_fractions_until_settled(
+            model, frames_and_counts_per_post, batch_size, is_settled, input_size
+        )
+    seg_maps = model.run_batch(
+        [frame for frames, _ in frames_and_counts_per_post for frame in frames],
+        batch_size,
+        input_size,
+    )
+    to_ret = []
+    start = 0
+    for frames, frame_counts in frames_and_counts_per_post:
+        # Near duplicates count as many times as the frames they stand for
+        to_ret.append(
+            np.repeat(
+                seg_maps_to_score_matrix(
+                    seg_maps[start : start + len(frames)], len(model.LABEL_NAMES)
+                ),
+                frame_counts,
+                axis=0,
             )
         )
-    # Delete labels below threshold
-    for label in list(proportion_label_in_post.keys()):
-        if proportion_label_in_post[label] < SCORE_CUTOFF:
-            # print(f'deleting {label} from consideration {proportion_label_in_post[label]} < {SCORE_CUTOFF}', file=sys.stderr)
-            del proportion_label_in_post[label]
-    return proportion_label_in_post
+        start += len(frames)
+    return to_ret
+
+
+def get_label_fractions_until_settled(
+    model, frames_and_counts_per_post, batch_size, is_settled, input_size=None
+):
+    """
+    Like get_label_fractions_for_posts, but a few frames at a time and each post stops
+    once is_settled (see label_aggregation.is_decision_settled) says the rest of its frames can't matter.
+    Every round, each unsettled post gets its share of one batch.
+    """
+    label_names = model.LABEL_NAMES.tolist()
+    if model.max_batch_size is not None:
+        batch_size = min(batch_size, model.max_batch_size)
+    score_matrices = [
+        np.zeros((0, len(label_names))) for _ in frames_and_counts_per_post
+    ]
+    frames_done = [0] * len(frames_and_counts_per_post)
+    unsettled = [
+        post_id
+        for post_id, (frames, _) in enumerate(frames_and_counts_per_post)
+        if len(frames)
+    ]
+    while unsettled:
+        frames_each = max(1, batch_size // len(unsettled))
+        frame_ranges = {
+            post_id: range(
+                frames_done[post_id],
+                min(
+                    frames_done[post_id] + frames_each,
+                    len(frames_and_counts_per_post[post_id][0]),
+                ),
+            )
+            for post_id in unsettled
+        }
+        seg_maps = iter(
+            model.run_batch(
+                [
+                    frames_and_counts_per_post[post_id][0][frame_id]
+                    for post_id in unsettled
+                    for frame_id in frame_ranges[post_id]
+                ],
+                batch_size,
+                input_size,
+            )
+        )
+        for post_id in unsettled:
+            frame_range = frame_ranges[post_id]
+            frame_counts = frames_and_counts_per_post[post_id][1]
+            score_matrices[post_id] = np.vstack(
+                [
+                    score_matrices[post_id],
+                    np.repeat(
+                        seg_maps_to_score_matrix(
+                            [next(seg_maps) for _ in frame_range], len(label_names)
+                        ),
+                        frame_counts[frame_range.start : frame_range.stop],
+                        axis=0,
+                    ),
+                ]
+            )
+            frames_done[post_id] = frame_range.stop
+        unsettled = [
+            post_id
+            for post_id in unsettled
+            if not is_settled(
+                score_matrices[post_id],
+                label_names,
+                sum(frames_and_counts_per_post[post_id][1]),
+            )
+        ]
+    return score_matrices
+
+
+class DeepLabCascade(object):
+    """A quick first pass over every post, then the full model only for posts that were too close to call.
+
+    coarse_model gets frames shrunk down to input_size. It can be the full model itself or a smaller one (eg mobilenet).
+    needs_full_model gets a post's (frames, labels) matrix from the first pass, see label_aggregation.is_near_cutoff.
+    The LabelScores that come back say which tier ("coarse" or "full") decided each post.
+    """
+
+    def __init__(self, coarse_model, input_size, needs_full_model):
+        self.coarse_model = coarse_model
+        self.input_size = input_size
+        self.needs_full_model = needs_full_model
+
+    def label_many(
+        self,
+        model,
+        frames_per_post,
+        batch_size=1,
+        aggregate=None,
+        is_settled=None,
+        dedupe=None,
+    ):
+        score_matrices = get_label_fractions_for_posts(
+            self.coarse_model,
+            frames_per_post,
+            batch_size,
+            is_settled,
+            dedupe,
+            self.input_size,
+        )
+        tiers = ["coarse"] * len(frames_per_post)
+        full_post_ids = [
+            post_id
+            for post_id, score_matrix in enumerate(score_matrices)
+            if self.needs_full_model(score_matrix, model.LABEL_NAMES.tolist())
+        ]
+        full_score_matrices = get_label_fractions_for_posts(
+            model,
+            [frames_per_post[post_id] for post_id in full_post_ids],
+            batch_size,
+            is_settled,
+            dedupe,
+        )
+        for post_id, score_matrix in zip(full_post_ids, full_score_matrices):
+            score_matrices[post_id] = score_matrix
+            tiers[post_id] = "full"
+        to_ret = []
+        for score_matrix, tier in zip(score_matrices, tiers):
+            labels = combine_frame_label_fractions(score_matrix, aggregate)
+            labels.tier = tier
+            to_ret.append(labels)
+        return to_ret
+
+
+# Each worker process in a DeepLabWorkerPool loads its own copy of the model into this
+worker_model = None
+
+
+def start_worker(tarball_path, intra_op_threads, graph_cache_dir=None):
+    "Runs once in each worker process"
+    global worker_model
+    tf.config.threading.set_intra_op_parallelism_threads(intra_op_threads)
+    worker_model = DeepLabModel(tarball_path, graph_cache_dir)
+
+
+def label_frames_in_shared_memory(shm_name, frame_layouts, batch_size):
+    "Runs in a worker. frame_layouts is a list of (offset, shape) for frames in the shared memory block"
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        frames = [
+            np.ndarray(shape, dtype=np.uint8, buffer=shm.buf, offset=offset)
+            for offset, shape in frame_layouts
+        ]
+        seg_maps = worker_model.run_batch(frames, batch_size)
+        del frames
+    finally:
+        shm.close()
+    return seg_maps_to_score_matrix(seg_maps, len(worker_model.LABEL_NAMES))
+
+
+class DeepLabWorkerPool(object):
+    """Several processes that each load deeplab once and label frames handed over in shared memory.
+
+    Frames get copied into one shared memory block per call (rather than pickled)
+    and each worker gets told where its frames are in that block.
+    """
+
+    def __init__(
+        self,
+        tarball_path,
+        procs,
+        intra_op_threads,
+        batch_size=1,
+        graph_cache_dir=None,
+        aggregate=None,
+        dedupe=None,
+    ):
+        self.procs = procs
+        self.batch_size = batch_size
+        self.aggregate = aggregate
+        self.dedupe = dedupe or dedupe_frames
+        # fork and tensorflow don't mix
+        self.executor = ProcessPoolExecutor(
+            max_workers=procs,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=start_worker,
+            initargs=(tarball_path, intra_op_threads, graph_cache_dir),
+        )
+
+    def label_many(self, frames_per_post):
+        "Same as get_labels_for_posts_deeplab, but spread over the workers"
+        frames_and_counts_per_post = [self.dedupe(frames) for frames in frames_per_post]
+        frames = [
+            np.ascontiguousarray(
+                frame if isinstance(frame, np.ndarray) else frame.convert("RGB"),
+                dtype=np.uint8,
+            )
+            for frames, _ in frames_and_counts_per_post
+            for frame in frames
+        ]
+        frame_layouts = []
+        offset = 0
+        for frame in frames:
+            frame_layouts.append((offset, frame.shape))
+            offset += frame.nbytes
+        shm = shared_memory.SharedMemory(create=True, size=max(1, offset))
+        try:
+            for frame, (offset, shape) in zip(frames, frame_layouts):
+                shared_frame = np.ndarray(
+                    shape, dtype=np.uint8, buffer=shm.buf, offset=offset
+                )
+                shared_frame[:] = frame
+                # The block can't be closed while there are views into it
+                del shared_frame
+            # Enough chunks to keep every worker busy, but no bigger than a batch
+            chunk_size = max(
+                1, min(self.batch_size, math.ceil(len(frames) / self.procs))
+            )
+            futures = [
+                self.executor.submit(
+                    label_frames_in_shared_memory,
+                    shm.name,
+                    frame_layouts[start : start + chunk_size],
+                    self.batch_size,
+                )
+                for start in range(0, len(frames), chunk_size)
+            ]
+            label_fractions = np.concatenate(
+                [future.result() for future in futures]
+                or [np.zeros((0, len(DeepLabModel.LABEL_NAMES)))]
+            )
+        finally:
+            shm.close()
+            shm.unlink()
+        to_ret = []
+        start = 0
+        for frames, frame_counts in frames_and_counts_per_post:
+            to_ret.append(
+                combine_frame_label_fractions(
+                    np.repeat(
+                        label_fractions[start : start + len(frames)],
+                        frame_counts,
+                        axis=0,
+                    ),
+                    self.aggregate,
+                )
+            )
+            start += len(frames)
+        return to_ret
+
+    def close(self):
+        self.executor.shutdown()
+
+
+def get_deeplab_tarball(file_name):
+    "Local path to one of the tarballs from http://download.tensorflow.org/models/ (downloaded the first time)"
+    return tf.keras.utils.get_file(
+        fname=file_name,
+        origin="http://download.tensorflow.org/models/" + file_name,
+        cache_subdir="models",
+    )
 
 
 def get_labelling_func_given_config(config):
     # Turn off useless TF messages
     os.environ["TF_CPP_MIN_LOG_LEVEL"] = "3"
     tf.compat.v1.logging.set_verbosity(tf.compat.v1.logging.ERROR)
-    from deeplab import DeepLabModel, get_labels_from_frames_deeplab
+    from deeplab import (
+        DeepLabCascade,
+        DeepLabModel,
+        get_labels_for_posts_deeplab,
+        get_labels_from_frames_deeplab,
+    )
 
     if int(config["PROCS_TO_USE"]) <= 0:
         cores_to_use = max(1, multiprocessing.cpu_count() + int(config["PROCS_TO_USE"]))
     else:
         cores_to_use = int(config["PROCS_TO_USE"])
+    worker_procs = min(int(config["DEEPLAB_WORKER_PROCS"]), cores_to_use)
+    batch_size = int(config["DEEPLAB_BATCH_SIZE"])
+
+    # Get the vision model ready
+    deeplabv3_model_tar = get_deeplab_tarball(config["DEEPLABV3_FILE_NAME"])
+    # The frozen graph gets pulled out of the tarball once and kept here
+    graph_cache_dir = config["DEEPLAB_GRAPH_CACHE_DIR"]
+    aggregate = get_aggregate_func_given_config(config, SCORE_CUTOFF)
+    is_settled = get_settled_func_given_config(config, SCORE_CUTOFF)
+    dedupe = get_dedupe_func_given_config(config)
+
+    if worker_procs > 1:
+        # Split the cores between the workers
+        pool = DeepLabWorkerPool(
+            deeplabv3_model_tar,
+            worker_procs,
+            max(1, cores_to_use // worker_procs),
+            batch_size,
+            graph_cache_dir,
+            aggregate,
+            dedupe,
+        )
+
+        def labelling_funtion_deeplabv3_pool(frames):
+            return pool.label_many([frames])[0]
+
+        # NOTE: the pool doesn't do STOP_LABELLING_WHEN_SETTLED or DEEPLAB_CASCADE
+        labelling_funtion_deeplabv3_pool.label_many = pool.label_many
+        labelling_funtion_deeplabv3_pool.accepts_numpy_batch = True
+        # So the worker processes get shut down once the run is over
+        labelling_funtion_deeplabv3_pool.close = pool.close
+        return labelling_funtion_deeplabv3_pool
+
     # For deeplab this seems to be the setting that matters for cpu count
     tf.config.threading.set_intra_op_parallelism_threads(cores_to_use)
+    model = DeepLabModel(deeplabv3_model_tar, graph_cache_dir)
 
-    # Get the vision model ready
-    deeplabv3_model_tar = tf.keras.utils.get_file(
-        fname=config["DEEPLABV3_FILE_NAME"],
-        origin="http://download.tensorflow.org/models/" + config["DEEPLABV3_FILE_NAME"],
-        cache_subdir="models",
-    )
-    model = DeepLabModel(deeplabv3_model_tar)
+    cascade = None
+    if config["DEEPLAB_CASCADE"]:
+        coarse_model = model
+        if config["DEEPLAB_CASCADE_FILE_NAME"]:
+            coarse_model = DeepLabModel(
+                get_deeplab_tarball(config["DEEPLAB_CASCADE_FILE_NAME"]),
+                graph_cache_dir,
+            )
+        cascade = DeepLabCascade(
+            coarse_model,
+            int(config["DEEPLAB_CASCADE_INPUT_SIZE"]),
+            get_near_cutoff_func_given_config(
+                config, SCORE_CUTOFF, float(config["DEEPLAB_CASCADE_MARGIN"])
+            ),
+        )
 
     def labelling_funtion_deeplabv3(frames):
-        return get_labels_from_frames_deeplab(model, frames)
+        return get_labels_from_frames_deeplab(
+            model, frames, batch_size, aggregate, is_settled, dedupe, cascade
+        )
+
+    # top_cat.py uses this to label a few posts in one go
+    labelling_funtion_deeplabv3.label_many = functools.partial(
+        get_labels_for_posts_deeplab,
+        model,
+        batch_size=batch_size,
+        aggregate=aggregate,
+        is_settled=is_settled,
+        dedupe=dedupe,
+        cascade=cascade,
+    )
 
+    # top_cat.py hands us a numpy batch instead of PIL images when we say we can take it
+    labelling_funtion_deeplabv3.accepts_numpy_batch = True
     return labelling_funtion_deeplabv3
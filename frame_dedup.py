@@ -0,0 +1,90 @@
+"""
+Spot frames that are basically the same picture (static shots are common on /r/aww) so they only
+get run through the model once. Duplicates are counted instead: a frame standing in for 3 frames
+gets its scores counted 3 times, so the scores still come out the same as labelling all of them.
+
+Frames are compared by dHash: shrink to (DHASH_SIZE, DHASH_SIZE + 1) grayscale and keep
+whether each pixel is brighter than its right neighbour. Hashes that differ in only a few bits are near duplicates.
+dHash only sees edges (a flat red frame and a flat black one hash the same) so the colours
+of the shrunk frames have to be close too.
+"""
+
+import functools
+
+import cv2
+import numpy as np
+
+DHASH_SIZE = 16
+
+# Most the shrunk frames' pixels can differ on average (0-255) and still be near duplicates
+MAX_MEAN_COLOUR_DIFF = 8
+
+
+def shrink_frame_for_dhash(frame, hash_size=DHASH_SIZE):
+    "frame is a PIL image or an (h, w, 3) uint8 RGB array"
+    return cv2.resize(
+        np.asarray(frame, dtype=np.uint8),
+        (hash_size + 1, hash_size),
+        interpolation=cv2.INTER_AREA,
+    ).astype(np.float32)
+
+
+def dhash_given_small_frame(small_frame):
+    gray = small_frame.mean(axis=2) if small_frame.ndim == 3 else small_frame
+    return (gray[:, 1:] > gray[:, :-1]).ravel()
+
+
+def dhash(frame, hash_size=DHASH_SIZE):
+    "hash_size**2 bools"
+    return dhash_given_small_frame(shrink_frame_for_dhash(frame, hash_size))
+
+
+def group_near_duplicate_frames(frames, max_distance):
+    """
+    Frames whose dhash is at most max_distance bits away from an earlier frame's (and whose colours are close)
+    get lumped in with it. Gives back the index of the first frame in each group and how many frames are in each group.
+    """
+    group_frame_ids = []
+    group_small_frames = []
+    group_hashes = []
+    group_counts = []
+    for frame_id, frame in enumerate(frames):
+        small_frame = shrink_frame_for_dhash(frame)
+        frame_hash = dhash_given_small_frame(small_frame)
+        for group_id, (group_small_frame, group_hash) in enumerate(
+            zip(group_small_frames, group_hashes)
+        ):
+            if (
+                np.count_nonzero(frame_hash != group_hash) <= max_distance
+                and np.abs(small_frame - group_small_frame).mean()
+                <= MAX_MEAN_COLOUR_DIFF
+            ):
+                group_counts[group_id] += 1
+                break
+        else:
+            group_frame_ids.append(frame_id)
+            group_small_frames.append(small_frame)
+            group_hashes.append(frame_hash)
+            group_counts.append(1)
+    return group_frame_ids, group_counts
+
+
+def dedupe_frames(frames, max_distance=None):
+    """
+    (one frame from each group of near duplicates, how many frames each of those stands for).
+    max_distance None means every frame is its own group.
+    """
+    if max_distance is None:
+        return frames, [1] * len(frames)
+    frame_ids, counts = group_near_duplicate_frames(frames, max_distance)
+    if isinstance(frames, np.ndarray):
+        return frames[frame_ids], counts
+    return [frames[frame_id] for frame_id in frame_ids], counts
+
+
+def get_dedupe_func_given_config(config):
+    "dedupe_frames with NEAR_DUPLICATE_FRAME_MAX_DISTANCE filled in (negative turns it off)"
+    max_distance = config["NEAR_DUPLICATE_FRAME_MAX_DISTANCE"]
+    return functools.partial(
+        dedupe_frames, max_distance=max_distance if max_distance >= 0 else None
+    )
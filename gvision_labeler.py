@@ -1,45 +1,201 @@
 # from google.cloud import vision
+import functools
 import os
-from collections import Counter
+import sys
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
 
 from PIL import Image
 
+from frame_dedup import dedupe_frames, get_dedupe_func_given_config
+from label_aggregation import (
+    aggregate_label_scores,
+    get_aggregate_func_given_config,
+    get_settled_func_given_config,
+    labels_and_scores_to_score_matrix,
+)
+
 # Average of the score for a label across all frames > 50%
 SCORE_CUTOFF = 0.5
 
+# Images get thumbnailed down to this (longest side) before we send them off
+INPUT_SIZE = 1000
+
+# vision.Feature.Type.LABEL_DETECTION, without having to import google.cloud.vision here
+LABEL_DETECTION = 4
+MAX_LABELS_PER_IMAGE = 50
+
 
-def get_labels_for_im_using_vision_api(gvision_client, pil_img):
+def encode_frame_for_vision_api(pil_img, jpeg_quality):
     # In case it's too big max it at one megapixel
-    pil_img.thumbnail((1000, 1000), Image.ANTIALIAS)
+    pil_img.thumbnail((INPUT_SIZE, INPUT_SIZE), Image.ANTIALIAS)
     b = BytesIO()
-    pil_img.save(b, format="png")
-    im_bytes = b.getvalue()
-    labels_for_im = gvision_client.label_detection(
-        {"content": im_bytes}, max_results=50
-    )
+    pil_img.convert("RGB").save(b, format="jpeg", quality=jpeg_quality)
+    return b.getvalue()
+
+
+def get_labels_and_scores_from_response(response):
+    "(labels, scores) from one image's AnnotateImageResponse, None if the api couldn't label it"
+    if response.error.message:
+        print(
+            f"#WARNING: vision api couldn't label a frame ({response.error.message})",
+            file=sys.stderr,
+        )
+        return None
     return (
-        [label.description.lower() for label in labels_for_im.label_annotations],
-        [label.score for label in labels_for_im.label_annotations],
+        [label.description.lower() for label in response.label_annotations],
+        [label.score for label in response.label_annotations],
     )
 
 
-# NOTE: I'm averaging the score accross all the sampled frames. Could use more tinkering.
-def get_labels_from_frames_gvision(gvision_client, frames_in_video):
-    # Counter can also keep track of fractional values
-    proportion_label_in_post = Counter()
-    for frame in frames_in_video:
-        labels, scores = get_labels_for_im_using_vision_api(gvision_client, frame)
-        # After dividing by the number of frames
-        normed_scores = [s / len(frames_in_video) for s in scores]
-        # we can add fractional scores to the total for each label
-        proportion_label_in_post += Counter(dict(zip(labels, normed_scores)))
-    # Delete labels below threshold
-    for label in list(proportion_label_in_post.keys()):
-        if proportion_label_in_post[label] < SCORE_CUTOFF:
-            # print(f'deleting {label} from consideration {proportion_label_in_post[label]} < {SCORE_CUTOFF}', file=sys.stderr)
-            del proportion_label_in_post[label]
-    return proportion_label_in_post
+class VisionApiBatcher(object):
+    """Labels frames with batch_annotate_images calls of up to images_per_request frames each
+    (the api takes 16 at most), with up to requests_in_flight of those calls going at once.
+    """
+
+    def __init__(
+        self,
+        gvision_client,
+        images_per_request=16,
+        requests_in_flight=4,
+        jpeg_quality=90,
+    ):
+        self.gvision_client = gvision_client
+        self.images_per_request = images_per_request
+        self.jpeg_quality = jpeg_quality
+        self.executor = ThreadPoolExecutor(max_workers=requests_in_flight)
+        # How many frames it takes to keep every request busy
+        self.frames_per_round = images_per_request * requests_in_flight
+
+    def annotate(self, frames):
+        "One batch_annotate_images call. Encoding happens here too so it overlaps with other calls"
+        batch_response = self.gvision_client.batch_annotate_images(
+            requests=[
+                {
+                    "image": {
+                        "content": encode_frame_for_vision_api(frame, self.jpeg_quality)
+                    },
+                    "features": [
+                        {"type_": LABEL_DETECTION, "max_results": MAX_LABELS_PER_IMAGE}
+                    ],
+                }
+                for frame in frames
+            ]
+        )
+        return [
+            get_labels_and_scores_from_response(response)
+            for response in batch_response.responses
+        ]
+
+    def get_labels_and_scores(self, frames):
+        "(labels, scores) for each frame, in order"
+        return [
+            labels_and_scores
+            for labels_and_scores_per_request in self.executor.map(
+                self.annotate,
+                [
+                    frames[start : start + self.images_per_request]
+                    for start in range(0, len(frames), self.images_per_request)
+                ],
+            )
+            for labels_and_scores in labels_and_scores_per_request
+        ]
+
+    def close(self):
+        self.executor.shutdown()
+
+
+# Average of the score for each label across all frames, dropping anything under SCORE_CUTOFF
+default_aggregate = functools.partial(
+    aggregate_label_scores, default_cutoff=SCORE_CUTOFF
+)
+
+
+# NOTE: I'm averaging the score accross all the sampled frames (by default). Could use more tinkering.
+def get_labels_from_frames_gvision(
+    batcher, frames_in_video, aggregate=None, is_settled=None, dedupe=None
+):
+    return get_labels_for_posts_gvision(
+        batcher, [frames_in_video], aggregate, is_settled, dedupe
+    )[0]
+
+
+def get_labels_for_posts_gvision(
+    batcher, frames_per_post, aggregate=None, is_settled=None, dedupe=None
+):
+    """
+    Labels for several posts at once, so frames from different posts can share api calls.
+    With is_settled (see label_aggregation.is_decision_settled) frames go out a round at a time
+    and posts stop making calls once the rest of their frames can't change anything.
+    Posts with a frame the api couldn't label get None, so they're retried later instead of recorded as labelless.
+    """
+    # Near duplicate frames share one api call (see frame_dedup)
+    frames_and_counts_per_post = [
+        (dedupe or dedupe_frames)(frames) for frames in frames_per_post
+    ]
+    labels_and_scores_per_post = [[] for _ in frames_per_post]
+    frames_done = [0] * len(frames_per_post)
+    failed = [False] * len(frames_per_post)
+    unsettled = [
+        post_id
+        for post_id, (frames, _) in enumerate(frames_and_counts_per_post)
+        if len(frames)
+    ]
+    while unsettled:
+        frames_each = max(1, batcher.frames_per_round // len(unsettled))
+        frame_ranges = {
+            post_id: range(
+                frames_done[post_id],
+                (
+                    len(frames_and_counts_per_post[post_id][0])
+                    if is_settled is None
+                    else min(
+                        frames_done[post_id] + frames_each,
+                        len(frames_and_counts_per_post[post_id][0]),
+                    )
+                ),
+            )
+            for post_id in unsettled
+        }
+        labels_and_scores = iter(
+            batcher.get_labels_and_scores(
+                [
+                    frames_and_counts_per_post[post_id][0][frame_id]
+                    for post_id in unsettled
+                    for frame_id in frame_ranges[post_id]
+                ]
+            )
+        )
+        for post_id in unsettled:
+            frame_counts = frames_and_counts_per_post[post_id][1]
+            for frame_id in frame_ranges[post_id]:
+                frame_labels_and_scores = next(labels_and_scores)
+                failed[post_id] |= frame_labels_and_scores is None
+                labels_and_scores_per_post[post_id] += [
+                    frame_labels_and_scores
+                ] * frame_counts[frame_id]
+            frames_done[post_id] = frame_ranges[post_id].stop
+        unsettled = [
+            post_id
+            for post_id in unsettled
+            if not failed[post_id]
+            and frames_done[post_id] < len(frames_and_counts_per_post[post_id][0])
+            and not is_settled(
+                *labels_and_scores_to_score_matrix(labels_and_scores_per_post[post_id]),
+                sum(frames_and_counts_per_post[post_id][1]),
+            )
+        ]
+    # Labels a frame didn't get count as a 0 for that frame
+    return [
+        (
+            None
+            if post_failed
+            else (aggregate or default_aggregate)(
+                *labels_and_scores_to_score_matrix(labels_and_scores)
+            )
+        )
+        for labels_and_scores, post_failed in zip(labels_and_scores_per_post, failed)
+    ]
 
 
 ## For when we import
@@ -54,11 +210,35 @@ def get_labelling_func_given_config(config):
         ]
     from google.cloud import vision
 
-    gvision_client = vision.ImageAnnotatorClient()
+    return get_labelling_func_given_client(vision.ImageAnnotatorClient(), config)
+
+
+def get_labelling_func_given_client(gvision_client, config):
+    "Everything but setting up the client, so tests can hand it a stand in"
+    batcher = VisionApiBatcher(
+        gvision_client,
+        int(config["GVISION_IMAGES_PER_REQUEST"]),
+        int(config["GVISION_REQUESTS_IN_FLIGHT"]),
+        int(config["GVISION_JPEG_QUALITY"]),
+    )
+    aggregate = get_aggregate_func_given_config(config, SCORE_CUTOFF)
+    is_settled = get_settled_func_given_config(config, SCORE_CUTOFF)
+    dedupe = get_dedupe_func_given_config(config)
 
     def labelling_funtion_gvision(frames):
-        return get_labels_from_frames_gvision(gvision_client, frames)
+        return get_labels_from_frames_gvision(
+            batcher, frames, aggregate, is_settled, dedupe
+        )
 
+    # top_cat.py uses this to label a few posts in one go
+    labelling_funtion_gvision.label_many = functools.partial(
+        get_labels_for_posts_gvision,
+        batcher,
+        aggregate=aggregate,
+        is_settled=is_settled,
+        dedupe=dedupe,
+    )
+    labelling_funtion_gvision.close = batcher.close
     return labelling_funtion_gvision
 
 
@@ -74,7 +254,7 @@ def get_labelling_func_given_config(config):
 
 
 # pil_img = Image.open('/Users/nim/git/top_cat/imgs/sink_cats.jpg')
-# l_s = get_labels_for_im_using_vision_api(pil_img)
+# l_s = VisionApiBatcher(gvision_client).get_labels_and_scores([pil_img])
 # l_s
 
 # frames = cast_to_pil_imgs(
@@ -82,5 +262,5 @@ def get_labelling_func_given_config(config):
 #         )
 
 
-# vision_labels=get_labels_from_frames_gvision(frames)
+# vision_labels=get_labels_from_frames_gvision(VisionApiBatcher(gvision_client), frames)
 # vision_labels
@@ -0,0 +1,195 @@
+"""
+Turns per frame model output into a post's label -> score dict. Shared by deeplab.py and gvision_labeler.py.
+
+Scores are kept in a dense (frames, labels) numpy matrix, then squashed down to one score per label
+by a reducer and filtered against the cutoffs. Frames that don't mention a label count as a 0 for it.
+"""
+
+import functools
+
+import numpy as np
+
+
+class LabelScores(dict):
+    """A label -> score dict that also remembers how many frames went into the scores
+    and which tier of a cascade (eg deeplab's "coarse" or "full") decided them, if any
+    """
+
+    def __init__(self, scores=(), frames_used=None, tier=None):
+        super().__init__(scores)
+        self.frames_used = frames_used
+        self.tier = tier
+
+
+def seg_map_label_fractions(seg_map, num_labels):
+    "What fraction of the seg map's pixels is each label (by label id)?"
+    return np.bincount(seg_map.ravel(), minlength=num_labels) / seg_map.size
+
+
+def seg_maps_to_score_matrix(seg_maps, num_labels):
+    "(frames, num_labels) matrix of label fractions"
+    score_matrix = np.zeros((len(seg_maps), num_labels))
+    for frame_scores, seg_map in zip(score_matrix, seg_maps):
+        frame_scores[:] = seg_map_label_fractions(seg_map, num_labels)
+    return score_matrix
+
+
+def labels_and_scores_to_score_matrix(labels_and_scores_per_frame):
+    """
+    For models that give back a few (label, score) pairs per frame (like google vision).
+    Returns the (frames, labels) matrix and the label names for its columns.
+    """
+    label_names = list(
+        dict.fromkeys(
+            label for labels, _ in labels_and_scores_per_frame for label in labels
+        )
+    )
+    label_ids = {label: label_id for label_id, label in enumerate(label_names)}
+    score_matrix = np.zeros((len(labels_and_scores_per_frame), len(label_names)))
+    for frame_scores, (labels, scores) in zip(
+        score_matrix, labels_and_scores_per_frame
+    ):
+        frame_scores[[label_ids[label] for label in labels]] = scores
+    return score_matrix, label_names
+
+
+def reduce_top_k(score_matrix, k):
+    "Mean of the k best frames for each label"
+    k = min(k, len(score_matrix))
+    return np.sort(score_matrix, axis=0)[-k:].mean(axis=0)
+
+
+def get_reducer(reducer_spec):
+    """
+    "mean", "max", "top_k:N" (mean of the best N frames per label) or "quantile:Q" (0 <= Q <= 1).
+    Gives back a function taking the (frames, labels) matrix to a score per label.
+    """
+    name, _, arg = reducer_spec.partition(":")
+    if name == "mean":
+        return functools.partial(np.mean, axis=0)
+    if name == "max":
+        return functools.partial(np.max, axis=0)
+    if name == "top_k":
+        return functools.partial(reduce_top_k, k=int(arg))
+    if name == "quantile":
+        return functools.partial(np.quantile, q=float(arg), axis=0)
+    raise ValueError(f"Unknown label score reducer '{reducer_spec}'")
+
+
+def aggregate_label_scores(
+    score_matrix, label_names, default_cutoff, reducer="mean", cutoffs=None
+):
+    """
+    Squash a (frames, labels) score matrix down to {label: score} for every label that
+    scored something and made its cutoff (from cutoffs, or default_cutoff if it's not in there).
+    """
+    if len(score_matrix) == 0:
+        return LabelScores(frames_used=0)
+    scores = get_reducer(reducer)(score_matrix)
+    label_cutoffs = get_label_cutoffs(label_names, default_cutoff, cutoffs)
+    keep = np.flatnonzero((scores > 0) & (scores >= label_cutoffs))
+    return LabelScores(
+        {label_names[label_id]: float(scores[label_id]) for label_id in keep},
+        frames_used=len(score_matrix),
+    )
+
+
+def get_label_cutoffs(label_names, default_cutoff, cutoffs=None):
+    "Cutoff for each label, from cutoffs if it's in there"
+    return np.array(
+        [(cutoffs or {}).get(label, default_cutoff) for label in label_names],
+        dtype=float,
+    )
+
+
+def get_label_columns(score_matrix, label_names, labels):
+    "Just the columns for labels, in that order. Labels that aren't in label_names scored 0"
+    label_ids = {label: label_id for label_id, label in enumerate(label_names)}
+    columns = np.zeros((len(score_matrix), len(labels)))
+    for column, label in enumerate(labels):
+        if label in label_ids:
+            columns[:, column] = score_matrix[:, label_ids[label]]
+    return columns
+
+
+def is_decision_settled(
+    score_matrix,
+    label_names,
+    frames_total,
+    labels_to_settle,
+    default_cutoff,
+    reducer="mean",
+    cutoffs=None,
+):
+    """
+    True once none of labels_to_settle could end up on the other side of its cutoff,
+    no matter what the rest of the frames_total frames score. Scores are between 0 and 1,
+    so the worst and best cases are every frame left scoring 0 or 1.
+    """
+    frames_left = frames_total - len(score_matrix)
+    if frames_left <= 0:
+        return True
+    scores_so_far = get_label_columns(score_matrix, label_names, labels_to_settle)
+    reduce = get_reducer(reducer)
+    lowest = reduce(
+        np.vstack([scores_so_far, np.zeros((frames_left, len(labels_to_settle)))])
+    )
+    highest = reduce(
+        np.vstack([scores_so_far, np.ones((frames_left, len(labels_to_settle)))])
+    )
+    label_cutoffs = get_label_cutoffs(labels_to_settle, default_cutoff, cutoffs)
+    return bool(np.all((lowest >= label_cutoffs) | (highest < label_cutoffs)))
+
+
+def is_near_cutoff(
+    score_matrix,
+    label_names,
+    labels_to_check,
+    default_cutoff,
+    margin,
+    reducer="mean",
+    cutoffs=None,
+):
+    "True if any of labels_to_check scored within margin of its cutoff (either side), ie it's too close to call"
+    if len(score_matrix) == 0:
+        return False
+    scores = get_reducer(reducer)(
+        get_label_columns(score_matrix, label_names, labels_to_check)
+    )
+    label_cutoffs = get_label_cutoffs(labels_to_check, default_cutoff, cutoffs)
+    return bool(np.any(np.abs(scores - label_cutoffs) < margin))
+
+
+def get_aggregate_func_given_config(config, default_cutoff):
+    "aggregate_label_scores with LABEL_SCORE_REDUCER and LABEL_SCORE_CUTOFFS filled in"
+    return functools.partial(
+        aggregate_label_scores,
+        default_cutoff=default_cutoff,
+        reducer=config["LABEL_SCORE_REDUCER"],
+        cutoffs=dict(config["LABEL_SCORE_CUTOFFS"]),
+    )
+
+
+def get_settled_func_given_config(config, default_cutoff):
+    "is_decision_settled for LABELS_TO_SEARCH_FOR, or None if STOP_LABELLING_WHEN_SETTLED is off"
+    if not config["STOP_LABELLING_WHEN_SETTLED"]:
+        return None
+    return functools.partial(
+        is_decision_settled,
+        labels_to_settle=list(config["LABELS_TO_SEARCH_FOR"]),
+        default_cutoff=default_cutoff,
+        reducer=config["LABEL_SCORE_REDUCER"],
+        cutoffs=dict(config["LABEL_SCORE_CUTOFFS"]),
+    )
+
+
+def get_near_cutoff_func_given_config(config, default_cutoff, margin):
+    "is_near_cutoff for LABELS_TO_SEARCH_FOR"
+    return functools.partial(
+        is_near_cutoff,
+        labels_to_check=list(config["LABELS_TO_SEARCH_FOR"]),
+        default_cutoff=default_cutoff,
+        margin=margin,
+        reducer=config["LABEL_SCORE_REDUCER"],
+        cutoffs=dict(config["LABEL_SCORE_CUTOFFS"]),
+    )
@@ -0,0 +1,345 @@
+#!/usr/bin/env python3
+
+"""
+Keeps a labelling model warm so top_cat.py (ie every cron run) doesn't have to load it from scratch.
+top_cat.py uses the server whenever one's running with the same labelling settings (LABELLING_CONFIG_KEYS),
+otherwise it loads the model itself.
+The server shuts itself down after LABEL_SERVER_IDLE_TIMEOUT_SECS without any requests.
+
+Messages over the unix socket are framed as:
+    4 byte header length, 4 byte payload length (both big endian), json header, payload
+Frames go in the payload as raw uint8 RGB bytes, their shapes are in the header.
+
+Usage:
+    label_server.py [options]
+
+Options:
+    -h, --help               Show this help message and exit
+    -c, --config FILE        user config file location [default: ~/.top_cat/config.toml]
+    -m, --model-to-use NAME  which model to use for labeling? (deeplab or gvision_labeler)
+    --ping                   Check on the running server instead of starting one
+"""
+
+import hashlib
+import importlib
+import json
+import os
+import socket
+import struct
+import sys
+
+import numpy as np
+from PIL import Image
+
+from label_aggregation import LabelScores
+
+FRAME_HEADER = struct.Struct("!II")
+
+# How long the client waits for the server to connect/answer a ping
+PING_TIMEOUT_SECS = 5
+
+# Config that changes what labels a post gets (rather than just how quickly), which the server and client have to agree on
+LABELLING_CONFIG_KEYS = [
+    "MODEL_TO_USE",
+    "LABELS_TO_SEARCH_FOR",
+    "LABEL_SCORE_CUTOFFS",
+    "LABEL_SCORE_REDUCER",
+    "STOP_LABELLING_WHEN_SETTLED",
+    "NEAR_DUPLICATE_FRAME_MAX_DISTANCE",
+    "DEEPLABV3_FILE_NAME",
+    "DEEPLAB_CASCADE",
+    "DEEPLAB_CASCADE_FILE_NAME",
+    "DEEPLAB_CASCADE_INPUT_SIZE",
+    "DEEPLAB_CASCADE_MARGIN",
+    # These decide whether deeplab uses its worker pool, which skips the cascade and settling
+    "DEEPLAB_WORKER_PROCS",
+    "PROCS_TO_USE",
+    "GVISION_JPEG_QUALITY",
+]
+
+
+def get_labelling_config_fingerprint(config):
+    "sha1 of the LABELLING_CONFIG_KEYS settings (missing ones count as None)"
+    return hashlib.sha1(
+        json.dumps(
+            {key: config.get(key) for key in LABELLING_CONFIG_KEYS}, sort_keys=True
+        ).encode()
+    ).hexdigest()
+
+
+def recv_exactly(sock, num_bytes):
+    chunks = []
+    while num_bytes > 0:
+        chunk = sock.recv(min(num_bytes, 1 << 20))
+        if not chunk:
+            raise ConnectionError("Socket closed mid message")
+        chunks.append(chunk)
+        num_bytes -= len(chunk)
+    return b"".join(chunks)
+
+
+def send_message(sock, header, payload=b""):
+    header_bytes = json.dumps(header).encode()
+    sock.sendall(FRAME_HEADER.pack(len(header_bytes), len(payload)) + header_bytes)
+    if payload:
+        sock.sendall(payload)
+
+
+def recv_message(sock):
+    "Returns the header (dict) and payload (bytes)"
+    header_len, payload_len = FRAME_HEADER.unpack(recv_exactly(sock, FRAME_HEADER.size))
+    header = json.loads(recv_exactly(sock, header_len))
+    return header, recv_exactly(sock, payload_len)
+
+
+def pack_frames(frames_per_post):
+    "Shapes (per post) for the header, all the frames' bytes for the payload"
+    shapes_per_post = []
+    chunks = []
+    for frames in frames_per_post:
+        shapes = []
+        for frame in frames:
+            if not isinstance(frame, np.ndarray):
+                frame = np.asarray(frame.convert("RGB"))
+            frame = np.ascontiguousarray(frame, dtype=np.uint8)
+            shapes.append(frame.shape)
+            chunks.append(frame.data)
+        shapes_per_post.append(shapes)
+    return shapes_per_post, b"".join(chunks)
+
+
+def unpack_frames(shapes_per_post, payload):
+    "Frames are (read only) views into payload, no copies"
+    frames_per_post = []
+    offset = 0
+    for shapes in shapes_per_post:
+        frames = []
+        for shape in shapes:
+            count = int(np.prod(shape))
+            frames.append(
+                np.frombuffer(payload, np.uint8, count, offset).reshape(shape)
+            )
+            offset += count
+        frames_per_post.append(frames)
+    return frames_per_post
+
+
+def label_many_with(labelling_function, frames_per_post):
+    "frames_per_post are numpy frames, which labellers without accepts_numpy_batch get as PIL images instead"
+    if not getattr(labelling_function, "accepts_numpy_batch", False):
+        frames_per_post = [
+            [
+                Image.fromarray(frame) if isinstance(frame, np.ndarray) else frame
+                for frame in frames
+            ]
+            for frames in frames_per_post
+        ]
+    if hasattr(labelling_function, "label_many"):
+        return labelling_function.label_many(frames_per_post)
+    return [labelling_function(frames) for frames in frames_per_post]
+
+
+def handle_message(
+    header, payload, labelling_function, model_name, config_fingerprint=None
+):
+    if header["op"] == "ping":
+        return {
+            "ok": True,
+            "model": model_name,
+            "config_fingerprint": config_fingerprint,
+            "pid": os.getpid(),
+        }
+    if header["op"] == "label_many":
+        labels_per_post = label_many_with(
+            labelling_function, unpack_frames(header["shapes_per_post"], payload)
+        )
+        return {
+            "ok": True,
+            # None for posts the model couldn't label (eg a gvision api error)
+            "labels_per_post": [
+                (
+                    None
+                    if labels is None
+                    else {label: float(score) for label, score in labels.items()}
+                )
+                for labels in labels_per_post
+            ],
+            "frames_used_per_post": [
+                getattr(labels, "frames_used", None) for labels in labels_per_post
+            ],
+            "tier_per_post": [
+                getattr(labels, "tier", None) for labels in labels_per_post
+            ],
+        }
+    return {"ok": False, "error": f"Unknown op {header['op']}"}
+
+
+def serve(
+    labelling_function,
+    model_name,
+    socket_path,
+    idle_timeout_secs,
+    config_fingerprint=None,
+):
+    """
+    Answer requests one connection at a time until nobody's asked for anything in idle_timeout_secs.
+    config_fingerprint (see get_labelling_config_fingerprint) goes in ping replies so clients can check it
+    """
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_path)
+    server.listen()
+    server.settimeout(idle_timeout_secs)
+    try:
+        while True:
+            try:
+                conn, _ = server.accept()
+            except socket.timeout:
+                return
+            with conn:
+                conn.settimeout(idle_timeout_secs)
+                try:
+                    while True:
+                        try:
+                            header, payload = recv_message(conn)
+                        except ConnectionError:
+                            break
+                        try:
+                            reply = handle_message(
+                                header,
+                                payload,
+                                labelling_function,
+                                model_name,
+                                config_fingerprint,
+                            )
+                        except Exception as e:
+                            reply = {"ok": False, "error": repr(e)}
+                        send_message(conn, reply)
+                except (OSError, ValueError) as e:
+                    print(f"# WARNING: dropped a client ({e})", file=sys.stderr)
+    finally:
+        server.close()
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+
+
+def request(socket_path, header, payload=b"", timeout=None):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(socket_path)
+        send_message(sock, header, payload)
+        reply, _ = recv_message(sock)
+    if not reply["ok"]:
+        raise RuntimeError(f"Label server failed: {reply['error']}")
+    return reply
+
+
+def ping(socket_path):
+    "The server's ping reply, or None if there's no (healthy) server there"
+    try:
+        return request(socket_path, {"op": "ping"}, timeout=PING_TIMEOUT_SECS)
+    except (OSError, ValueError, RuntimeError):
+        return None
+
+
+def get_labelling_func_from_server(config, fallback=None):
+    """
+    A labelling function that hands frames over to a running server, or None if there isn't one
+    (or it's running with other labelling settings, in which case its labels wouldn't be what config asks for).
+    If the server stops answering (within LABEL_SERVER_TIMEOUT_SECS) partway through a run,
+    frames go to fallback (eg a top_cat.LazyLabellingFunction) from then on.
+    """
+    socket_path = os.path.expanduser(config["LABEL_SERVER_SOCKET"])
+    server_health = ping(socket_path)
+    if server_health is None or server_health["model"] != config["MODEL_TO_USE"]:
+        return None
+    if server_health.get("config_fingerprint") != get_labelling_config_fingerprint(
+        config
+    ):
+        print(
+            "# WARNING: the label server has different labelling settings, loading the model here instead."
+            " Restart it to pick up this config",
+            file=sys.stderr,
+        )
+        return None
+    timeout = float(config["LABEL_SERVER_TIMEOUT_SECS"])
+    server_lost = False
+
+    def label_many(frames_per_post):
+        nonlocal server_lost
+        if server_lost:
+            return label_many_with(fallback, frames_per_post)
+        shapes_per_post, payload = pack_frames(frames_per_post)
+        try:
+            reply = request(
+                socket_path,
+                {"op": "label_many", "shapes_per_post": shapes_per_post},
+                payload,
+                timeout=timeout,
+            )
+        except (OSError, ValueError) as e:
+            # Went away (eg its idle timeout ran out while we were downloading) or hung
+            if fallback is None:
+                raise
+            print(
+                f"# WARNING: lost the label server ({e!r}), loading the model here instead",
+                file=sys.stderr,
+            )
+            server_lost = True
+            return label_many_with(fallback, frames_per_post)
+        return [
+            None if labels is None else LabelScores(labels, frames_used, tier)
+            for labels, frames_used, tier in zip(
+                reply["labels_per_post"],
+                reply["frames_used_per_post"],
+                reply["tier_per_post"],
+            )
+        ]
+
+    def labelling_funtion_label_server(frames):
+        return label_many([frames])[0]
+
+    labelling_funtion_label_server.label_many = label_many
+    labelling_funtion_label_server.accepts_numpy_batch = True
+    if hasattr(fallback, "close"):
+        labelling_funtion_label_server.close = fallback.close
+    return labelling_funtion_label_server
+
+
+def main():
+    from docopt import docopt
+
+    from top_cat import get_config
+
+    args = docopt(__doc__)
+    config = get_config(config_file_loc=args["--config"])
+    if args["--model-to-use"]:
+        config["MODEL_TO_USE"] = args["--model-to-use"]
+    socket_path = os.path.expanduser(config["LABEL_SERVER_SOCKET"])
+
+    server_health = ping(socket_path)
+    if args["--ping"]:
+        print(json.dumps(server_health))
+        sys.exit(0 if server_health else 1)
+    if server_health:
+        sys.exit(f"# Label server already running: {server_health}")
+    if os.path.exists(socket_path):
+        # Left over from a server that didn't get to clean up after itself
+        os.unlink(socket_path)
+
+    model_package = importlib.import_module(config["MODEL_TO_USE"])
+    labelling_function = model_package.get_labelling_func_given_config(config)
+    try:
+        serve(
+            labelling_function,
+            config["MODEL_TO_USE"],
+            socket_path,
+            float(config["LABEL_SERVER_IDLE_TIMEOUT_SECS"]),
+            get_labelling_config_fingerprint(config),
+        )
+    finally:
+        if hasattr(labelling_function, "close"):
+            labelling_function.close()
+
+
+if __name__ == "__main__":
+    main()
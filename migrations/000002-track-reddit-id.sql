@@ -0,0 +1,11 @@
+-- Keep track of the reddit post (eg t3_hrz5lj) and the url as it was posted
+-- so we can tell which posts are new without resolving any urls.
+-- Older rows get filled in by top_cat.py the next time it sees them.
+alter table post add column reddit_id text;
+alter table post add column orig_url text;
+
+CREATE INDEX IF NOT EXISTS
+post_reddit_id_index
+on  post (
+        reddit_id
+    );
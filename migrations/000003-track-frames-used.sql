@@ -0,0 +1,3 @@
+-- How many of the sampled frames the labeller actually looked at
+-- (fewer than we sampled when STOP_LABELLING_WHEN_SETTLED cut it short). null for older rows.
+alter table post add column frames_used int;
@@ -0,0 +1,4 @@
+-- Which model labelled the post, so its labels can be reused for the same media (see get_labelled_post_given_media_hash).
+-- Posts where the model didn't find anything don't have any post_label rows to tell us.
+-- null for older rows.
+alter table post add column model text;
@@ -0,0 +1,3 @@
+-- Perceptual hash of the post's sampled frames (see phash_index.py) so we can spot reposts that got re-encoded or resized.
+-- null for older rows (we don't keep their media around to hash).
+alter table post add column phash text;
@@ -0,0 +1,3 @@
+-- The url we actually downloaded (and so hashed into media_hash): a smaller rendition when SELECT_SMALLEST_USEFUL_MEDIA picked one.
+-- null for older rows, whose media_hash is of the full quality url.
+alter table post add column media_url text;
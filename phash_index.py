@@ -0,0 +1,162 @@
+"""
+Perceptual hashes for posts and a BK-tree to find posts whose hashes are close, so reposts that got
+re-encoded or resized (which changes their sha1 media_hash) can reuse the labels we already have.
+
+A post's hash is a 64 bit dHash (see frame_dedup) of its sampled frames averaged together, plus the mean colour
+of those frames. dHash only sees edges (a flat black frame and a flat white one hash the same, as does
+anything that gets darker left to right) so posts have to be about the same colour too, and posts with
+hardly any edges (or hardly anything but) don't get a hash at all.
+Hashes are kept as hex strings (16 characters of dHash, then 6 of RGB colour) and compared by Hamming distance.
+"""
+
+import os
+import pickle
+
+import numpy as np
+
+from frame_dedup import dhash_given_small_frame, shrink_frame_for_dhash
+
+PHASH_BITS = 64
+# Hex characters: the dHash then the mean RGB colour
+PHASH_LENGTH = PHASH_BITS // 4 + 6
+PHASH_INDEX_VERSION = 2
+
+# Hashes with fewer than this many bits set (or unset) are mostly flat, gradients or a single edge, which too many
+#  posts share (the photos in imgs/ have 24-36). Missing one just means labelling it again
+MIN_PHASH_EDGE_BITS = 20
+
+# Most any channel of two posts' mean colours can differ (0-255) and still count as looking the same
+MAX_MEAN_COLOUR_DIFF = 8
+
+
+def as_rgb_frame(frame):
+    "Grayscale/palette/RGBA PIL images and arrays as (h, w, 3) RGB, so the mean colour always has 3 channels"
+    if hasattr(frame, "convert"):
+        return frame if frame.mode == "RGB" else frame.convert("RGB")
+    frame = np.asarray(frame)
+    if frame.ndim == 2:
+        return np.repeat(frame[..., np.newaxis], 3, axis=2)
+    return frame[..., :3]
+
+
+def get_post_phash(frames):
+    """
+    frames are PIL images (any mode) or (h, w) / (h, w, 3) uint8 arrays (or an (n, h, w, 3) array).
+    None if there aren't any or they don't have enough edges to tell them apart from other posts
+    """
+    if len(frames) == 0:
+        return None
+    hash_size = int(PHASH_BITS**0.5)
+    mean_frame = sum(
+        shrink_frame_for_dhash(as_rgb_frame(frame), hash_size) for frame in frames
+    ) / len(frames)
+    bits = dhash_given_small_frame(mean_frame)
+    if not MIN_PHASH_EDGE_BITS <= bits.sum() <= PHASH_BITS - MIN_PHASH_EDGE_BITS:
+        return None
+    mean_colour = mean_frame.mean(axis=(0, 1)).round().astype(int)
+    return f"{int(''.join('1' if bit else '0' for bit in bits), 2):016x}" + "".join(
+        f"{channel:02x}" for channel in mean_colour
+    )
+
+
+def phash_distance(phash_a, phash_b):
+    "How many bits of their dHashes are different"
+    return bin(int(phash_a[:16], 16) ^ int(phash_b[:16], 16)).count("1")
+
+
+def phash_colour_diff(phash_a, phash_b):
+    "Biggest difference between any channel of their mean colours"
+    return max(
+        abs(a - b)
+        for a, b in zip(bytes.fromhex(phash_a[16:]), bytes.fromhex(phash_b[16:]))
+    )
+
+
+def phashes_look_alike(phash_a, phash_b, max_distance):
+    return (
+        phash_distance(phash_a, phash_b) <= max_distance
+        and phash_colour_diff(phash_a, phash_b) <= MAX_MEAN_COLOUR_DIFF
+    )
+
+
+class BKTree(object):
+    """Burkhard-Keller tree: finds every hash within some distance without comparing against all of them.
+
+    Each node's children are keyed by their distance from it, so (triangle inequality) a search
+    only has to go down children whose key is within max_distance of the query's distance to the node.
+    Hashes with the same dHash but a different colour are distance 0 apart, so they can be children too.
+    Nodes are [phash, post_ids, {distance: child node}] lists so they pickle small.
+    """
+
+    def __init__(self):
+        self.root = None
+        self.size = 0
+
+    def add(self, phash, post_id):
+        self.size += 1
+        if self.root is None:
+            self.root = [phash, [post_id], {}]
+            return
+        node = self.root
+        while True:
+            if phash == node[0]:
+                node[1].append(post_id)
+                return
+            distance = phash_distance(phash, node[0])
+            if distance not in node[2]:
+                node[2][distance] = [phash, [post_id], {}]
+                return
+            node = node[2][distance]
+
+    def find(self, phash, max_distance):
+        "(distance, post_id) for everything within max_distance that's about the same colour, closest first"
+        found = []
+        nodes_to_check = [self.root] if self.root is not None else []
+        while nodes_to_check:
+            node = nodes_to_check.pop()
+            distance = phash_distance(phash, node[0])
+            if (
+                distance <= max_distance
+                and phash_colour_diff(phash, node[0]) <= MAX_MEAN_COLOUR_DIFF
+            ):
+                found += [(distance, post_id) for post_id in node[1]]
+            nodes_to_check += [
+                child
+                for child_distance, child in node[2].items()
+                if abs(child_distance - distance) <= max_distance
+            ]
+        return sorted(found)
+
+
+class PhashIndex(object):
+    """A BKTree of posts' phashes that remembers the last post_id it has seen,
+    so it can be topped up from the post table and saved between runs instead of rebuilt.
+    """
+
+    def __init__(self):
+        self.tree = BKTree()
+        self.last_post_id = 0
+
+    def add(self, phash, post_id):
+        self.tree.add(phash, post_id)
+        self.last_post_id = max(self.last_post_id, post_id)
+
+    def find(self, phash, max_distance):
+        return self.tree.find(phash, max_distance)
+
+    def save(self, path):
+        "Written to a temp file first so a run getting killed can't leave half an index behind"
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path + ".tmp", "wb") as f:
+            pickle.dump((PHASH_INDEX_VERSION, self), f)
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def load(cls, path):
+        "The saved index, or a new empty one if there isn't a (usable) one at path"
+        try:
+            with open(path, "rb") as f:
+                version, index = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError, ValueError, AttributeError):
+            return cls()
+        return index if version == PHASH_INDEX_VERSION else cls()
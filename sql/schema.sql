@@ -5,6 +5,12 @@ post (
     url           text not null,
     media_hash    text not null,
     title         text not null,
+    reddit_id     text,
+    orig_url      text,
+    frames_used   int,
+    model         text,
+    phash         text,
+    media_url     text,
     ts_ins        text not null default current_timestamp,
     ts_upd        text,
     ts_del        text
@@ -34,6 +40,23 @@ top_post (
     FOREIGN KEY(post_id) REFERENCES post(post_id)
 );
 
+-- More reddit posts (crossposts, reposts of the same url...) that turned out to be a post we'd already recorded
+--  under another reddit_id, so they can be found by reddit id too
+CREATE TABLE IF NOT EXISTS
+post_reddit_id (
+    reddit_id     text PRIMARY KEY,
+    post_id       int not null,
+    ts_ins        text not null default current_timestamp,
+    FOREIGN KEY(post_id) REFERENCES post(post_id)
+);
+
+CREATE TABLE IF NOT EXISTS
+run_state (
+    key           text PRIMARY KEY,
+    value         text not null,
+    ts_upd        text not null default current_timestamp
+);
+
 
 CREATE INDEX IF NOT EXISTS
 media_url_index
@@ -41,6 +64,18 @@ on  post (
         url
     );
 
+CREATE INDEX IF NOT EXISTS
+post_media_hash_index
+on  post (
+        media_hash
+    );
+
+CREATE INDEX IF NOT EXISTS
+post_reddit_id_index
+on  post (
+        reddit_id
+    );
+
 CREATE INDEX IF NOT EXISTS
 top_post_post_id_index
 on  top_post (
@@ -52,3 +87,16 @@ post_label_post_id_index
 on  post_label (
         post_id
     );
+
+-- name: create_url_cache_table#
+-- Lives in its own little db file (URL_CACHE_FILE) so it can be thrown away at any time
+CREATE TABLE IF NOT EXISTS
+resolved_url (
+    kind          text not null,
+    url           text not null,
+    resolved_url  text,
+    ok            int not null,
+    ts_ins        text not null default current_timestamp,
+    ts_expires    text not null,
+    PRIMARY KEY (kind, url)
+);
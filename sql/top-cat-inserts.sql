@@ -1,11 +1,28 @@
--- name: record_post!
--- Stash metadata for the post found on /r/aww
-INSERT INTO post (url, media_hash, title) values (:url, :media_hash, :title);
+-- name: record_post<!
+-- Stash metadata for the post found on /r/aww. Gives back the new post_id
+-- media_hash is the sha1 of whatever media_url (maybe a smaller rendition of url) gave us
+INSERT INTO post (url, media_hash, title, reddit_id, orig_url, frames_used, model, phash, media_url)
+values (:url, :media_hash, :title, :reddit_id, :orig_url, :frames_used, :model, :phash, :media_url);
 
--- name: record_post_label!
--- Record all the labels above the minimum cutoff in the db
+-- name: record_post_labels*!
+-- Record all of a post's labels above the minimum cutoff in the db at once
 INSERT INTO post_label (post_id, label, score, model) values (:post_id, :label, :score, :model);
 
+-- name: record_other_reddit_id_for_post!
+-- Another reddit post (eg a crosspost) with the same url as a post we already have under a different reddit_id
+INSERT OR IGNORE INTO post_reddit_id (reddit_id, post_id)
+SELECT :reddit_id, :post_id
+ WHERE EXISTS (SELECT 1 FROM post WHERE post_id = :post_id AND reddit_id != :reddit_id);
+
 -- name: record_the_repost!
 -- We found a top cat/dog, record it so we only reshare it once
 INSERT INTO top_post (post_id,label) values (:post_id, :label);
+
+-- name: cache_url!
+-- Remember what a url resolved to (or that it failed) until it expires
+INSERT OR REPLACE INTO resolved_url (kind, url, resolved_url, ok, ts_expires)
+values (:kind, :url, :resolved_url, :ok, datetime('now', :ttl));
+
+-- name: set_run_state!
+-- Remember something (json encoded) for the next run
+INSERT OR REPLACE INTO run_state (key, value, ts_upd) values (:key, :value, current_timestamp);
@@ -1,12 +1,87 @@
--- name: get_post_given_url^
--- Get the post_id and media_hash associated with a url
-SELECT post_id, media_hash FROM post WHERE url = :url;
+-- name: get_posts_and_labels_given_reddit_ids
+-- Every post we have for a json list of reddit ids (its own or one in post_reddit_id) along with its labels,
+-- for a whole listing in one go. One row per label (best first), posts without labels get one row with a null label
+WITH listing_post AS (
+    SELECT reddit_id, post_id
+      FROM post
+     WHERE reddit_id IN (SELECT value FROM json_each(:reddit_ids))
+     UNION ALL
+    SELECT reddit_id, post_id
+      FROM post_reddit_id
+     WHERE reddit_id IN (SELECT value FROM json_each(:reddit_ids))
+)
+SELECT lp.reddit_id, p.post_id, p.media_hash, p.url, pl.label, pl.score
+  FROM listing_post lp
+  JOIN post p
+    ON p.post_id = lp.post_id
+  LEFT JOIN post_label pl
+    ON pl.post_id = p.post_id
+   AND pl.ts_del IS NULL
+ ORDER BY p.post_id, pl.score DESC
+;
+
+-- name: get_posts_and_labels_given_urls
+-- Same as get_posts_and_labels_given_reddit_ids, but for a json list of (fixed) urls
+SELECT p.url, p.post_id, p.media_hash, p.url, pl.label, pl.score
+  FROM post p
+  LEFT JOIN post_label pl
+    ON pl.post_id = p.post_id
+   AND pl.ts_del IS NULL
+ WHERE p.url IN (SELECT value FROM json_each(:urls))
+ ORDER BY p.post_id, pl.score DESC
+;
+
+-- name: get_labelled_post_given_media_hash^
+-- Latest post with exactly the same media that was labelled by this model.
+-- Posts from before we tracked the model count if they have labels from it.
+SELECT p.post_id, p.frames_used
+  FROM post p
+ WHERE p.media_hash = :media_hash
+   AND p.ts_del IS NULL
+   AND (p.model = :model
+        OR (p.model IS NULL
+            AND EXISTS (SELECT 1
+                          FROM post_label pl
+                         WHERE pl.post_id = p.post_id
+                           AND pl.model = :model
+                           AND pl.ts_del IS NULL)))
+ ORDER BY p.post_id DESC
+ LIMIT 1
+;
+
+-- name: get_labelled_post^
+-- Same as get_labelled_post_given_media_hash, but for a post_id (eg one found in the phash index)
+SELECT p.post_id, p.frames_used
+  FROM post p
+ WHERE p.post_id = :post_id
+   AND p.ts_del IS NULL
+   AND (p.model = :model
+        OR (p.model IS NULL
+            AND EXISTS (SELECT 1
+                          FROM post_label pl
+                         WHERE pl.post_id = p.post_id
+                           AND pl.model = :model
+                           AND pl.ts_del IS NULL)))
+;
 
--- name: get_labels_and_scores_for_post
--- Get the labels we already calculated for a post
+-- name: get_post_phashes_since
+-- Posts recorded after post_id (phash is null for posts we couldn't hash), for topping up the phash index
+SELECT post_id, phash FROM post WHERE post_id > :post_id ORDER BY post_id;
+
+-- name: get_max_post_id$
+-- Biggest post_id so far (None for an empty db)
+SELECT max(post_id) FROM post;
+
+-- name: get_post_column_names
+-- Lets us figure out if an older db needs migrating
+SELECT name FROM pragma_table_info('post');
+
+-- name: get_labels_and_scores_for_post_and_model
+-- Get the labels we already calculated for a post with one model
 SELECT label, score
   FROM post_label
  WHERE post_id = :post_id
+   AND model = :model
    AND ts_del is NULL
  ORDER BY score DESC
 ;
@@ -14,3 +89,16 @@ SELECT label, score
 -- name: did_we_already_repost^
 -- If a post_id has already been reposted to social media then we'll get a row
 SELECT post_id, label FROM top_post WHERE post_id = :post_id and label = :label;
+
+-- name: get_cached_url^
+-- What did this url resolve to last time? Only if it hasn't expired yet
+SELECT resolved_url, ok
+  FROM resolved_url
+ WHERE kind = :kind
+   AND url = :url
+   AND ts_expires > datetime('now')
+;
+
+-- name: get_run_state^
+-- Things we remember between runs (json encoded), eg the fingerprint of the last listing
+SELECT value FROM run_state WHERE key = :key;
@@ -5,3 +5,14 @@ UPDATE post_label
  where post_id = :post_id
    and ts_del is null
 ;
+
+-- name: set_reddit_id_for_post!
+-- Posts recorded before we tracked reddit ids get them filled in the next time we see them.
+-- Posts that already have one keep it (see record_other_reddit_id_for_post)
+UPDATE post
+   set reddit_id = :reddit_id
+     , orig_url = :orig_url
+     , ts_upd = current_timestamp
+ where post_id = :post_id
+   and reddit_id is null
+;
@@ -0,0 +1,42 @@
+import numpy as np
+from PIL import Image
+
+from frame_dedup import dedupe_frames, dhash, get_dedupe_func_given_config
+
+
+def make_frames():
+    rng = np.random.default_rng(0)
+    still = rng.integers(0, 256, (90, 120, 3), dtype=np.uint8)
+    # Same shot with a bit of compression noise
+    noisy_still = np.clip(
+        still.astype(int) + rng.integers(-4, 5, still.shape), 0, 255
+    ).astype(np.uint8)
+    something_else = rng.integers(0, 256, (90, 120, 3), dtype=np.uint8)
+    return np.stack([still, noisy_still, something_else, still])
+
+
+def test_dhash():
+    frames = make_frames()
+    assert dhash(frames[0]).shape == (256,)
+    assert np.array_equal(dhash(frames[0]), dhash(Image.fromarray(frames[0])))
+    assert np.count_nonzero(dhash(frames[0]) != dhash(frames[1])) <= 10
+    assert np.count_nonzero(dhash(frames[0]) != dhash(frames[2])) > 64
+
+
+def test_dedupe_frames():
+    frames = make_frames()
+    deduped, counts = dedupe_frames(frames, 10)
+    assert np.array_equal(deduped, frames[[0, 2]]) and counts == [3, 1]
+    # PIL images come back as a list
+    deduped, counts = dedupe_frames([Image.fromarray(frame) for frame in frames], 10)
+    assert len(deduped) == 2 and counts == [3, 1]
+    # Turned off
+    dedupe = get_dedupe_func_given_config({"NEAR_DUPLICATE_FRAME_MAX_DISTANCE": -1})
+    deduped, counts = dedupe(frames)
+    assert deduped is frames and counts == [1, 1, 1, 1]
+    assert dedupe_frames(frames[:0], 10)[1] == []
+    # Flat frames have the same dhash, but a black frame isn't a red one
+    red = np.zeros((90, 120, 3), dtype=np.uint8)
+    red[..., 0] = 255
+    assert np.array_equal(dhash(red), dhash(red * 0))
+    assert dedupe_frames(np.stack([red, red * 0, red]), 10)[1] == [2, 1]
@@ -0,0 +1,162 @@
+import functools
+import threading
+import time
+from io import BytesIO
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from frame_dedup import dedupe_frames
+from gvision_labeler import (
+    LABEL_DETECTION,
+    VisionApiBatcher,
+    get_labelling_func_given_client,
+    get_labels_for_posts_gvision,
+)
+from label_aggregation import is_decision_settled
+
+
+class FakeImageAnnotatorClient(object):
+    """Stand in for vision.ImageAnnotatorClient that doesn't need the internet (or credentials).
+
+    Only does batch_annotate_images with label detection. Frames get a "Cat" label scored by how red
+    they are, and fully green frames get an error back instead of labels.
+    Keeps track of what it was sent and how many calls were going at once.
+    """
+
+    MAX_IMAGES_PER_REQUEST = 16
+
+    def __init__(self, secs_per_call=0.0):
+        self.secs_per_call = secs_per_call
+        self.lock = threading.Lock()
+        self.images_per_call = []
+        self.image_formats = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def label_image(self, request):
+        assert request["features"] == [{"type_": LABEL_DETECTION, "max_results": 50}]
+        image = Image.open(BytesIO(request["image"]["content"]))
+        with self.lock:
+            self.image_formats.append(image.format)
+        pixels = np.asarray(image.convert("RGB"), dtype=float) / 255
+        if pixels[..., 1].mean() > 0.9:
+            return SimpleNamespace(
+                label_annotations=[], error=SimpleNamespace(message="Bad image data.")
+            )
+        redness = float(np.clip(pixels[..., 0] - pixels[..., 2], 0, 1).mean())
+        return SimpleNamespace(
+            label_annotations=[SimpleNamespace(description="Cat", score=redness)],
+            error=SimpleNamespace(message=""),
+        )
+
+    def batch_annotate_images(self, requests):
+        if len(requests) > self.MAX_IMAGES_PER_REQUEST:
+            raise ValueError("400 Too many images per request")
+        with self.lock:
+            self.images_per_call.append(len(requests))
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            time.sleep(self.secs_per_call)
+            return SimpleNamespace(
+                responses=[self.label_image(request) for request in requests]
+            )
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+
+def make_frame(red):
+    frame = np.zeros((40, 50, 3), dtype=np.uint8)
+    frame[..., 0] = red
+    return Image.fromarray(frame)
+
+
+def test_batched_and_concurrent():
+    client = FakeImageAnnotatorClient(secs_per_call=0.05)
+    batcher = VisionApiBatcher(client, images_per_request=4, requests_in_flight=3)
+    # 10 red frames, 3 black ones and 2 red ones plus one that errors out
+    green = Image.fromarray(np.full((40, 50, 3), (0, 255, 0), dtype=np.uint8))
+    frames_per_post = [
+        [make_frame(255)] * 10,
+        [make_frame(0)] * 3,
+        [make_frame(255), make_frame(250), green],
+    ]
+    cat_post, no_cat_post, half_error_post = get_labels_for_posts_gvision(
+        batcher, frames_per_post
+    )
+    assert cat_post == {"cat": pytest.approx(1.0, abs=0.02)}
+    assert no_cat_post == {}
+    # A frame that errored means the post gets tried again later, not recorded without labels
+    assert half_error_post is None
+    # Frames from different posts share calls
+    assert sorted(client.images_per_call) == [4, 4, 4, 4]
+    assert client.max_in_flight == 3
+    assert set(client.image_formats) == {"JPEG"}
+    batcher.close()
+
+
+def test_stops_when_settled():
+    client = FakeImageAnnotatorClient()
+    batcher = VisionApiBatcher(client, images_per_request=2, requests_in_flight=1)
+    is_settled = functools.partial(
+        is_decision_settled, labels_to_settle=["cat"], default_cutoff=0.4
+    )
+    red_frames = [make_frame(255), make_frame(254), make_frame(253), make_frame(252)]
+    (labels,) = get_labels_for_posts_gvision(
+        batcher,
+        [red_frames],
+        is_settled=is_settled,
+        dedupe=functools.partial(dedupe_frames, max_distance=None),
+    )
+    # 2 (very nearly) red frames out of 4 is already almost 0.5
+    assert labels.frames_used == 2 and client.images_per_call == [2]
+    batcher.close()
+
+
+def test_error_fails_the_post():
+    client = FakeImageAnnotatorClient()
+    batcher = VisionApiBatcher(client, images_per_request=2, requests_in_flight=1)
+    is_settled = functools.partial(
+        is_decision_settled, labels_to_settle=["cat"], default_cutoff=0.4
+    )
+    green = Image.fromarray(np.full((40, 50, 3), (0, 255, 0), dtype=np.uint8))
+    error_labels, cat_labels = get_labels_for_posts_gvision(
+        batcher,
+        [[green, make_frame(10), make_frame(20), make_frame(30)], [make_frame(255)]],
+        is_settled=is_settled,
+        dedupe=functools.partial(dedupe_frames, max_distance=None),
+    )
+    assert error_labels is None
+    assert cat_labels == {"cat": pytest.approx(1.0, abs=0.02)}
+    # The failed post doesn't send the rest of its frames
+    assert client.images_per_call == [2]
+    batcher.close()
+
+
+def test_get_labelling_func_given_client():
+    config = {
+        "GVISION_IMAGES_PER_REQUEST": 16,
+        "GVISION_REQUESTS_IN_FLIGHT": 2,
+        "GVISION_JPEG_QUALITY": 50,
+        "LABEL_SCORE_REDUCER": "mean",
+        "LABEL_SCORE_CUTOFFS": {},
+        "STOP_LABELLING_WHEN_SETTLED": False,
+        "LABELS_TO_SEARCH_FOR": ["cat", "dog"],
+        "NEAR_DUPLICATE_FRAME_MAX_DISTANCE": 10,
+    }
+    client = FakeImageAnnotatorClient()
+    labelling_function = get_labelling_func_given_client(client, config)
+    assert labelling_function([make_frame(255), make_frame(255)]) == {
+        "cat": pytest.approx(1.0, abs=0.02)
+    }
+    # Same frame twice only gets sent once
+    assert client.images_per_call == [1]
+    assert labelling_function.label_many([[make_frame(0)], [make_frame(255)]]) == [
+        {},
+        {"cat": pytest.approx(1.0, abs=0.02)},
+    ]
+    assert client.images_per_call == [1, 2]
@@ -0,0 +1,140 @@
+from collections import Counter
+
+import numpy as np
+import pytest
+
+from label_aggregation import (
+    aggregate_label_scores,
+    get_aggregate_func_given_config,
+    get_settled_func_given_config,
+    is_decision_settled,
+    is_near_cutoff,
+    labels_and_scores_to_score_matrix,
+    seg_maps_to_score_matrix,
+)
+
+LABEL_NAMES = ["background", "cat", "dog"]
+
+
+def get_label_proportions_the_old_way(seg_maps, score_cutoff):
+    "What deeplab.py used to do with Counters"
+    proportion_label_in_post = Counter()
+    for seg_map in seg_maps:
+        labels, num_pixels = np.unique(seg_map, return_counts=True)
+        labels_text = [LABEL_NAMES[label] for label in labels]
+        proportion_label_in_post += Counter(
+            dict(zip(labels_text, 1.0 * num_pixels / seg_map.size / len(seg_maps)))
+        )
+    for label in list(proportion_label_in_post.keys()):
+        if proportion_label_in_post[label] < score_cutoff:
+            del proportion_label_in_post[label]
+    return proportion_label_in_post
+
+
+def test_seg_maps_match_the_old_way():
+    rng = np.random.default_rng(0)
+    seg_maps = [rng.choice([0, 0, 0, 1, 2], size=(30, 40)) for _ in range(5)]
+    seg_maps.append(np.zeros((10, 10), dtype=int))
+    new_scores = aggregate_label_scores(
+        seg_maps_to_score_matrix(seg_maps, len(LABEL_NAMES)), LABEL_NAMES, 0.05
+    )
+    old_scores = get_label_proportions_the_old_way(seg_maps, 0.05)
+    assert new_scores.keys() == old_scores.keys() and all(
+        new_scores[label] == pytest.approx(old_scores[label]) for label in new_scores
+    )
+
+
+def test_reducers_and_cutoffs():
+    # 4 frames: cat is in one of them, dog is in every one a little bit
+    score_matrix = np.array(
+        [
+            [0.9, 0.0, 0.1],
+            [0.9, 0.0, 0.1],
+            [0.9, 0.0, 0.1],
+            [0.1, 0.8, 0.1],
+        ]
+    )
+    assert aggregate_label_scores(score_matrix, LABEL_NAMES, 0.25) == {
+        "background": pytest.approx(0.7)
+    }
+    assert aggregate_label_scores(
+        score_matrix, LABEL_NAMES, 0.25, cutoffs={"cat": 0.25, "dog": 0.1}
+    ) == {
+        "background": pytest.approx(0.7),
+        "dog": pytest.approx(0.1),
+    }
+    assert aggregate_label_scores(score_matrix, LABEL_NAMES, 0.5, "max") == {
+        "background": 0.9,
+        "cat": 0.8,
+    }
+    assert aggregate_label_scores(score_matrix, LABEL_NAMES, 0.3, "top_k:2") == {
+        "background": 0.9,
+        "cat": 0.4,
+    }
+    assert aggregate_label_scores(score_matrix, LABEL_NAMES, 0.3, "quantile:0.5") == {
+        "background": 0.9
+    }
+    assert aggregate_label_scores(np.zeros((0, 3)), LABEL_NAMES, 0.3) == {}
+    with pytest.raises(ValueError):
+        aggregate_label_scores(score_matrix, LABEL_NAMES, 0.3, "median")
+
+
+def test_labels_and_scores_to_score_matrix():
+    score_matrix, label_names = labels_and_scores_to_score_matrix(
+        [(["cat", "whiskers"], [0.9, 0.6]), (["cat"], [0.7]), ([], [])]
+    )
+    assert label_names == ["cat", "whiskers"]
+    assert np.array_equal(score_matrix, [[0.9, 0.6], [0.7, 0], [0, 0]])
+    aggregate = get_aggregate_func_given_config(
+        {"LABEL_SCORE_REDUCER": "mean", "LABEL_SCORE_CUTOFFS": {"whiskers": 0.15}},
+        0.5,
+    )
+    assert aggregate(score_matrix, label_names) == {
+        "cat": pytest.approx(1.6 / 3),
+        "whiskers": pytest.approx(0.2),
+    }
+
+
+def test_is_decision_settled():
+    # cat scored 0.9 in the first 2 of 4 frames: at least 0.45 whatever the rest do
+    score_matrix = np.array([[0.1, 0.9, 0.0], [0.1, 0.9, 0.0]])
+    assert is_decision_settled(score_matrix, LABEL_NAMES, 4, ["cat"], 0.4)
+    # ...but it could still end up anywhere from 0.45 to 0.95
+    assert not is_decision_settled(score_matrix, LABEL_NAMES, 4, ["cat"], 0.5)
+    # dog hasn't shown up yet, it can only make 0.5 if the rest are all dog
+    assert not is_decision_settled(score_matrix, LABEL_NAMES, 4, ["dog"], 0.5)
+    assert is_decision_settled(score_matrix, LABEL_NAMES, 4, ["dog"], 0.6)
+    assert not is_decision_settled(
+        score_matrix, LABEL_NAMES, 4, ["cat", "dog"], 0.4, cutoffs={"dog": 0.5}
+    )
+    assert is_decision_settled(score_matrix, LABEL_NAMES, 4, ["horse"], 0.6)
+    # max: one frame over the cutoff is enough
+    assert is_decision_settled(score_matrix, LABEL_NAMES, 4, ["cat"], 0.5, "max")
+    # Nothing left to look at
+    assert is_decision_settled(score_matrix, LABEL_NAMES, 2, ["dog"], 0.01)
+    config = {
+        "STOP_LABELLING_WHEN_SETTLED": False,
+        "LABELS_TO_SEARCH_FOR": ["cat"],
+        "LABEL_SCORE_REDUCER": "mean",
+        "LABEL_SCORE_CUTOFFS": {},
+    }
+    assert get_settled_func_given_config(config, 0.4) is None
+    is_settled = get_settled_func_given_config(
+        {**config, "STOP_LABELLING_WHEN_SETTLED": True}, 0.4
+    )
+    assert is_settled(score_matrix, LABEL_NAMES, 4)
+    frames_used = aggregate_label_scores(score_matrix, LABEL_NAMES, 0.4).frames_used
+    assert frames_used == 2
+
+
+def test_is_near_cutoff():
+    score_matrix = np.array([[0.5, 0.45, 0.05], [0.5, 0.35, 0.0]])
+    # cat averaged 0.4
+    assert is_near_cutoff(score_matrix, LABEL_NAMES, ["cat"], 0.45, 0.1)
+    assert is_near_cutoff(score_matrix, LABEL_NAMES, ["cat"], 0.35, 0.1)
+    assert not is_near_cutoff(score_matrix, LABEL_NAMES, ["cat"], 0.2, 0.1)
+    assert not is_near_cutoff(score_matrix, LABEL_NAMES, ["cat"], 0.6, 0.1)
+    assert is_near_cutoff(score_matrix, LABEL_NAMES, ["cat", "dog"], 0.1, 0.1)
+    # Never seen counts as 0
+    assert is_near_cutoff(score_matrix, LABEL_NAMES, ["horse"], 0.05, 0.1)
+    assert not is_near_cutoff(np.zeros((0, 3)), LABEL_NAMES, ["cat"], 0.05, 0.1)
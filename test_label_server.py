@@ -0,0 +1,176 @@
+import os
+import threading
+import time
+from tempfile import TemporaryDirectory
+
+import numpy as np
+from PIL import Image
+
+import label_server
+from top_cat import get_labelling_funtion
+
+
+def start_test_server(
+    labelling_function, socket_path, idle_timeout_secs=5, config_fingerprint=None
+):
+    server_thread = threading.Thread(
+        target=label_server.serve,
+        args=(
+            labelling_function,
+            "test_model",
+            socket_path,
+            idle_timeout_secs,
+            config_fingerprint,
+        ),
+        daemon=True,
+    )
+    server_thread.start()
+    while not os.path.exists(socket_path):
+        time.sleep(0.01)
+    return server_thread
+
+
+def test_label_server():
+    batches_seen = []
+
+    def labelling_function(frames):
+        raise AssertionError("Should be labelled through label_many")
+
+    def label_many(frames_per_post):
+        batches_seen.append(frames_per_post)
+        return [
+            (
+                {
+                    "cat": float(np.mean([frame[..., 0].mean() for frame in frames]))
+                    / 255
+                }
+                # Stands in for a post the model couldn't label
+                if len(frames)
+                else None
+            )
+            for frames in frames_per_post
+        ]
+
+    labelling_function.label_many = label_many
+    labelling_function.accepts_numpy_batch = True
+    temp_dir = TemporaryDirectory()
+    socket_path = temp_dir.name + "/label_server.sock"
+    config = {
+        "USE_LABEL_SERVER": True,
+        "LABEL_SERVER_SOCKET": socket_path,
+        "MODEL_TO_USE": "test_model",
+        "LABELS_TO_SEARCH_FOR": ["cat"],
+        "LABEL_SERVER_TIMEOUT_SECS": 5,
+    }
+    start_test_server(
+        labelling_function,
+        socket_path,
+        config_fingerprint=label_server.get_labelling_config_fingerprint(config),
+    )
+    assert label_server.ping(socket_path)["model"] == "test_model"
+    server_labelling_function = get_labelling_funtion(config)
+    red = np.zeros((4, 6, 3), dtype=np.uint8)
+    red[..., 0] = 255
+    assert server_labelling_function.label_many(
+        [np.stack([red, red]), [np.zeros((2, 2, 3), dtype=np.uint8)]]
+    ) == [{"cat": 1.0}, {"cat": 0.0}]
+    assert server_labelling_function(red[np.newaxis]) == {"cat": 1.0}
+    assert server_labelling_function.label_many([red[np.newaxis], []]) == [
+        {"cat": 1.0},
+        None,
+    ]
+    # Frames made it over intact
+    assert np.array_equal(batches_seen[0][0][1], red)
+
+    # Different model or labelling settings -> don't use the server
+    assert (
+        label_server.get_labelling_func_from_server(
+            {**config, "MODEL_TO_USE": "another_model"}
+        )
+        is None
+    )
+    assert (
+        label_server.get_labelling_func_from_server(
+            {**config, "LABELS_TO_SEARCH_FOR": ["cat", "dog"]}
+        )
+        is None
+    )
+    # ...but settings that only change how it's run are fine
+    assert label_server.get_labelling_func_from_server(
+        {**config, "LABEL_SERVER_IDLE_TIMEOUT_SECS": 1}
+    )
+    # Errors get passed back
+    labelling_function.label_many = None
+    try:
+        server_labelling_function(red[np.newaxis])
+        assert False, "Should have raised"
+    except RuntimeError as e:
+        assert "Label server failed" in str(e)
+
+
+def test_label_server_fallback():
+    def slow_labelling_function(frames):
+        time.sleep(1)
+        return {"cat": 1.0}
+
+    fallback_frames = []
+    closed = []
+
+    # Only takes PIL images
+    def fallback(frames):
+        fallback_frames.extend(frames)
+        return {"dog": 1.0}
+
+    fallback.close = lambda: closed.append(True)
+    temp_dir = TemporaryDirectory()
+    frames = [np.zeros((2, 2, 3), dtype=np.uint8)]
+    for labelling_function, idle_timeout_secs in [
+        # Hangs
+        (slow_labelling_function, 5),
+        # Goes away partway through
+        (lambda frames: {"cat": 1.0}, 0.3),
+    ]:
+        socket_path = temp_dir.name + f"/label_server{idle_timeout_secs}.sock"
+        config = {
+            "LABEL_SERVER_SOCKET": socket_path,
+            "MODEL_TO_USE": "test_model",
+            "LABEL_SERVER_TIMEOUT_SECS": 0.2,
+        }
+        server_thread = start_test_server(
+            labelling_function,
+            socket_path,
+            idle_timeout_secs,
+            label_server.get_labelling_config_fingerprint(config),
+        )
+        server_labelling_function = label_server.get_labelling_func_from_server(
+            config, fallback
+        )
+        if idle_timeout_secs < 1:
+            assert server_labelling_function(frames) == {"cat": 1.0}
+            server_thread.join(timeout=5)
+        assert server_labelling_function(frames) == {"dog": 1.0}
+        # ...and it sticks with the fallback from then on
+        assert server_labelling_function.label_many([frames, frames]) == [
+            {"dog": 1.0},
+            {"dog": 1.0},
+        ]
+        assert len(fallback_frames) == 3 and isinstance(fallback_frames[0], Image.Image)
+        fallback_frames.clear()
+        server_labelling_function.close()
+    assert closed == [True, True]
+
+
+def test_label_server_idle_timeout():
+    temp_dir = TemporaryDirectory()
+    socket_path = temp_dir.name + "/label_server.sock"
+    server_thread = start_test_server(lambda frames: {}, socket_path, 0.2)
+    assert label_server.ping(socket_path) is not None
+    server_thread.join(timeout=5)
+    assert not server_thread.is_alive() and not os.path.exists(socket_path)
+    # No server, no labelling function
+    assert (
+        label_server.get_labelling_func_from_server(
+            {"LABEL_SERVER_SOCKET": socket_path, "MODEL_TO_USE": "test_model"}
+        )
+        is None
+    )
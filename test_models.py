@@ -1,6 +1,10 @@
 import glob
+import io
 import sys
+import tarfile
+from tempfile import NamedTemporaryFile, TemporaryDirectory
 
+import numpy as np
 import pytest
 
 from top_cat import add_labels_for_image_to_post_d, get_config, get_labelling_funtion
@@ -50,3 +54,236 @@ def test_deeplab(model_to_use):
 
     post_dicts = get_posts_including_labels_and_correctness(labelling_function, config)
     assert all([p["correct_label"] for p in post_dicts])
+
+
+@pytest.mark.slow
+def test_deeplab_cascade():
+    "The quick first pass shouldn't cost us any correct labels"
+    config = get_config()
+    config["MODEL_TO_USE"] = "deeplab"
+    config["DEEPLAB_CASCADE"] = True
+    config["DEEPLAB_WORKER_PROCS"] = 0
+    labelling_function = get_labelling_funtion(config)
+
+    post_dicts = get_posts_including_labels_and_correctness(labelling_function, config)
+    assert all([p["correct_label"] for p in post_dicts])
+    assert set(p["labelling_tier"] for p in post_dicts) <= {"coarse", "full"}
+
+
+def make_tiny_deeplab_tarball(batch_dim):
+    "A stand in frozen graph: pixels with a bright red channel are cats, the rest is background"
+    import tensorflow as tf
+
+    graph = tf.Graph()
+    with graph.as_default():
+        image = tf.compat.v1.placeholder(
+            tf.uint8, [batch_dim, None, None, 3], name="ImageTensor"
+        )
+        tf.identity(
+            tf.cast(image[..., 0] > 127, tf.int64) * 8, name="SemanticPredictions"
+        )
+    graph_bytes = graph.as_graph_def().SerializeToString()
+    tarball = NamedTemporaryFile(suffix=".tar.gz")
+    with tarfile.open(tarball.name, "w:gz") as tar_file:
+        tar_info = tarfile.TarInfo("tiny_model/frozen_inference_graph.pb")
+        tar_info.size = len(graph_bytes)
+        tar_file.addfile(tar_info, io.BytesIO(graph_bytes))
+    return tarball
+
+
+# Batched or not (the stock tarballs only take one image at a time), same seg maps
+@pytest.mark.parametrize("batch_dim", [None, 1])
+def test_deeplab_run_batch(batch_dim):
+    from deeplab import DeepLabModel, get_labels_for_posts_deeplab
+
+    tarball = make_tiny_deeplab_tarball(batch_dim)
+    model = DeepLabModel(tarball.name)
+    assert model.max_batch_size == batch_dim
+    # Left half is a cat
+    tall = np.zeros((1026, 400, 3), dtype=np.uint8)
+    tall[:, :200, 0] = 255
+    wide = np.zeros((100, 300, 3), dtype=np.uint8)
+    frames = [tall, wide, tall]
+    seg_maps = model.run_batch(frames, batch_size=8)
+    assert [seg_map.shape for seg_map in seg_maps] == [
+        (513, 200),
+        (171, 513),
+        (513, 200),
+    ]
+    assert all(
+        np.array_equal(seg_map, model.run(frame)[1])
+        for frame, seg_map in zip(frames, seg_maps)
+    )
+    # Frames from different posts can share a batch but still get labelled separately
+    cat_post, background_post = get_labels_for_posts_deeplab(
+        model, [np.stack([tall, tall]), [wide]], batch_size=8
+    )
+    assert cat_post == {"cat": 0.5, "background": 0.5}
+    assert background_post == {"background": 1.0}
+
+
+def test_deeplab_stops_when_settled():
+    import functools
+
+    from deeplab import DeepLabModel, get_labels_for_posts_deeplab
+    from label_aggregation import is_decision_settled
+
+    tarball = make_tiny_deeplab_tarball(None)
+    model = DeepLabModel(tarball.name)
+    half_cat = np.zeros((50, 60, 3), dtype=np.uint8)
+    half_cat[:, :30, 0] = 255
+    no_cat = np.zeros((50, 60, 3), dtype=np.uint8)
+    frames_per_post = [np.stack([half_cat] * 10), np.stack([no_cat] * 4)]
+    is_settled = functools.partial(
+        is_decision_settled, labels_to_settle=["cat"], default_cutoff=0.05
+    )
+    cat_post, no_cat_post = get_labels_for_posts_deeplab(
+        model, frames_per_post, batch_size=2, is_settled=is_settled
+    )
+    # One frame at half cat is already 0.5 / 10 frames = 0.05, no way to drop under the cutoff after that
+    assert cat_post == {
+        "cat": pytest.approx(0.5, abs=0.01),
+        "background": pytest.approx(0.5, abs=0.01),
+    }
+    assert cat_post.frames_used == 1
+    # A frame with no cat can't rule out the rest being cats, so we need all of them
+    assert no_cat_post == {"background": 1.0}
+    assert no_cat_post.frames_used == 4
+    # Same labels as looking at every frame
+    for settled_labels, labels in zip(
+        [cat_post, no_cat_post],
+        get_labels_for_posts_deeplab(model, frames_per_post, batch_size=2),
+    ):
+        assert settled_labels == pytest.approx(labels)
+
+
+def count_frames_run(model):
+    "How many frames each model.run_batch call gets from now on"
+    frames_seen = []
+    run_batch = model.run_batch
+
+    def counting_run_batch(frames, *args):
+        frames_seen.append(len(frames))
+        return run_batch(frames, *args)
+
+    model.run_batch = counting_run_batch
+    return frames_seen
+
+
+def test_deeplab_near_duplicate_frames():
+    import functools
+
+    from deeplab import DeepLabModel, get_labels_for_posts_deeplab
+    from frame_dedup import dedupe_frames
+    from label_aggregation import is_decision_settled
+
+    tarball = make_tiny_deeplab_tarball(None)
+    model = DeepLabModel(tarball.name)
+    frames_seen = count_frames_run(model)
+    cat = np.zeros((50, 60, 3), dtype=np.uint8)
+    cat[..., 0] = 255
+    no_cat = np.zeros((50, 60, 3), dtype=np.uint8)
+    frames_per_post = [np.stack([cat, cat, cat, no_cat])]
+    dedupe = functools.partial(dedupe_frames, max_distance=0)
+    # The 3 cat frames get run once but still count 3 times
+    (labels,) = get_labels_for_posts_deeplab(model, frames_per_post, 8, dedupe=dedupe)
+    assert labels == {"cat": 0.75, "background": 0.25} and labels.frames_used == 4
+    assert frames_seen == [2]
+    assert get_labels_for_posts_deeplab(model, frames_per_post, 8) == [labels]
+    assert frames_seen == [2, 4]
+    # Same when stopping early: the first (cat) frame covers 3 of the 4 frames
+    is_settled = functools.partial(
+        is_decision_settled, labels_to_settle=["cat"], default_cutoff=0.5
+    )
+    (labels,) = get_labels_for_posts_deeplab(
+        model, frames_per_post, 1, is_settled=is_settled, dedupe=dedupe
+    )
+    assert labels == {"cat": 1.0} and labels.frames_used == 3
+    assert frames_seen == [2, 4, 1]
+
+
+def test_deeplab_cascade_tiers():
+    import functools
+
+    from deeplab import DeepLabCascade, DeepLabModel, get_labels_for_posts_deeplab
+    from label_aggregation import is_near_cutoff
+
+    tarball = make_tiny_deeplab_tarball(None)
+    model = DeepLabModel(tarball.name)
+    frames_seen = count_frames_run(model)
+    half_cat = np.zeros((100, 100, 3), dtype=np.uint8)
+    half_cat[:, :50, 0] = 255
+    # 6% cat, close to the 5% cutoff
+    bit_of_cat = np.zeros((100, 100, 3), dtype=np.uint8)
+    bit_of_cat[:, :6, 0] = 255
+    no_cat = np.zeros((100, 100, 3), dtype=np.uint8)
+    cascade = DeepLabCascade(
+        model,
+        50,
+        functools.partial(
+            is_near_cutoff, labels_to_check=["cat"], default_cutoff=0.05, margin=0.03
+        ),
+    )
+    labels = get_labels_for_posts_deeplab(
+        model, [[half_cat], [bit_of_cat, bit_of_cat], [no_cat]], 8, cascade=cascade
+    )
+    assert [post_labels.tier for post_labels in labels] == ["coarse", "full", "coarse"]
+    assert labels[0]["cat"] == 0.5 and labels[1]["cat"] == pytest.approx(
+        0.06, abs=0.005
+    )
+    assert "cat" not in labels[2]
+    # Everything once at 50px, then just the close one at full size
+    assert frames_seen == [4, 2]
+    # The close one got the same labels it would have without the cascade
+    assert (
+        labels[1]
+        == get_labels_for_posts_deeplab(model, [[bit_of_cat, bit_of_cat]], 8)[0]
+    )
+
+
+def test_labeller_input_sizes_match_models():
+    import deeplab
+    import gvision_labeler
+
+    assert get_config("/dev/null")["LABELLER_INPUT_SIZES"] == {
+        "deeplab": deeplab.INPUT_SIZE,
+        "gvision_labeler": gvision_labeler.INPUT_SIZE,
+    }
+
+
+def test_deeplab_worker_pool():
+    from deeplab import DeepLabModel, DeepLabWorkerPool, get_labels_for_posts_deeplab
+
+    tarball = make_tiny_deeplab_tarball(1)
+    tall = np.zeros((1026, 400, 3), dtype=np.uint8)
+    tall[:, :200, 0] = 255
+    wide = np.zeros((100, 300, 3), dtype=np.uint8)
+    frames_per_post = [np.stack([tall, tall, tall]), [wide], [wide, tall]]
+    pool = DeepLabWorkerPool(tarball.name, procs=2, intra_op_threads=1, batch_size=2)
+    try:
+        assert pool.label_many(frames_per_post) == get_labels_for_posts_deeplab(
+            DeepLabModel(tarball.name), frames_per_post
+        )
+    finally:
+        pool.close()
+
+
+def test_deeplab_graph_cache(monkeypatch):
+    import deeplab
+
+    tarball = make_tiny_deeplab_tarball(None)
+    graph_cache_dir = TemporaryDirectory()
+    frame = np.zeros((10, 20, 3), dtype=np.uint8)
+    seg_map = deeplab.DeepLabModel(tarball.name, graph_cache_dir.name).run(frame)[1]
+    [cached_graph] = glob.glob(graph_cache_dir.name + "/*.pb")
+    # Later runs don't need the tarball opened at all
+    monkeypatch.setattr(deeplab.tarfile, "open", None)
+    model = deeplab.DeepLabModel(tarball.name, graph_cache_dir.name)
+    assert np.array_equal(model.run(frame)[1], seg_map)
+    # A different tarball at the same path gets its own graph
+    monkeypatch.undo()
+    other_tarball = make_tiny_deeplab_tarball(1)
+    with open(tarball.name, "wb") as f:
+        f.write(open(other_tarball.name, "rb").read())
+    assert deeplab.DeepLabModel(tarball.name, graph_cache_dir.name).max_batch_size == 1
+    assert len(glob.glob(graph_cache_dir.name + "/*.pb")) == 2
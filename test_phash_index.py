@@ -0,0 +1,110 @@
+import random
+from tempfile import TemporaryDirectory
+
+import numpy as np
+from PIL import Image
+
+from phash_index import (
+    BKTree,
+    PhashIndex,
+    get_post_phash,
+    phash_distance,
+    phashes_look_alike,
+)
+
+
+def test_bk_tree_matches_brute_force():
+    rng = random.Random(0)
+    phashes = [
+        f"{rng.getrandbits(64):016x}{rng.choice(['808080', '828080', 'ff0000'])}"
+        for _ in range(2000)
+    ]
+    # Some near copies too, and some with the same dHash but another colour
+    phashes += [
+        f"{int(phash[:16], 16) ^ (1 << rng.randrange(64)):016x}" + phash[16:]
+        for phash in phashes[:200]
+    ]
+    phashes += [phash[:16] + "00ff00" for phash in phashes[:100]]
+    tree = BKTree()
+    for post_id, phash in enumerate(phashes):
+        tree.add(phash, post_id)
+    tree.add(phashes[0], 99999)
+    assert tree.size == len(phashes) + 1
+    for query in phashes[:50] + phashes[-50:] + phashes[1000:1050]:
+        for max_distance in [0, 3, 10]:
+            brute_force = sorted(
+                (phash_distance(query, phash), post_id)
+                for post_id, phash in enumerate(phashes)
+                if phashes_look_alike(query, phash, max_distance)
+            )
+            found = tree.find(query, max_distance)
+            assert [post_id for _, post_id in found if post_id != 99999] == [
+                post_id for _, post_id in brute_force
+            ]
+    assert (0, 99999) in tree.find(phashes[0], 0)
+    assert BKTree().find(phashes[0], 64) == []
+
+
+def test_post_phash_survives_resizing():
+    cat = Image.open("imgs/cat/cat_with_a_hat.jpg").convert("RGB")
+    small_cat = cat.resize((cat.width // 3, cat.height // 3))
+    galaxy = Image.open("imgs/galaxy/m31_antonis_960.jpg").convert("RGB")
+    assert len(get_post_phash([cat])) == 22
+    assert phashes_look_alike(get_post_phash([cat]), get_post_phash([small_cat]), 3)
+    assert phash_distance(get_post_phash([cat]), get_post_phash([galaxy])) > 10
+    # Same shapes in other colours don't count
+    blue_cat = Image.fromarray(np.asarray(cat)[..., ::-1])
+    assert phash_distance(get_post_phash([cat]), get_post_phash([blue_cat])) <= 3
+    assert not phashes_look_alike(get_post_phash([cat]), get_post_phash([blue_cat]), 3)
+    # Videos get the mean of their frames hashed
+    frames = np.stack([np.asarray(cat)] * 3)
+    assert get_post_phash(frames) == get_post_phash([cat])
+    assert get_post_phash([]) is None
+
+
+def test_post_phash_of_other_image_modes():
+    cat = Image.open("imgs/cat/cat_with_a_hat.jpg").convert("RGB")
+    cat_phash = get_post_phash([cat])
+    # Alpha gets dropped
+    assert get_post_phash([cat.convert("RGBA")]) == cat_phash
+    gray_phash = get_post_phash([cat.convert("L")])
+    assert len(gray_phash) == 22 and gray_phash[16:18] * 3 == gray_phash[16:]
+    assert get_post_phash([np.asarray(cat.convert("L"))]) == gray_phash
+    palette_phash = get_post_phash([cat.convert("P")])
+    assert len(palette_phash) == 22
+    assert phash_distance(cat_phash, palette_phash) <= 3
+
+
+def test_post_phash_skips_flat_frames():
+    def make_frame(left, right):
+        frame = np.zeros((64, 64, 3), dtype=np.uint8)
+        frame[:, :32], frame[:, 32:] = left, right
+        return Image.fromarray(frame)
+
+    # These would all hash to 0000000000000000 (dHash only sees left to right brightening)
+    for frame in [
+        make_frame((0, 0, 0), (0, 0, 0)),
+        make_frame((255, 255, 255), (255, 255, 255)),
+        make_frame((255, 0, 0), (0, 0, 0)),
+        make_frame((0, 255, 0), (0, 0, 0)),
+        # ...or to ffffffffffffffff, or one edge and nothing else
+        make_frame((0, 0, 0), (0, 0, 255)),
+    ]:
+        assert get_post_phash([frame]) is None
+
+
+def test_phash_index_save_and_load():
+    temp_dir = TemporaryDirectory()
+    index_file = temp_dir.name + "/phash/index.pickle"
+    assert PhashIndex.load(index_file).last_post_id == 0
+    phash_index = PhashIndex()
+    phash_index.add("00000000000000ff808080", 3)
+    phash_index.add("00000000000000fe808080", 7)
+    phash_index.save(index_file)
+    loaded = PhashIndex.load(index_file)
+    assert loaded.last_post_id == 7
+    assert loaded.find("00000000000000ff808080", 1) == [(0, 3), (1, 7)]
+    # Junk gets thrown away
+    with open(index_file, "wb") as f:
+        f.write(b"not a pickle")
+    assert PhashIndex.load(index_file).tree.size == 0
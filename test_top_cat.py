@@ -1,29 +1,55 @@
 import hashlib
+import json
+import os
 import sqlite3
+import subprocess
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from tempfile import NamedTemporaryFile, TemporaryDirectory
+from urllib.parse import parse_qsl, urlparse
 
 import cv2
+import numpy as np
 import pytest
 import toml
 from PIL import Image
 
+from phash_index import PhashIndex
 from top_cat import (
     QUERIES,
     THIS_SCRIPT_DIR,
+    LazyLabellingFunction,
+    ResolvedUrlCache,
     add_image_content_to_post_d,
     add_labels_for_image_to_post_d,
     cast_to_pil_imgs,
+    cast_to_rgb_batch,
+    connect_to_db,
     extract_frames_from_im_or_video,
     fix_giphy_url,
     fix_imgur_url,
     fix_redd_url,
+    fix_url_in_dict_or_none,
     get_config,
+    get_known_posts_given_urls,
     get_labelling_funtion,
+    get_listing_fingerprint,
+    get_media_path,
     get_sha1_lowmemuse,
     guarantee_tables_exist,
+    iter_reddit_posts,
+    label_and_record_new_posts,
+    load_phash_index,
+    main,
     maybe_repost_to_social_media,
     populate_labels_in_db_for_posts,
     query_reddit_api,
+    read_frames,
+    resolve_post_urls,
+    select_media_url,
+    set_run_state,
     update_config_with_args,
 )
 
@@ -61,15 +87,53 @@ def test_guarantee_tables_exist():
             {
                 ("index", "post_label_post_id_index"),
                 ("index", "media_url_index"),
+                ("index", "post_reddit_id_index"),
+                ("index", "post_media_hash_index"),
                 ("index", "top_post_post_id_index"),
                 ("table", "post"),
                 ("table", "post_label"),
                 ("table", "top_post"),
+                ("table", "run_state"),
+                ("table", "post_reddit_id"),
+                ("index", "sqlite_autoindex_post_reddit_id_1"),
+                ("index", "sqlite_autoindex_run_state_1"),
             }
         )
     )
 
 
+def test_connect_to_db():
+    tempf = NamedTemporaryFile()
+    db_conn = connect_to_db({"DB_FILE": tempf.name, "DB_JOURNAL_MODE": "wal"})
+    assert db_conn.execute("PRAGMA journal_mode").fetchone() == ("wal",)
+    guarantee_tables_exist(db_conn)
+    reader_conn = sqlite3.connect(tempf.name, timeout=0)
+    # A reader in the middle of a read doesn't stop us writing and committing
+    reader_conn.execute("BEGIN")
+    assert reader_conn.execute("select count(*) from post").fetchone() == (0,)
+    post_id = QUERIES.record_post(
+        db_conn,
+        url="https://i.redd.it/a.jpg",
+        media_hash="a",
+        title="a",
+        reddit_id="t3_a",
+        orig_url=None,
+        frames_used=1,
+        model="test",
+        phash=None,
+        media_url=None,
+    )
+    assert post_id == 1
+    # ...and an open write transaction doesn't stop anyone reading
+    assert reader_conn.execute("select count(*) from post").fetchone() == (0,)
+    db_conn.commit()
+    reader_conn.rollback()
+    assert reader_conn.execute("select count(*) from post").fetchone() == (1,)
+    # "" leaves the db how it was
+    db_conn = connect_to_db({"DB_FILE": tempf.name, "DB_JOURNAL_MODE": ""})
+    assert db_conn.execute("PRAGMA journal_mode").fetchone() == ("wal",)
+
+
 @pytest.mark.net
 def test_fix_imgur_url_video():
     assert (
@@ -113,19 +177,357 @@ def test_fix_redd_url():
 #     pass
 
 
+class MediaHostStandIn(BaseHTTPRequestHandler):
+    "Pretends to be a media host. Anything under /missing 404s, everything else exists."
+
+    in_flight = 0
+    max_in_flight = 0
+    requests_seen = 0
+    lock = threading.Lock()
+
+    def do_HEAD(self):
+        with self.lock:
+            MediaHostStandIn.requests_seen += 1
+            MediaHostStandIn.in_flight += 1
+            MediaHostStandIn.max_in_flight = max(
+                MediaHostStandIn.max_in_flight, MediaHostStandIn.in_flight
+            )
+        time.sleep(0.05)
+        with self.lock:
+            MediaHostStandIn.in_flight -= 1
+        self.send_response(404 if self.path.startswith("/missing") else 200)
+        self.end_headers()
+
+    def do_GET(self):
+        "Serves files out of imgs/. Anything under /nolength doesn't say how big it is."
+        media_path = THIS_SCRIPT_DIR + self.path.replace("/nolength", "", 1)
+        if not os.path.isfile(media_path):
+            self.send_response(404)
+            self.end_headers()
+            return
+        media = open(media_path, "rb").read()
+        self.send_response(200)
+        if not self.path.startswith("/nolength"):
+            self.send_header("Content-Length", str(len(media)))
+        self.end_headers()
+        self.wfile.write(media)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def media_host_stand_in():
+    MediaHostStandIn.in_flight = MediaHostStandIn.max_in_flight = 0
+    MediaHostStandIn.requests_seen = 0
+    server = ThreadingHTTPServer(("127.0.0.1", 0), MediaHostStandIn)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+def test_resolve_post_urls(media_host_stand_in):
+    posts = [
+        {
+            "title": f"post {i}",
+            "url": f"{media_host_stand_in}/{'missing' if i % 3 == 0 else 'pic'}_{i}.jpg",
+            "orig_url": f"{media_host_stand_in}/pic_{i}.jpg",
+            "gfycat": None,
+        }
+        for i in range(12)
+    ]
+    config = {
+        "URL_RESOLVER_THREADS": 8,
+        "MAX_CONNECTIONS_PER_HOST": 2,
+        "URL_CACHE_FILE": "",
+        "SELECT_SMALLEST_USEFUL_MEDIA": False,
+        "VERBOSE": False,
+    }
+    resolved_posts = resolve_post_urls(posts, config)
+    # Broken urls are skipped, the rest keep their order
+    assert [p["title"] for p in resolved_posts] == [
+        f"post {i}" for i in range(12) if i % 3 != 0
+    ]
+    # Never hit the host with more than MAX_CONNECTIONS_PER_HOST requests at once
+    assert 1 <= MediaHostStandIn.max_in_flight <= 2
+
+
+def test_resolve_post_urls_with_url_cache(media_host_stand_in):
+    posts = [
+        {
+            "title": f"post {i}",
+            "url": f"{media_host_stand_in}/{'missing' if i == 0 else 'pic'}_{i}.jpg",
+            "orig_url": f"{media_host_stand_in}/pic_{i}.jpg",
+            "gfycat": None,
+        }
+        for i in range(4)
+    ]
+    tempf = NamedTemporaryFile()
+    config = {
+        "URL_RESOLVER_THREADS": 4,
+        "MAX_CONNECTIONS_PER_HOST": 4,
+        "URL_CACHE_FILE": tempf.name,
+        "URL_CACHE_TTL_HOURS": {"default": 24},
+        "URL_CACHE_FAILURE_TTL_HOURS": 1,
+        "SELECT_SMALLEST_USEFUL_MEDIA": False,
+        "VERBOSE": False,
+    }
+    first_run = resolve_post_urls(posts, config)
+    assert MediaHostStandIn.requests_seen == 4
+    # Second time around everything (including the failure) comes from the cache
+    second_run = resolve_post_urls(posts, config)
+    assert MediaHostStandIn.requests_seen == 4
+    assert first_run == second_run and [p["title"] for p in second_run] == [
+        "post 1",
+        "post 2",
+        "post 3",
+    ]
+    # Expired entries get looked up again
+    expired_tempf = NamedTemporaryFile()
+    config["URL_CACHE_FILE"] = expired_tempf.name
+    config["URL_CACHE_TTL_HOURS"] = {"default": 24, "127.0.0.1": -1}
+    config["URL_CACHE_FAILURE_TTL_HOURS"] = -1
+    resolve_post_urls(posts, config)
+    resolve_post_urls(posts, config)
+    assert MediaHostStandIn.requests_seen == 4 + 4 + 4
+    # Hosts without a TTL of their own are fine even if the table has no "default"
+    url_cache = ResolvedUrlCache(expired_tempf.name, {"imgur.com": 168}, 6)
+    assert url_cache.ttl_hours_for_url("https://i.imgur.com/a.jpg") == 168
+    assert url_cache.ttl_hours_for_url(f"{media_host_stand_in}/pic_1.jpg") == 24
+    url_cache.close()
+
+
 @pytest.mark.net
 def test_query_reddit_api():
     reddit_response_json = query_reddit_api(
-        {"MAX_REDDIT_API_ATTEMPTS": 10, "VERBOSE": False, "MAX_POSTS_TO_PROCESS": 10}
+        {
+            "MAX_REDDIT_API_ATTEMPTS": 10,
+            "VERBOSE": False,
+            "MAX_POSTS_TO_PROCESS": 10,
+            "SUBREDDITS": ["aww"],
+            "LISTING_SORTS": ["top"],
+        }
     )
     assert (
         type(reddit_response_json) == list
         and len(reddit_response_json) >= 1
         and reddit_response_json[0].keys()
-        == frozenset(["title", "url", "orig_url", "gfycat"])
+        == frozenset(["reddit_id", "title", "url", "orig_url", "gfycat", "previews"])
+    )
+
+
+class FakeResponse:
+    def __init__(self, status_code, json_body=None, headers=None, content=b""):
+        self.status_code = status_code
+        self.json_body = json_body
+        self.headers = headers or {}
+        self.content = content
+
+    def json(self):
+        return self.json_body
+
+
+def replay_example_listing(pages_fetched, etag=None):
+    """
+    Stands in for requests.get against the reddit api by serving up
+    example_reddit_api_curl.json page by page. Answers 304 if the ETag matches.
+    """
+    example_children = json.load(
+        open(THIS_SCRIPT_DIR + "/example_reddit_api_curl.json")
+    )["data"]["children"]
+    names = [c["data"]["name"] for c in example_children]
+
+    def fake_get(url, headers=None):
+        path, _, query = urlparse(url)[2:5]
+        params = dict(parse_qsl(query))
+        limit, after = int(params["limit"]), params.get("after")
+        pages_fetched.append((path, limit, after, (headers or {}).get("If-None-Match")))
+        if etag and (headers or {}).get("If-None-Match") == etag:
+            return FakeResponse(304)
+        start = names.index(after) + 1 if after else 0
+        children = example_children[start : start + limit]
+        more_left = start + limit < len(example_children)
+        return FakeResponse(
+            200,
+            {
+                "data": {
+                    "children": children,
+                    "after": children[-1]["data"]["name"] if more_left else None,
+                }
+            },
+            {"ETag": etag} if etag else {},
+        )
+
+    return fake_get
+
+
+def test_iter_reddit_posts(monkeypatch):
+    pages_fetched = []
+    monkeypatch.setattr("top_cat.requests.get", replay_example_listing(pages_fetched))
+    config = {
+        "MAX_POSTS_TO_PROCESS": 250,
+        "MAX_REDDIT_API_ATTEMPTS": 1,
+        "SUBREDDITS": ["aww"],
+        "LISTING_SORTS": ["top", "hot"],
+        "VERBOSE": False,
+    }
+    posts = iter_reddit_posts(config)
+    first_post = next(posts)
+    # We don't go fetching everything up front
+    assert len(pages_fetched) <= 2
+    assert [p["width"] for p in first_post.pop("previews")] == [108, 216, 320, 640, 720]
+    assert first_post == {
+        "reddit_id": "t3_hrz5lj",
+        "title": "Those little arms!!!",
+        "url": "https://v.redd.it/7gi1vwbn04b51",
+        "orig_url": "https://v.redd.it/7gi1vwbn04b51",
+        "gfycat": None,
+    }
+    rest_of_posts = list(posts)
+    # The example only has 100 posts and "hot" is the same as "top" so no dupes
+    assert len(rest_of_posts) == 99
+    assert pages_fetched == [
+        ("/r/aww/top.json", 100, None, None),
+        ("/r/aww/hot.json", 100, None, None),
+    ]
+
+
+def test_iter_reddit_posts_follows_after(monkeypatch):
+    pages_fetched = []
+    monkeypatch.setattr("top_cat.requests.get", replay_example_listing(pages_fetched))
+    monkeypatch.setattr("top_cat.REDDIT_MAX_PAGE_SIZE", 25)
+    config = {
+        "MAX_POSTS_TO_PROCESS": 60,
+        "MAX_REDDIT_API_ATTEMPTS": 1,
+        "SUBREDDITS": ["aww"],
+        "LISTING_SORTS": ["top"],
+        "VERBOSE": False,
+    }
+    posts = list(iter_reddit_posts(config))
+    assert len(posts) == 60 and len({p["reddit_id"] for p in posts}) == 60
+    assert [(limit, after is None) for _, limit, after, _ in pages_fetched] == [
+        (25, True),
+        (25, False),
+        (10, False),
+    ]
+
+
+def test_select_media_url_previews():
+    post = {
+        "url": "https://i.redd.it/tom097oyy2b51.jpg",
+        "previews": [
+            {
+                "url": "https://preview.redd.it/a.jpg?width=320&amp;s=1",
+                "width": 320,
+                "height": 426,
+            },
+            {
+                "url": "https://preview.redd.it/a.jpg?width=640&amp;s=2",
+                "width": 640,
+                "height": 853,
+            },
+            {"url": "https://preview.redd.it/a.jpg?s=3", "width": 720, "height": 960},
+        ],
+    }
+    # It's the longest side that matters
+    assert select_media_url(post, 400) == "https://preview.redd.it/a.jpg?width=320&s=1"
+    assert select_media_url(post, 513) == "https://preview.redd.it/a.jpg?width=640&s=2"
+    assert select_media_url(post, 900) == "https://preview.redd.it/a.jpg?s=3"
+    assert select_media_url(post, 2000) == "https://preview.redd.it/a.jpg?s=3"
+    assert select_media_url(post, None) == post["url"]
+
+
+def test_select_media_url_imgur():
+    post = {"url": "https://i.imgur.com/2cfU6dh.jpg"}
+    assert select_media_url(post, 513) == "https://i.imgur.com/2cfU6dhl.jpg"
+    assert select_media_url(post, 1000) == "https://i.imgur.com/2cfU6dhh.jpg"
+    assert select_media_url(post, 2000) == "https://i.imgur.com/2cfU6dh.jpg"
+    # Videos don't come in smaller sizes on imgur
+    assert select_media_url({"url": "https://i.imgur.com/zH3iA75.mp4"}, 513) == (
+        "https://i.imgur.com/zH3iA75.mp4"
     )
 
 
+def test_select_media_url_dash():
+    dash_playlist = b"""<?xml version="1.0" encoding="UTF-8"?>
+<MPD xmlns="urn:mpeg:dash:schema:mpd:2011"><Period>
+<AdaptationSet contentType="video">
+<Representation id="1" width="1280" height="720"><BaseURL>DASH_720.mp4</BaseURL></Representation>
+<Representation id="2" width="640" height="360"><BaseURL>DASH_360.mp4</BaseURL></Representation>
+<Representation id="3" width="426" height="240"><BaseURL>DASH_240.mp4</BaseURL></Representation>
+</AdaptationSet>
+<AdaptationSet contentType="audio">
+<Representation id="4"><BaseURL>DASH_audio.mp4</BaseURL></Representation>
+</AdaptationSet></Period></MPD>"""
+
+    class FakeSession:
+        playlists_fetched = 0
+
+        def get(self, url):
+            assert url == "https://v.redd.it/midbybt5fmh51/DASHPlaylist.mpd"
+            FakeSession.playlists_fetched += 1
+            return FakeResponse(200, content=dash_playlist)
+
+        def head(self, url):
+            return FakeResponse(200)
+
+    post = {"url": "https://v.redd.it/midbybt5fmh51/DASH_720.mp4"}
+    assert (
+        select_media_url(post, 513, FakeSession())
+        == "https://v.redd.it/midbybt5fmh51/DASH_360.mp4"
+    )
+    assert (
+        select_media_url(post, 1000, FakeSession())
+        == "https://v.redd.it/midbybt5fmh51/DASH_720.mp4"
+    )
+    # Fixing the url and picking the rendition share one fetch of the playlist
+    FakeSession.playlists_fetched = 0
+    post = fix_url_in_dict_or_none(
+        {"url": "https://v.redd.it/midbybt5fmh51", "gfycat": None},
+        FakeSession(),
+        input_size=513,
+    )
+    assert (post["url"], post["media_url"]) == (
+        "https://v.redd.it/midbybt5fmh51/DASH_720.mp4",
+        "https://v.redd.it/midbybt5fmh51/DASH_360.mp4",
+    )
+    assert FakeSession.playlists_fetched == 1
+
+
+def test_main_stops_early_for_unchanged_listing(monkeypatch):
+    pages_fetched = []
+    monkeypatch.setattr(
+        "top_cat.requests.get", replay_example_listing(pages_fetched, etag='"v1"')
+    )
+    db_file = NamedTemporaryFile()
+    config_file = NamedTemporaryFile()
+    open(config_file.name, "w").write(
+        f'DB_FILE = "{db_file.name}"\nMAX_POSTS_TO_PROCESS = 5\n'
+    )
+    monkeypatch.setattr("sys.argv", ["top_cat.py", "-c", config_file.name])
+
+    def get_labelling_funtion(config):
+        raise AssertionError("Shouldn't need to load a model for an unchanged listing")
+
+    monkeypatch.setattr("top_cat.get_labelling_funtion", get_labelling_funtion)
+    # Pretend the last run saw the same listing
+    config = get_config(config_file.name)
+    db_conn = sqlite3.connect(db_file.name)
+    guarantee_tables_exist(db_conn)
+    set_run_state(
+        db_conn,
+        "listing_fingerprint",
+        get_listing_fingerprint(query_reddit_api({**config, "VERBOSE": False}), config),
+    )
+    pages_fetched.clear()
+
+    main()
+    # Second time around reddit gets to tell us nothing changed
+    main()
+    assert [if_none_match for *_, if_none_match in pages_fetched] == [None, '"v1"']
+
+
 @pytest.mark.net
 def test_add_image_content_to_post_d():
     temp_dir = TemporaryDirectory()
@@ -135,13 +537,86 @@ def test_add_image_content_to_post_d():
         "orig_url": "https://i.redd.it/ld0ct5djqkh51.jpg",
         "gfycat": None,
     }
-    add_image_content_to_post_d(post, temp_dir)
+    add_image_content_to_post_d(post, temp_dir, get_config("/dev/null"))
     assert (
         post.get("media_file") is not None
         and post.get("media_hash") == "c241691625515c29b02a4a66f3c947ba71566168"
     )
 
 
+def test_add_image_content_to_post_d_in_memory(media_host_stand_in):
+    # The smaller rendition isn't there so it falls back on the full url
+    post = {
+        "url": f"{media_host_stand_in}/imgs/dog/ld0ct5djqkh51.jpg",
+        "media_url": f"{media_host_stand_in}/missing/ld0ct5djqkh51l.jpg",
+    }
+    config = {"MAX_MEDIA_BYTES": 10**6, "MEDIA_IN_MEMORY_MAX_BYTES": 10**6}
+    temp_dir = TemporaryDirectory()
+    add_image_content_to_post_d(post, temp_dir, config)
+    assert post["media_hash"] == "c241691625515c29b02a4a66f3c947ba71566168"
+    # media_hash is the hash of whatever media_url is
+    assert post["media_url"] == post["url"]
+    # Never touched the disk, but PIL can still read it
+    assert not os.listdir(temp_dir.name)
+    assert (
+        extract_frames_from_im_or_video(
+            post["media_file"], config, post["media_mime_type"]
+        )[0].size
+        == Image.open(THIS_SCRIPT_DIR + "/imgs/dog/ld0ct5djqkh51.jpg").size
+    )
+
+
+@pytest.mark.skipif(not hasattr(os, "memfd_create"), reason="memfd is linux only")
+def test_add_image_content_to_post_d_video_memfd(media_host_stand_in):
+    post = {"url": f"{media_host_stand_in}/imgs/cat/wzkv43qxa1c51.mp4"}
+    config = {
+        "MAX_MEDIA_BYTES": 10**7,
+        "MEDIA_IN_MEMORY_MAX_BYTES": 10**7,
+        "MAX_IMS_PER_VIDEO": 10,
+        "SEEK_MIN_FRAME_GAP": 250,
+    }
+    add_image_content_to_post_d(post, TemporaryDirectory(), config)
+    assert post["media_hash"] == get_sha1_lowmemuse(
+        THIS_SCRIPT_DIR + "/imgs/cat/wzkv43qxa1c51.mp4"
+    )
+    assert get_media_path(post["media_file"]).startswith("/proc/self/fd/")
+    frames = extract_frames_from_im_or_video(
+        post["media_file"], config, post["media_mime_type"]
+    )
+    assert len(frames) == 10
+
+
+@pytest.mark.parametrize("path_prefix", ["", "/nolength"])
+def test_add_image_content_to_post_d_too_big(media_host_stand_in, path_prefix):
+    post = {"url": f"{media_host_stand_in}{path_prefix}/imgs/cat/lit_cat.jpg"}
+    config = {"MAX_MEDIA_BYTES": 100000, "MEDIA_IN_MEMORY_MAX_BYTES": 100000}
+    with pytest.raises(Exception) as excinfo:
+        add_image_content_to_post_d(post, TemporaryDirectory(), config)
+    excinfo.match("too big")
+
+
+@pytest.mark.skipif(not hasattr(os, "memfd_create"), reason="memfd is linux only")
+def test_add_image_content_to_post_d_video_without_length(media_host_stand_in):
+    # Without a Content-Length it starts off in memory but moves to disk once it's too big for it
+    video_url = f"{media_host_stand_in}/nolength/imgs/cat/wzkv43qxa1c51.mp4"
+    post = {"url": video_url}
+    config = {"MAX_MEDIA_BYTES": 10**7, "MEDIA_IN_MEMORY_MAX_BYTES": 200000}
+    temp_dir = TemporaryDirectory()
+    add_image_content_to_post_d(post, temp_dir, config)
+    assert post["media_hash"] == get_sha1_lowmemuse(
+        THIS_SCRIPT_DIR + "/imgs/cat/wzkv43qxa1c51.mp4"
+    )
+    assert os.path.dirname(get_media_path(post["media_file"])) == temp_dir.name
+    post["media_file"].close()
+    # Too big for anything, and nothing gets left behind
+    with pytest.raises(Exception) as excinfo:
+        add_image_content_to_post_d(
+            {"url": video_url}, temp_dir, {**config, "MAX_MEDIA_BYTES": 300000}
+        )
+    excinfo.match("too big")
+    assert os.listdir(temp_dir.name) == []
+
+
 def test_get_sha1_lowmemuse():
     assert (
         get_sha1_lowmemuse(THIS_SCRIPT_DIR + "/imgs/dog/ld0ct5djqkh51.jpg")
@@ -162,7 +637,11 @@ def test_add_labels_for_image_to_post_d():
     def labelling_function(frames):
         return {"dog": 0.7}
 
-    add_labels_for_image_to_post_d(post, labelling_function, {"MAX_IMS_PER_VIDEO": 10})
+    add_labels_for_image_to_post_d(
+        post,
+        labelling_function,
+        {"MAX_IMS_PER_VIDEO": 10, "DECODE_AT_LABELLER_INPUT_SIZE": False},
+    )
     assert (
         post.get("labels") is not None
         and post.get("labels") == ["dog"]
@@ -171,10 +650,42 @@ def test_add_labels_for_image_to_post_d():
     )
 
 
-def test_extract_frames_from_im_or_video():
+def test_add_labels_for_image_to_post_d_numpy_batch():
+    post = {"media_file": THIS_SCRIPT_DIR + "/imgs/cat/wzkv43qxa1c51.mp4"}
+    frames_seen = []
+
+    def labelling_function(frames):
+        frames_seen.append(frames)
+        return {"cat": 0.9}
+
+    labelling_function.accepts_numpy_batch = True
+    add_labels_for_image_to_post_d(
+        post,
+        labelling_function,
+        {
+            "MAX_IMS_PER_VIDEO": 10,
+            "SEEK_MIN_FRAME_GAP": 250,
+            "DECODE_AT_LABELLER_INPUT_SIZE": False,
+        },
+    )
+    [frames] = frames_seen
+    assert (
+        isinstance(frames, np.ndarray)
+        and frames.dtype == np.uint8
+        and frames.shape[0] == 10
+        and frames.shape[3] == 3
+        and frames.flags["C_CONTIGUOUS"]
+        and post["labels"] == ["cat"]
+    )
+
+
+# Seeking or not, we should get exactly the same frames
+@pytest.mark.parametrize("seek_min_frame_gap", [250, 0])
+def test_extract_frames_from_im_or_video(seek_min_frame_gap):
     # Test currently relies on MAX_IMS_PER_VIDEO == 10
     frames = extract_frames_from_im_or_video(
-        THIS_SCRIPT_DIR + "/imgs/cat/wzkv43qxa1c51.mp4", {"MAX_IMS_PER_VIDEO": 10}
+        THIS_SCRIPT_DIR + "/imgs/cat/wzkv43qxa1c51.mp4",
+        {"MAX_IMS_PER_VIDEO": 10, "SEEK_MIN_FRAME_GAP": seek_min_frame_gap},
     )
     frame_hashes = tuple(hashlib.sha1(bytes(f)).hexdigest() for f in frames)
     assert frame_hashes == (
@@ -191,6 +702,56 @@ def test_extract_frames_from_im_or_video():
     )
 
 
+def test_extract_frames_from_im_or_video_at_size():
+    frames = extract_frames_from_im_or_video(
+        THIS_SCRIPT_DIR + "/imgs/cat/wzkv43qxa1c51.mp4",
+        {"MAX_IMS_PER_VIDEO": 10, "SEEK_MIN_FRAME_GAP": 250},
+        max_size=200,
+    )
+    assert len(frames) == 10 and all(max(f.shape[:2]) == 200 for f in frames)
+    # 4032x3024 jpeg gets decoded at 1/4 scale, still bigger than what we asked for
+    [im] = extract_frames_from_im_or_video(
+        THIS_SCRIPT_DIR + "/imgs/cat/lit_cat.jpg", {}, max_size=513
+    )
+    assert im.size == (756, 1008)
+    # Images that are already small enough are left alone
+    [im] = extract_frames_from_im_or_video(
+        THIS_SCRIPT_DIR + "/imgs/cat/cat_with_a_hat.jpg", {}, max_size=1000
+    )
+    assert im.size == (528, 960)
+
+
+def test_read_frames_bad_seek():
+    class UnseekableCapture:
+        "Pretends to be a cv2.VideoCapture whose seeks land a few frames early"
+
+        def __init__(self):
+            self.frame_id = self.claimed_frame_id = 0
+
+        def set(self, prop, frame_id):
+            # Real captures say they're wherever we told them to go
+            self.frame_id, self.claimed_frame_id = frame_id - 3, frame_id
+            return True
+
+        def get(self, prop):
+            return {
+                cv2.CAP_PROP_FPS: 25,
+                cv2.CAP_PROP_POS_FRAMES: self.claimed_frame_id,
+                cv2.CAP_PROP_POS_MSEC: (self.frame_id - 1) * 1000 / 25,
+            }[prop]
+
+        def grab(self):
+            self.frame_id += 1
+            return True
+
+        def read(self):
+            self.frame_id += 1
+            return True, self.frame_id - 1
+
+    assert read_frames(UnseekableCapture(), [0, 100, 200], 50) is None
+    assert read_frames(UnseekableCapture(), [0, 100, 200], None) == [0, 100, 200]
+
+
 def test_cast_to_pil_imgs_from_pil():
     pil_im = Image.open(THIS_SCRIPT_DIR + "/imgs/cat/cat_with_a_hat.jpg")
     assert [pil_im] == cast_to_pil_imgs(pil_im) and [pil_im] == cast_to_pil_imgs(
@@ -208,10 +769,29 @@ def test_cast_to_pil_imgs_from_cv2():
     )
 
 
+def test_cast_to_rgb_batch():
+    cv2_im = cv2.imread(THIS_SCRIPT_DIR + "/imgs/cat/cat_with_a_hat.jpg")
+    pil_im = Image.open(THIS_SCRIPT_DIR + "/imgs/cat/cat_with_a_hat.jpg")
+    # Same pixels as going through PIL the old way
+    [from_pil_list] = cast_to_pil_imgs([cv2_im, cv2_im])[:1]
+    batch = cast_to_rgb_batch([cv2_im, cv2_im])
+    assert batch.shape == (2, 960, 528, 3) and batch.dtype == np.uint8
+    assert np.array_equal(batch[0], np.asarray(from_pil_list)) and np.array_equal(
+        batch[0], batch[1]
+    )
+    # A single PIL image just gets a batch axis
+    assert np.array_equal(cast_to_rgb_batch(pil_im)[0], np.asarray(pil_im))
+    # Odd sized frames get resized to match the first one
+    small = cv2.resize(cv2_im, (264, 480))
+    assert cast_to_rgb_batch([cv2_im, small]).shape == (2, 960, 528, 3)
+    assert cast_to_rgb_batch([]).shape[0] == 0
+
+
 def test_populate_labels_in_db_for_posts():
     # Set up variables to pass
     reddit_response_json = [
         {
+            "reddit_id": "t3_ld0ct5",
             "title": "this is a test",
             "url": "https://i.redd.it/ld0ct5djqkh51.jpg",
             "orig_url": "https://i.redd.it/ld0ct5djqkh51.jpg",
@@ -227,7 +807,17 @@ def test_populate_labels_in_db_for_posts():
     temp_dir = TemporaryDirectory()
     tempf = NamedTemporaryFile()
     db_conn = sqlite3.connect(tempf.name)
-    config = {"VERBOSE": False, "MODEL_TO_USE": "test"}
+    config = {
+        "VERBOSE": False,
+        "MODEL_TO_USE": "test",
+        "DECODE_AT_LABELLER_INPUT_SIZE": False,
+        "POSTS_PER_LABELLING_BATCH": 4,
+        "DOWNLOAD_THREADS": 2,
+        "DECODE_THREADS": 2,
+        "PIPELINE_QUEUE_SIZE": 4,
+        "REUSE_LABELS_FOR_SAME_MEDIA": True,
+        "REPOST_PHASH_MAX_DISTANCE": -1,
+    }
     # set up the tables in the db
     guarantee_tables_exist(db_conn)
     # Run the function
@@ -235,8 +825,640 @@ def test_populate_labels_in_db_for_posts():
         reddit_response_json, labelling_function, temp_dir, db_conn, config
     )
     # check that the labels found their way into the db
-    labels_in_db = QUERIES.get_labels_and_scores_for_post(db_conn, 1)
+    labels_in_db = QUERIES.get_labels_and_scores_for_post_and_model(
+        db_conn, post_id=1, model="test"
+    )
     assert labels_in_db == [("dog", 0.7)]
+    # ...and got committed
+    assert not db_conn.in_transaction
+    assert QUERIES.get_labels_and_scores_for_post_and_model(
+        sqlite3.connect(tempf.name), post_id=1, model="test"
+    ) == [("dog", 0.7)]
+
+
+def test_populate_labels_in_db_for_posts_skips_known_reddit_ids():
+    tempf = NamedTemporaryFile()
+    db_conn = sqlite3.connect(tempf.name)
+    guarantee_tables_exist(db_conn)
+    QUERIES.record_post(
+        db_conn,
+        url="https://i.redd.it/ld0ct5djqkh51.jpg",
+        media_hash="c241691625515c29b02a4a66f3c947ba71566168",
+        title="this is a test",
+        reddit_id="t3_ld0ct5",
+        orig_url="https://imgur.com/ld0ct5djqkh51",
+        frames_used=1,
+        model="test",
+        phash=None,
+        media_url=None,
+    )
+    QUERIES.record_post_labels(
+        db_conn, [dict(post_id=1, label="dog", score=0.7, model="test")]
+    )
+
+    def labelling_function(frames):
+        raise AssertionError("Known posts shouldn't get labelled again")
+
+    # The raw url would need resolving (ie http calls) if we didn't know the reddit id
+    reddit_response_json = [
+        {
+            "reddit_id": "t3_ld0ct5",
+            "title": "this is a test",
+            "url": "https://imgur.com/ld0ct5djqkh51",
+            "orig_url": "https://imgur.com/ld0ct5djqkh51",
+            "gfycat": None,
+        }
+    ]
+    posts = populate_labels_in_db_for_posts(
+        reddit_response_json,
+        labelling_function,
+        TemporaryDirectory(),
+        db_conn,
+        {"VERBOSE": False, "MODEL_TO_USE": "test"},
+    )
+    assert len(posts) == 1 and (
+        posts[0]["post_id"],
+        posts[0]["url"],
+        tuple(posts[0]["labels"]),
+    ) == (1, "https://i.redd.it/ld0ct5djqkh51.jpg", ("dog",))
+
+
+def test_populate_labels_in_db_for_posts_looks_up_listing_in_one_go():
+    tempf = NamedTemporaryFile()
+    db_conn = sqlite3.connect(tempf.name)
+    guarantee_tables_exist(db_conn)
+    for post_id, reddit_id in enumerate(["t3_a", "t3_b", "t3_c", None], 1):
+        QUERIES.record_post(
+            db_conn,
+            url=f"https://i.redd.it/{post_id}.jpg",
+            media_hash=f"hash{post_id}",
+            title="old",
+            reddit_id=reddit_id,
+            orig_url=None,
+            frames_used=1,
+            model="test",
+            phash=None,
+            media_url=None,
+        )
+    for label, score in [("cat", 0.2), ("dog", 0.6)]:
+        QUERIES.record_post_labels(
+            db_conn, [dict(post_id=1, label=label, score=score, model="test")]
+        )
+    QUERIES.record_post_labels(
+        db_conn, [dict(post_id=3, label="cat", score=0.9, model="test")]
+    )
+    db_conn.execute(
+        "UPDATE post_label SET ts_del = current_timestamp WHERE post_id = 3"
+    )
+    db_conn.commit()
+
+    def labelling_function(frames):
+        raise AssertionError("Known posts shouldn't get labelled again")
+
+    reddit_posts = [
+        {"reddit_id": reddit_id, "title": reddit_id, "url": url, "orig_url": url}
+        for reddit_id, url in [
+            ("t3_a", "https://i.redd.it/1.jpg"),
+            ("t3_b", "https://i.redd.it/2.jpg"),
+            ("t3_c", "https://i.redd.it/3.jpg"),
+            # From before we tracked reddit ids
+            ("t3_d", "https://i.redd.it/4.jpg"),
+        ]
+    ]
+    # Pretend the urls are already fixed
+    for post in reddit_posts[3:]:
+        post["media_file"] = THIS_SCRIPT_DIR + "/imgs/cat/cat_with_a_hat.jpg"
+    queries = []
+    db_conn.set_trace_callback(queries.append)
+    posts = populate_labels_in_db_for_posts(
+        iter(reddit_posts),
+        labelling_function,
+        TemporaryDirectory(),
+        db_conn,
+        {"VERBOSE": False, "MODEL_TO_USE": "test"},
+    )
+    db_conn.set_trace_callback(None)
+    assert [(p["post_id"], list(p["labels"]), list(p["scores"])) for p in posts] == [
+        (1, ["dog", "cat"], [0.6, 0.2]),
+        (2, ["background"], [1.0]),
+        (3, ["background"], [1.0]),
+        (4, ["background"], [1.0]),
+    ]
+    # One lookup by reddit id for the whole listing, one by url for the rest
+    assert len([q for q in queries if q.lstrip().startswith(("SELECT", "WITH"))]) == 2
+    ((_, post_id, *_),) = QUERIES.get_posts_and_labels_given_reddit_ids(
+        db_conn, reddit_ids=json.dumps(["t3_d"])
+    )
+    assert post_id == 4
+
+
+def test_populate_labels_in_db_for_posts_crossposts(monkeypatch):
+    tempf = NamedTemporaryFile()
+    db_conn = sqlite3.connect(tempf.name)
+    guarantee_tables_exist(db_conn)
+    QUERIES.record_post(
+        db_conn,
+        url="https://i.redd.it/1.jpg",
+        media_hash="hash1",
+        title="old",
+        reddit_id="t3_a",
+        orig_url="https://i.redd.it/1.jpg",
+        frames_used=1,
+        model="test",
+        phash=None,
+        media_url=None,
+    )
+    db_conn.commit()
+    resolved = []
+
+    def resolve_post_urls(posts, config):
+        resolved.extend(p["reddit_id"] for p in posts)
+        return [{**p, "media_url": p["url"]} for p in posts]
+
+    monkeypatch.setattr("top_cat.resolve_post_urls", resolve_post_urls)
+
+    def labelling_function(frames):
+        raise AssertionError("Known posts shouldn't get labelled again")
+
+    # The same picture crossposted somewhere else
+    reddit_posts = [
+        {"reddit_id": reddit_id, "title": reddit_id, "url": url, "orig_url": url}
+        for reddit_id, url in [
+            ("t3_a", "https://i.redd.it/1.jpg"),
+            ("t3_x", "https://i.redd.it/1.jpg"),
+        ]
+    ]
+    for _ in range(2):
+        posts = populate_labels_in_db_for_posts(
+            [dict(p) for p in reddit_posts],
+            labelling_function,
+            TemporaryDirectory(),
+            db_conn,
+            {"VERBOSE": False, "MODEL_TO_USE": "test"},
+        )
+        assert [p["post_id"] for p in posts] == [1, 1]
+    # Only needed resolving the first time. t3_a keeps its reddit id
+    assert resolved == ["t3_x"]
+    assert db_conn.execute("SELECT reddit_id FROM post").fetchall() == [("t3_a",)]
+
+
+def test_populate_labels_in_db_for_posts_in_batches():
+    def make_post(reddit_id, media_file):
+        return {
+            "reddit_id": reddit_id,
+            "title": reddit_id,
+            "url": "https://i.redd.it/" + media_file.split("/")[-1],
+            "orig_url": "https://i.redd.it/" + media_file.split("/")[-1],
+            "gfycat": None,
+            "media_file": THIS_SCRIPT_DIR + "/imgs/" + media_file,
+            "media_hash": reddit_id,
+        }
+
+    reddit_response_json = [
+        make_post("t3_a", "dog/ld0ct5djqkh51.jpg"),
+        make_post("t3_b", "cat/cat_with_a_hat.jpg"),
+        # A repost of the first one
+        make_post("t3_c", "dog/ld0ct5djqkh51.jpg"),
+        make_post("t3_d", "cat/lit_cat.jpg"),
+    ]
+    batches = []
+
+    def labelling_function(frames):
+        raise AssertionError("Should be labelled through label_many")
+
+    def label_many(frames_per_post):
+        batches.append(len(frames_per_post))
+        return [{"cat": 0.5 + i / 10} for i in range(len(frames_per_post))]
+
+    labelling_function.label_many = label_many
+    tempf = NamedTemporaryFile()
+    db_conn = sqlite3.connect(tempf.name)
+    guarantee_tables_exist(db_conn)
+    posts = populate_labels_in_db_for_posts(
+        reddit_response_json,
+        labelling_function,
+        TemporaryDirectory(),
+        db_conn,
+        {
+            "VERBOSE": False,
+            "MODEL_TO_USE": "test",
+            "DECODE_AT_LABELLER_INPUT_SIZE": False,
+            "MAX_IMS_PER_VIDEO": 10,
+            "POSTS_PER_LABELLING_BATCH": 2,
+            "DOWNLOAD_THREADS": 2,
+            "DECODE_THREADS": 2,
+            "PIPELINE_QUEUE_SIZE": 4,
+            "REUSE_LABELS_FOR_SAME_MEDIA": True,
+            "REPOST_PHASH_MAX_DISTANCE": -1,
+        },
+    )
+    assert batches == [2, 1]
+    # New posts still get recorded in listing order, the repost is found by url
+    assert [(p["reddit_id"], p["post_id"]) for p in posts] == [
+        ("t3_a", 1),
+        ("t3_b", 2),
+        ("t3_c", 1),
+        ("t3_d", 3),
+    ]
+    assert QUERIES.get_labels_and_scores_for_post_and_model(
+        db_conn, post_id=3, model="test"
+    ) == [("cat", 0.5)]
+
+
+def test_label_and_record_new_posts_pipeline(monkeypatch):
+    # Later posts download faster, but everything still gets recorded in order
+    posts = [
+        {
+            "reddit_id": f"t3_{i}",
+            "title": str(i),
+            "url": f"https://i.redd.it/{i}.jpg",
+            "orig_url": f"https://i.redd.it/{i}.jpg",
+            "gfycat": None,
+        }
+        for i in range(12)
+    ]
+    downloads_started = []
+    posts_labelled = []
+
+    def add_image_content_to_post_d(post, temp_dir, config):
+        downloads_started.append(post["reddit_id"])
+        if post["reddit_id"] == "t3_5":
+            raise Exception("404")
+        time.sleep(0.02 * (12 - int(post["title"])) / 12)
+        post["media_file"] = THIS_SCRIPT_DIR + "/imgs/cat/cat_with_a_hat.jpg"
+        post["media_hash"] = post["reddit_id"]
+
+    def labelling_function(frames):
+        posts_labelled.append(len(downloads_started))
+        return {"cat": 0.9}
+
+    monkeypatch.setattr(
+        "top_cat.add_image_content_to_post_d", add_image_content_to_post_d
+    )
+    tempf = NamedTemporaryFile()
+    db_conn = sqlite3.connect(tempf.name)
+    guarantee_tables_exist(db_conn)
+    label_and_record_new_posts(
+        posts,
+        labelling_function,
+        TemporaryDirectory(),
+        db_conn,
+        {
+            "VERBOSE": False,
+            "MODEL_TO_USE": "test",
+            "DECODE_AT_LABELLER_INPUT_SIZE": False,
+            "POSTS_PER_LABELLING_BATCH": 1,
+            "DOWNLOAD_THREADS": 4,
+            "DECODE_THREADS": 2,
+            "PIPELINE_QUEUE_SIZE": 2,
+            "REUSE_LABELS_FOR_SAME_MEDIA": True,
+            "REPOST_PHASH_MAX_DISTANCE": -1,
+        },
+    )
+    assert [p.get("post_id") for p in posts] == [1, 2, 3, 4, 5, None] + list(
+        range(6, 12)
+    )
+    # Downloads can't run off too far ahead of the labelling (backpressure)
+    assert all(
+        started <= labelled + 4 for labelled, started in enumerate(posts_labelled, 1)
+    )
+
+
+def test_label_and_record_new_posts_reuses_labels_for_same_media(capsys):
+    tempf = NamedTemporaryFile()
+    db_conn = sqlite3.connect(tempf.name)
+    guarantee_tables_exist(db_conn)
+    for post_id, (media_hash, model) in enumerate(
+        [("dog_hash", "test"), ("nothing_hash", "test"), ("cat_hash", "other")], 1
+    ):
+        QUERIES.record_post(
+            db_conn,
+            url=f"https://i.redd.it/{post_id}.jpg",
+            media_hash=media_hash,
+            title="old",
+            reddit_id=f"t3_old{post_id}",
+            orig_url=None,
+            frames_used=1,
+            model=model,
+            phash=None,
+            media_url=None,
+        )
+    QUERIES.record_post_labels(
+        db_conn, [dict(post_id=1, label="dog", score=0.7, model="test")]
+    )
+    QUERIES.record_post_labels(
+        db_conn, [dict(post_id=3, label="cat", score=0.9, model="other")]
+    )
+
+    def make_post(reddit_id, media_hash):
+        return {
+            "reddit_id": reddit_id,
+            "title": reddit_id,
+            "url": f"https://i.redd.it/{reddit_id}.jpg",
+            "orig_url": f"https://i.redd.it/{reddit_id}.jpg",
+            "media_file": THIS_SCRIPT_DIR + "/imgs/cat/cat_with_a_hat.jpg",
+            "media_hash": media_hash,
+        }
+
+    posts = [
+        make_post("t3_a", "dog_hash"),
+        make_post("t3_b", "nothing_hash"),
+        # Only labelled by another model so far
+        make_post("t3_c", "cat_hash"),
+        make_post("t3_d", "new_hash"),
+        make_post("t3_e", "new_hash"),
+        make_post("t3_f", "cat_hash"),
+    ]
+    labelled = []
+
+    def labelling_function(frames):
+        raise AssertionError("Should be labelled through label_many")
+
+    def label_many(frames_per_post):
+        labelled.extend(frames_per_post)
+        return [{"cat": 0.8} for _ in frames_per_post]
+
+    labelling_function.label_many = label_many
+    config = {
+        "VERBOSE": False,
+        "MODEL_TO_USE": "test",
+        "DECODE_AT_LABELLER_INPUT_SIZE": False,
+        "MAX_IMS_PER_VIDEO": 10,
+        "POSTS_PER_LABELLING_BATCH": 2,
+        "DOWNLOAD_THREADS": 2,
+        "DECODE_THREADS": 2,
+        "PIPELINE_QUEUE_SIZE": 4,
+        "REUSE_LABELS_FOR_SAME_MEDIA": True,
+        "REPOST_PHASH_MAX_DISTANCE": -1,
+    }
+    label_and_record_new_posts(posts, labelling_function, None, db_conn, config)
+    # Just t3_c and t3_d needed the model
+    assert len(labelled) == 2
+    assert [(p["post_id"], p["labels"], p["scores"]) for p in posts] == [
+        (4, ["dog"], [0.7]),
+        (5, ["background"], [1.0]),
+        (6, ["cat"], [0.8]),
+        (7, ["cat"], [0.8]),
+        (8, ["cat"], [0.8]),
+        (9, ["cat"], [0.8]),
+    ]
+    assert QUERIES.get_labels_and_scores_for_post_and_model(
+        db_conn, post_id=4, model="test"
+    ) == [("dog", 0.7)]
+    assert (
+        QUERIES.get_labels_and_scores_for_post_and_model(
+            db_conn, post_id=5, model="test"
+        )
+        == []
+    )
+    assert QUERIES.get_labelled_post_given_media_hash(
+        db_conn, media_hash="cat_hash", model="test"
+    ) == (9, None)
+    assert "Label cache: 4/6 new posts (67%)" in capsys.readouterr().err
+
+    # Turned off, everything gets labelled
+    labelled.clear()
+    label_and_record_new_posts(
+        [make_post("t3_g", "dog_hash")],
+        labelling_function,
+        None,
+        db_conn,
+        {**config, "REUSE_LABELS_FOR_SAME_MEDIA": False},
+    )
+    assert len(labelled) == 1
+
+
+def test_label_and_record_new_posts_reuses_labels_for_lookalike_media(capsys):
+    tempf = NamedTemporaryFile()
+    db_conn = sqlite3.connect(tempf.name)
+    guarantee_tables_exist(db_conn)
+    temp_dir = TemporaryDirectory()
+    small_cat_file = temp_dir.name + "/small_cat.png"
+    cat = Image.open(THIS_SCRIPT_DIR + "/imgs/cat/cat_with_a_hat.jpg")
+    cat.resize((cat.width // 2, cat.height // 2)).save(small_cat_file)
+
+    def make_post(reddit_id, media_file):
+        return {
+            "reddit_id": reddit_id,
+            "title": reddit_id,
+            "url": f"https://i.redd.it/{reddit_id}.jpg",
+            "orig_url": f"https://i.redd.it/{reddit_id}.jpg",
+            "media_file": media_file,
+            # Different bytes every time, so only the phash can match them up
+            "media_hash": reddit_id + "_hash",
+        }
+
+    labelled = []
+
+    def labelling_function(frames):
+        labelled.append(frames)
+        return {"cat": 0.8} if len(labelled) == 1 else {}
+
+    config = {
+        "VERBOSE": False,
+        "MODEL_TO_USE": "test",
+        "DECODE_AT_LABELLER_INPUT_SIZE": False,
+        "MAX_IMS_PER_VIDEO": 10,
+        "POSTS_PER_LABELLING_BATCH": 4,
+        "DOWNLOAD_THREADS": 2,
+        "DECODE_THREADS": 2,
+        "PIPELINE_QUEUE_SIZE": 4,
+        "REUSE_LABELS_FOR_SAME_MEDIA": True,
+        "REPOST_PHASH_MAX_DISTANCE": 4,
+        "PHASH_INDEX_FILE": temp_dir.name + "/phash_index.pickle",
+    }
+    posts = [
+        make_post("t3_a", THIS_SCRIPT_DIR + "/imgs/cat/cat_with_a_hat.jpg"),
+        make_post("t3_b", THIS_SCRIPT_DIR + "/imgs/galaxy/m31_antonis_960.jpg"),
+        # Looks like t3_a, which is labelled earlier on in the same batch
+        make_post("t3_c", small_cat_file),
+    ]
+    label_and_record_new_posts(posts, labelling_function, None, db_conn, config)
+    assert len(labelled) == 2
+    assert [(p["post_id"], p["labels"]) for p in posts] == [
+        (1, ["cat"]),
+        (2, []),
+        (3, ["cat"]),
+    ]
+    assert PhashIndex.load(config["PHASH_INDEX_FILE"]).last_post_id == 3
+    assert (
+        "Label cache: 1/3 new posts (33%) had media we'd already labelled"
+        " (1 of those by phash, out of 3 looked up by phash)"
+    ) in capsys.readouterr().err
+
+    # Next run it comes from the saved index (and the db), and that counts without REUSE_LABELS_FOR_SAME_MEDIA too
+    (post,) = posts = [make_post("t3_d", small_cat_file)]
+    label_and_record_new_posts(
+        posts,
+        labelling_function,
+        None,
+        db_conn,
+        {**config, "REUSE_LABELS_FOR_SAME_MEDIA": False},
+    )
+    assert len(labelled) == 2
+    assert post["labels"] == ["cat"]
+    assert "Label cache: 1/1 new posts (100%)" in capsys.readouterr().err
+    assert QUERIES.get_labels_and_scores_for_post_and_model(
+        db_conn, post_id=4, model="test"
+    ) == [("cat", 0.8)]
+    phash_index = PhashIndex.load(config["PHASH_INDEX_FILE"])
+    assert phash_index.last_post_id == 4
+    assert [post_id for _, post_id in phash_index.find(post["phash"], 4)] == [
+        1,
+        3,
+        4,
+    ]
+
+    # With it turned off posts don't get hashed at all
+    (post_e,) = posts = [make_post("t3_e", small_cat_file)]
+    label_and_record_new_posts(
+        posts,
+        labelling_function,
+        None,
+        db_conn,
+        {**config, "REPOST_PHASH_MAX_DISTANCE": -1},
+    )
+    assert len(labelled) == 3
+    assert post_e["phash"] is None
+    phash_index = load_phash_index(db_conn, config)
+    assert phash_index.last_post_id == 5
+    assert len(phash_index.find(post["phash"], 4)) == 3
+    # Without a saved index it's rebuilt from the db
+    os.remove(config["PHASH_INDEX_FILE"])
+    phash_index = load_phash_index(db_conn, config)
+    assert (phash_index.last_post_id, phash_index.tree.size) == (5, 4)
+    # An index from some other (bigger) db gets thrown out
+    other_index = PhashIndex()
+    other_index.add(post["phash"], 1000)
+    other_index.save(config["PHASH_INDEX_FILE"])
+    assert load_phash_index(db_conn, config).tree.size == 4
+
+
+def test_label_and_record_new_posts_phashes_any_image_mode(monkeypatch):
+    tempf = NamedTemporaryFile()
+    db_conn = sqlite3.connect(tempf.name)
+    guarantee_tables_exist(db_conn)
+    temp_dir = TemporaryDirectory()
+    gray_cat_file = temp_dir.name + "/gray_cat.jpg"
+    Image.open(THIS_SCRIPT_DIR + "/imgs/cat/cat_with_a_hat.jpg").convert("L").save(
+        gray_cat_file
+    )
+
+    def make_post(reddit_id):
+        return {
+            "reddit_id": reddit_id,
+            "title": reddit_id,
+            "url": f"https://i.redd.it/{reddit_id}.jpg",
+            "orig_url": f"https://i.redd.it/{reddit_id}.jpg",
+            "media_file": gray_cat_file,
+            "media_hash": reddit_id + "_hash",
+        }
+
+    # Gets PIL images (like gvision_labeler does), not a numpy batch
+    def labelling_function(frames):
+        return {"cat": 0.8}
+
+    config = {
+        "VERBOSE": False,
+        "MODEL_TO_USE": "test",
+        "DECODE_AT_LABELLER_INPUT_SIZE": False,
+        "MAX_IMS_PER_VIDEO": 10,
+        "POSTS_PER_LABELLING_BATCH": 4,
+        "DOWNLOAD_THREADS": 2,
+        "DECODE_THREADS": 2,
+        "PIPELINE_QUEUE_SIZE": 4,
+        "REUSE_LABELS_FOR_SAME_MEDIA": True,
+        "REPOST_PHASH_MAX_DISTANCE": 4,
+        "PHASH_INDEX_FILE": "",
+    }
+    (post,) = posts = [make_post("t3_a")]
+    label_and_record_new_posts(posts, labelling_function, None, db_conn, config)
+    assert post["labels"] == ["cat"] and len(post["phash"]) == 22
+
+    # A post that can't be hashed still gets labelled and recorded
+    def get_post_phash(frames):
+        raise TypeError("can't hash this")
+
+    monkeypatch.setattr("phash_index.get_post_phash", get_post_phash)
+    (post,) = posts = [make_post("t3_b")]
+    label_and_record_new_posts(posts, labelling_function, None, db_conn, config)
+    assert (post["post_id"], post["labels"], post["phash"]) == (2, ["cat"], None)
+
+
+def test_label_and_record_new_posts_skips_failed_labelling():
+    tempf = NamedTemporaryFile()
+    db_conn = sqlite3.connect(tempf.name)
+    guarantee_tables_exist(db_conn)
+
+    def make_post(reddit_id):
+        return {
+            "reddit_id": reddit_id,
+            "title": reddit_id,
+            "url": f"https://i.redd.it/{reddit_id}.jpg",
+            "orig_url": f"https://i.redd.it/{reddit_id}.jpg",
+            "media_file": THIS_SCRIPT_DIR + "/imgs/cat/cat_with_a_hat.jpg",
+            # Same media, so t3_b would copy t3_a's labels
+            "media_hash": "cat_hash",
+        }
+
+    labelled = []
+
+    # Like gvision_labeler when the api errors out on a frame
+    def labelling_function(frames):
+        labelled.append(frames)
+        return None if len(labelled) == 1 else {"cat": 0.8}
+
+    config = {
+        "VERBOSE": False,
+        "MODEL_TO_USE": "test",
+        "DECODE_AT_LABELLER_INPUT_SIZE": False,
+        "MAX_IMS_PER_VIDEO": 10,
+        "POSTS_PER_LABELLING_BATCH": 1,
+        "DOWNLOAD_THREADS": 2,
+        "DECODE_THREADS": 2,
+        "PIPELINE_QUEUE_SIZE": 4,
+        "REUSE_LABELS_FOR_SAME_MEDIA": True,
+        "REPOST_PHASH_MAX_DISTANCE": -1,
+    }
+    posts = [make_post("t3_a"), make_post("t3_b")]
+    label_and_record_new_posts(posts, labelling_function, None, db_conn, config)
+    assert len(labelled) == 1
+    assert [p.get("post_id") for p in posts] == [None, None]
+    assert QUERIES.get_max_post_id(db_conn) is None
+
+    # Next run it gets another go
+    (post,) = posts = [make_post("t3_a")]
+    label_and_record_new_posts(posts, labelling_function, None, db_conn, config)
+    assert (post["post_id"], post["labels"]) == (1, ["cat"])
+
+
+def test_guarantee_tables_exist_migrates_old_db():
+    tempf = NamedTemporaryFile()
+    db_conn = sqlite3.connect(tempf.name)
+    db_conn.executescript("""
+        CREATE TABLE post (
+            post_id INTEGER PRIMARY KEY, url text not null, media_hash text not null,
+            title text not null, ts_ins text not null default current_timestamp,
+            ts_upd text, ts_del text
+        );
+        INSERT INTO post (url, media_hash, title) values ('a_url', 'a_hash', 'a_title');
+        """)
+    guarantee_tables_exist(db_conn)
+    assert get_known_posts_given_urls([{"url": "a_url"}], db_conn) == {
+        "a_url": ((1, "a_hash", "a_url"), [])
+    }
+    assert (
+        QUERIES.get_posts_and_labels_given_reddit_ids(
+            db_conn, reddit_ids=json.dumps(["t3_nope"])
+        )
+        == []
+    )
+    assert (
+        QUERIES.get_labelled_post_given_media_hash(
+            db_conn, media_hash="a_hash", model="deeplab"
+        )
+        is None
+    )
 
 
 # # Yeah... I don't want to spam my channels... unfortunately I'll have to test this manually...
@@ -269,6 +1491,12 @@ def test_maybe_repost_to_social_media():
         url="https://i.redd.it/ld0ct5djqkh51.jpg",
         media_hash="c241691625515c29b02a4a66f3c947ba71566168",
         title="this is a test",
+        reddit_id="t3_ld0ct5",
+        orig_url="https://i.redd.it/ld0ct5djqkh51.jpg",
+        frames_used=1,
+        model="test",
+        phash=None,
+        media_url=None,
     )
     maybe_repost_to_social_media(reddit_response_json, config, db_conn)
     # Now double check we added a row to top_post;
@@ -282,10 +1510,62 @@ def test_update_config_with_args():
     assert config["DB_FILE"] == "b_file"
 
 
+def test_no_new_posts_skips_heavy_imports():
+    # Runs with nothing new to label shouldn't pay for cv2 or tensorflow. See bench_import_time.py
+    script = """
+import sqlite3, sys
+from tempfile import TemporaryDirectory
+from top_cat import *
+db_conn = sqlite3.connect(":memory:")
+guarantee_tables_exist(db_conn)
+QUERIES.record_post(
+    db_conn, url="u", media_hash="h", title="t", reddit_id="t3_a", orig_url="u",
+    frames_used=1, model="test", phash=None, media_url=None
+)
+config = get_config("/dev/null")
+posts = populate_labels_in_db_for_posts(
+    [{"reddit_id": "t3_a", "title": "t", "url": "u", "orig_url": "u"}],
+    LazyLabellingFunction(config),
+    TemporaryDirectory(),
+    db_conn,
+    config,
+)
+assert len(posts) == 1
+print(sorted(m for m in ["cv2", "numpy", "PIL", "tensorflow"] if m in sys.modules))
+"""
+    output = subprocess.run(
+        [sys.executable, "-c", script],
+        cwd=THIS_SCRIPT_DIR,
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    assert output.strip() == "[]"
+
+
+def test_get_labeller_input_size_skips_tensorflow():
+    # Resolving and decoding new posts need it, but the model might not (label server, reused labels)
+    script = """
+import sys
+from top_cat import get_config, get_labeller_input_size
+assert get_labeller_input_size(get_config("/dev/null")) == 513
+print("tensorflow" in sys.modules)
+"""
+    output = subprocess.run(
+        [sys.executable, "-c", script],
+        cwd=THIS_SCRIPT_DIR,
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    assert output.strip() == "False"
+
+
 @pytest.mark.net
 @pytest.mark.slow
 def test_get_labelling_funtion():
     base_config = get_config("/dev/null")
+    base_config["USE_LABEL_SERVER"] = False
     labelling_func_deeplab = get_labelling_funtion(base_config)
     base_config["MODEL_TO_USE"] = "gvision_labeler"
     labelling_func_gvision = get_labelling_funtion(base_config)
@@ -293,3 +1573,31 @@ def test_get_labelling_funtion():
     assert "labelling_funtion_deeplabv3" in str(
         labelling_func_deeplab
     ) and "labelling_funtion_gvision" in str(labelling_func_gvision)
+
+
+def test_lazy_labelling_function(monkeypatch):
+    loads = []
+
+    def get_labelling_funtion(config):
+        loads.append(config)
+
+        def labelling_function(frames):
+            return {"cat": 1.0}
+
+        labelling_function.accepts_numpy_batch = True
+        return labelling_function
+
+    monkeypatch.setattr("top_cat.get_labelling_funtion", get_labelling_funtion)
+    labelling_function = LazyLabellingFunction({"MODEL_TO_USE": "test"})
+    assert loads == []
+    assert labelling_function.accepts_numpy_batch and not hasattr(
+        labelling_function, "label_many"
+    )
+    assert labelling_function([]) == {"cat": 1.0} and len(loads) == 1
+    # Closing passes through to whatever got loaded (and doesn't load anything)
+    closed = []
+    labelling_function.labelling_function.close = lambda: closed.append(True)
+    labelling_function.close()
+    assert closed == [True]
+    LazyLabellingFunction({"MODEL_TO_USE": "test"}).close()
+    assert len(loads) == 1
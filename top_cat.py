@@ -22,33 +22,47 @@ Options:
 """
 
 import difflib
+import functools
 import hashlib
+import html
 import importlib
+import itertools
 import json
+import math
 import mimetypes
 import os
 import pprint
-import random
 import re
 import shutil
 import sqlite3
-import string
 import sys
-from tempfile import TemporaryDirectory
+import threading
+from collections import Counter, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from tempfile import NamedTemporaryFile, SpooledTemporaryFile, TemporaryDirectory
 from time import sleep
+from urllib.parse import urlparse
+from xml.etree import ElementTree
 
 import aiosql
-import cv2
-import numpy as np
 import pyjq
 import requests
-import stackprinter
 import toml
 from docopt import docopt
-from PIL import Image
+from requests.adapters import HTTPAdapter
 
-# Make stack traces way better
-stackprinter.set_excepthook(style="darkbg2")
+# cv2, numpy and PIL (and the model) get imported by the functions that need them,
+#   so runs that don't find anything new to label don't have to pay for them
+
+
+# Make stack traces way better. stackprinter pulls in numpy, so only import it once something breaks
+def show_exception_with_stackprinter(*exc_info):
+    import stackprinter
+
+    stackprinter.show(exc_info, style="darkbg2")
+
+
+sys.excepthook = show_exception_with_stackprinter
 
 # So we can copy paste into ipython for debugging. Assuming we run ipython from the repo dir
 if hasattr(__builtins__, "__IPYTHON__"):
@@ -77,14 +91,10 @@ def get_config(config_file_loc="~/.top_cat/config.toml"):
     # Make sure to crash if any config options are specified that we don't know what to do with
     available_opts = list(default_config.keys())
     for user_config_opt in user_config.keys():
-        closest_opt_key = available_opts[
-            np.argmax(
-                [
-                    difflib.SequenceMatcher(None, user_config_opt, opt).ratio()
-                    for opt in available_opts
-                ]
-            )
-        ]
+        closest_opt_key = max(
+            available_opts,
+            key=lambda opt: difflib.SequenceMatcher(None, user_config_opt, opt).ratio(),
+        )
         assert user_config_opt in available_opts, re.sub(
             r"^\s*",
             "",
@@ -119,12 +129,72 @@ def get_config(config_file_loc="~/.top_cat/config.toml"):
     return final_config
 
 
+# Columns added to the post table after the fact, and the migration that adds each one
+POST_COLUMN_MIGRATIONS = [
+    ("reddit_id", "000002-track-reddit-id.sql"),
+    ("frames_used", "000003-track-frames-used.sql"),
+    ("model", "000004-track-post-model.sql"),
+    ("phash", "000005-track-phash.sql"),
+    ("media_url", "000006-track-media-url.sql"),
+]
+
+
+def connect_to_db(config):
+    """
+    Connect to DB_FILE (creating it if need be) with DB_JOURNAL_MODE.
+    In wal mode readers (eg the website) don't block us writing and we don't block them,
+    and commits only need to fsync the wal at checkpoints (synchronous=NORMAL is still crash safe with wal).
+    """
+    db_conn = sqlite3.connect(os.path.expanduser(config["DB_FILE"]))
+    if config["DB_JOURNAL_MODE"]:
+        db_conn.execute(f"PRAGMA journal_mode={config['DB_JOURNAL_MODE']}")
+        if config["DB_JOURNAL_MODE"].lower() == "wal":
+            db_conn.execute("PRAGMA synchronous=NORMAL")
+    return db_conn
+
+
 def guarantee_tables_exist(db_conn):
+    # Older dbs need to be migrated before the schema (and its indexes) will line up
+    post_columns = [c[0] for c in QUERIES.get_post_column_names(db_conn)]
+    for column, migration_file in POST_COLUMN_MIGRATIONS:
+        if post_columns and column not in post_columns:
+            with open(f"{THIS_SCRIPT_DIR}/migrations/{migration_file}") as migration:
+                db_conn.executescript(migration.read())
     QUERIES.create_tables_and_indexes(db_conn)
     db_conn.commit()
 
 
-def fix_imgur_url(url):
+class HostLimitedSession(requests.Session):
+    """
+    A keep-alive requests session that caps how many requests hit any one host at once.
+    Lets us resolve lots of urls in parallel without hammering imgur or v.redd.it.
+    """
+
+    def __init__(self, max_connections_per_host, pool_size):
+        super().__init__()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.mount("http://", adapter)
+        self.mount("https://", adapter)
+        self._host_semaphores = defaultdict(
+            lambda: threading.BoundedSemaphore(max_connections_per_host)
+        )
+        self._host_semaphores_lock = threading.Lock()
+
+    def request(self, method, url, *args, **kwargs):
+        with self._host_semaphores_lock:
+            host_semaphore = self._host_semaphores[urlparse(url).netloc]
+        with host_semaphore:
+            return super().request(method, url, *args, **kwargs)
+
+
+def get_http_session(config):
+    return HostLimitedSession(
+        max_connections_per_host=config["MAX_CONNECTIONS_PER_HOST"],
+        pool_size=config["URL_RESOLVER_THREADS"],
+    )
+
+
+def fix_imgur_url(url, session=requests):
     """
     Sometimes people post imgur urls without the image or video extension.
     This grabs the extension and fixes the link so we go straight to the image or video:
@@ -136,7 +206,7 @@ def fix_imgur_url(url):
         # Don't bother doing anything fancy if it already ends in .jpg etc
         if "." not in url.split("/")[-1]:
             imgur_id = re.findall("imgur.com/([^.]+)", url)[0]
-            req = requests.get(url)
+            req = session.get(url)
             possible_media_links = set(
                 re.findall(r'content="(http.{0,50}%s\.[^"?]+)[?"]' % imgur_id, req.text)
             )
@@ -167,44 +237,340 @@ def fix_giphy_url(url):
     return url
 
 
-def fix_redd_url(url):
+def fix_redd_url(url, session=requests, get_renditions=None):
+    "get_renditions stands in for get_dash_renditions, eg to reuse a playlist we've already fetched"
     if "v.redd.it" in url:
         # Unfortunately we can't predict what quality levels are available beforehand
         # Protip from https://www.joshmcarthur.com/til/2019/05/20/httpsvreddit-video-urls.html
-        vid_id = re.findall("v.redd.it/([A-Za-z0-9]+)", url)[0]
-        dash_playlist = requests.get(f"https://v.redd.it/{vid_id}/DASHPlaylist.mpd")
-        available_qs = re.findall(r"DASH_(\d+)\.mp4", dash_playlist.text)
-        best_q = sorted(available_qs, key=lambda x: -int(x))[0]
-        return f"https://v.redd.it/{vid_id}/DASH_{best_q}.mp4"
+        return max((get_renditions or get_dash_renditions)(url, session))[1]
     else:
         return url
 
 
-def fix_url_in_dict(d):
+# For hosts not in URL_CACHE_TTL_HOURS, if it doesn't have a "default" either
+DEFAULT_URL_CACHE_TTL_HOURS = 24
+
+
+class ResolvedUrlCache:
+    """
+    Remembers what imgur/v.redd.it urls resolve to (and whether they exist) between runs.
+    Failures are remembered too (for less time) so we don't keep retrying broken posts.
+    """
+
+    def __init__(self, db_file, ttl_hours, failure_ttl_hours):
+        # Lookups happen from the resolver threads, the lock keeps them from stepping on each other
+        self.db_conn = sqlite3.connect(
+            os.path.expanduser(db_file), check_same_thread=False
+        )
+        self.lock = threading.Lock()
+        self.ttl_hours = ttl_hours
+        self.failure_ttl_hours = failure_ttl_hours
+        self.hits = 0
+        self.misses = 0
+        with self.lock:
+            QUERIES.create_url_cache_table(self.db_conn)
+            self.db_conn.commit()
+
+    def ttl_hours_for_url(self, url):
+        "Hosts can be listed in the config as eg imgur.com to also match i.imgur.com"
+        host = urlparse(url).hostname or ""
+        for host_suffix, ttl_hours in self.ttl_hours.items():
+            if host == host_suffix or host.endswith("." + host_suffix):
+                return ttl_hours
+        return self.ttl_hours.get("default", DEFAULT_URL_CACHE_TTL_HOURS)
+
+    def resolve(self, kind, url, resolve_func):
+        with self.lock:
+            cached = QUERIES.get_cached_url(self.db_conn, kind=kind, url=url)
+            if cached:
+                self.hits += 1
+            else:
+                self.misses += 1
+        if cached:
+            resolved_url, ok = cached
+            if not ok:
+                raise Exception(f"'{url}' failed to resolve recently ({kind})")
+            return resolved_url
+        try:
+            resolved_url = resolve_func(url)
+        except Exception:
+            self.remember(kind, url, None, False, self.failure_ttl_hours)
+            raise
+        self.remember(kind, url, resolved_url, True, self.ttl_hours_for_url(url))
+        return resolved_url
+
+    def remember(self, kind, url, resolved_url, ok, ttl_hours):
+        with self.lock:
+            QUERIES.cache_url(
+                self.db_conn,
+                kind=kind,
+                url=url,
+                resolved_url=resolved_url,
+                ok=ok,
+                ttl=f"+{ttl_hours} hours",
+            )
+            self.db_conn.commit()
+
+    def close(self):
+        self.db_conn.close()
+
+
+def get_url_cache(config):
+    if not config["URL_CACHE_FILE"]:
+        return None
+    return ResolvedUrlCache(
+        db_file=config["URL_CACHE_FILE"],
+        ttl_hours=config["URL_CACHE_TTL_HOURS"],
+        failure_ttl_hours=config["URL_CACHE_FAILURE_TTL_HOURS"],
+    )
+
+
+def check_url_exists(url, session=requests):
+    if session.head(url).status_code != 200:
+        raise Exception(f"Something's wrong with '{url}'")
+    return url
+
+
+def resolve_without_cache(kind, url, resolve_func):
+    return resolve_func(url)
+
+
+def fix_url_in_dict(d, session=requests, url_cache=None, get_renditions=None):
+    resolve = url_cache.resolve if url_cache is not None else resolve_without_cache
     if d["gfycat"]:
+        # No need to cache this one, it's just a regex
         to_ret = fix_giphy_url(d["gfycat"])
     else:
-        to_ret = fix_redd_url(fix_imgur_url(d["url"]))
+        to_ret = d["url"]
+        # Only the imgur and v.redd.it fixes need to hit the network
+        if "imgur.com" in to_ret:
+            to_ret = resolve("imgur", to_ret, lambda u: fix_imgur_url(u, session))
+        if "v.redd.it" in to_ret:
+            to_ret = resolve(
+                "redd", to_ret, lambda u: fix_redd_url(u, session, get_renditions)
+            )
     # Double check the url actually exists
-    if requests.head(to_ret).status_code != 200:
-        raise Exception(f"Something's wrong with '{to_ret}'")
-    return to_ret
+    return resolve("head", to_ret, lambda u: check_url_exists(u, session))
+
+
+# imgur can give us smaller versions of an image, add the letter to the end of the id
+#   eg https://i.imgur.com/mc316Unl.jpg is at most 640x640. Sizes from https://api.imgur.com/models/image
+IMGUR_SIZE_VARIANTS = [(320, "m"), (640, "l"), (1024, "h")]
+
+
+def get_labeller_input_size(config):
+    """
+    Labellers can set INPUT_SIZE (longest side in pixels) if they shrink frames before labelling.
+    No point downloading or decoding anything much bigger than that.
+    Comes from LABELLER_INPUT_SIZES if it's in there, since importing deeplab means importing tensorflow.
+    """
+    if config["MODEL_TO_USE"] in config["LABELLER_INPUT_SIZES"]:
+        return config["LABELLER_INPUT_SIZES"][config["MODEL_TO_USE"]]
+    return getattr(importlib.import_module(config["MODEL_TO_USE"]), "INPUT_SIZE", None)
+
+
+def pick_rendition(renditions, input_size):
+    """
+    Given (longest side, url) pairs, pick the smallest one that's still at least input_size.
+    If none are big enough then the biggest will have to do.
+    """
+    big_enough = [r for r in renditions if r[0] >= input_size]
+    if big_enough:
+        return min(big_enough)[1]
+    return max(renditions)[1]
+
+
+def get_redd_vid_id(url):
+    return re.findall("v.redd.it/([A-Za-z0-9]+)", url)[0]
+
+
+def get_dash_renditions(url, session=requests):
+    "All the video renditions (longest side, url) listed in a v.redd.it DASH playlist"
+    vid_id = get_redd_vid_id(url)
+    dash_playlist = session.get(f"https://v.redd.it/{vid_id}/DASHPlaylist.mpd")
+    renditions = []
+    for elem in ElementTree.fromstring(dash_playlist.content).iter():
+        # Audio representations don't have a width or height so they get skipped
+        if elem.tag.endswith("Representation") and elem.get("width"):
+            base_url = [c.text for c in elem if c.tag.endswith("BaseURL")][0].strip()
+            renditions.append(
+                (
+                    max(int(elem.get("width")), int(elem.get("height"))),
+                    f"https://v.redd.it/{vid_id}/{base_url}",
+                )
+            )
+    assert renditions, f"can't find any video renditions for {url}"
+    return renditions
+
+
+def select_media_url(
+    d, input_size, session=requests, url_cache=None, get_renditions=None
+):
+    """
+    The url we'll actually download for labelling. Picks the smallest version of the media
+    that's still at least as big as what the labeller wants. d["url"] stays full quality.
+    get_renditions is like in fix_redd_url.
+    """
+    url = d["url"]
+    if input_size is None:
+        return url
+    mime_t = mimetypes.MimeTypes().guess_type(urlparse(url).path)[0] or ""
+    if mime_t in ["image/jpeg", "image/png"]:
+        # Reddit already gave us a bunch of resized previews for images
+        if d.get("previews"):
+            return html.unescape(
+                pick_rendition(
+                    [(max(p["width"], p["height"]), p["url"]) for p in d["previews"]],
+                    input_size,
+                )
+            )
+        if "i.imgur.com" in url:
+            base_url, ext = url.rsplit(".", 1)
+            return pick_rendition(
+                [
+                    (size, f"{base_url}{letter}.{ext}")
+                    for size, letter in IMGUR_SIZE_VARIANTS
+                ]
+                + [(float("inf"), url)],
+                input_size,
+            )
+    if "v.redd.it" in url:
+        resolve = url_cache.resolve if url_cache is not None else resolve_without_cache
+        return resolve(
+            f"redd_{input_size}",
+            url,
+            lambda u: pick_rendition(
+                (get_renditions or get_dash_renditions)(u, session), input_size
+            ),
+        )
+    return url
+
+
+# Fix imgur and giphy urls. Some rare urls break v.redd.it
+#   so make it durable to that issue... #FIXME: broken for id = lohoa87sas331
+def fix_url_in_dict_or_none(d, session, url_cache=None, input_size=None):
+    # Fixing a v.redd.it url and picking its rendition both need its DASH playlist, only fetch it once
+    dash_renditions = {}
+
+    def get_renditions(url, session):
+        vid_id = get_redd_vid_id(url)
+        if vid_id not in dash_renditions:
+            dash_renditions[vid_id] = get_dash_renditions(url, session)
+        return dash_renditions[vid_id]
+
+    try:
+        d = {**d, "url": fix_url_in_dict(d, session, url_cache, get_renditions)}
+    except Exception:
+        print(f'#WARNING: failed for {d["url"]}. Skipping this post...')
+        return None
+    try:
+        d["media_url"] = select_media_url(
+            d, input_size, session, url_cache, get_renditions
+        )
+    except Exception:
+        # We can always fall back on the full quality version
+        d["media_url"] = d["url"]
+    return d
 
 
-def query_reddit_api(config, limit=10):
+def resolve_post_urls(posts, config, session=None):
+    """
+    Fix imgur, giphy and v.redd.it urls for a bunch of posts at once.
+    Each post can take a few http round trips so we do them in parallel (bounded per host).
+    Posts we can't resolve are dropped, otherwise the original order is kept.
+    """
+    if not posts:
+        return []
+    session = session or get_http_session(config)
+    url_cache = get_url_cache(config)
+    input_size = (
+        get_labeller_input_size(config)
+        if config["SELECT_SMALLEST_USEFUL_MEDIA"]
+        else None
+    )
+    with ThreadPoolExecutor(max_workers=config["URL_RESOLVER_THREADS"]) as executor:
+        resolved_posts = [
+            d
+            for d in executor.map(
+                lambda d: fix_url_in_dict_or_none(d, session, url_cache, input_size),
+                posts,
+            )
+            if d is not None
+        ]
+    if url_cache is not None:
+        if config["VERBOSE"]:
+            print(
+                f"# Url cache: {url_cache.hits} hits, {url_cache.misses} misses",
+                file=sys.stderr,
+            )
+        url_cache.close()
+    return resolved_posts
+
+
+# Reddit won't give us more than this many posts per request
+REDDIT_MAX_PAGE_SIZE = 100
+
+
+class ListingPageCache:
+    """
+    Remembers the listing pages we got last run along with their ETag/Last-Modified headers
+    so we can make conditional requests, and reuse our copy when reddit says nothing changed.
+    """
+
+    def __init__(self, previous_pages=None):
+        self.previous_pages = previous_pages or {}
+        # Only the pages we saw this run get saved for next time
+        self.pages = {}
+
+    def conditional_headers(self, url):
+        previous_page = self.previous_pages.get(url, {})
+        headers = {}
+        if previous_page.get("etag"):
+            headers["If-None-Match"] = previous_page["etag"]
+        if previous_page.get("last_modified"):
+            headers["If-Modified-Since"] = previous_page["last_modified"]
+        return headers
+
+    def reuse(self, url):
+        self.pages[url] = self.previous_pages[url]
+        return self.pages[url]["page"]
+
+    def remember(self, url, response, page):
+        self.pages[url] = {
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "page": page,
+        }
+
+
+def fetch_reddit_listing_page(
+    config, subreddit, sort, limit, after=None, page_cache=None
+):
+    """
+    Grab one page of a listing (eg /r/aww/top) starting after the `after` post.
+    Returns the normalized posts on the page and the cursor for the next one.
+    """
+    url = f"https://www.reddit.com/r/{subreddit}/{sort}.json?limit={limit}"
+    if after:
+        url += f"&after={after}"
+    headers = {"User-Agent": "linux:top-cat:v0.2.0"}
+    if page_cache is not None:
+        headers.update(page_cache.conditional_headers(url))
     # Try really hard to get reddit api results. Sometimes the reddit API gives back empty jsons.
     for attempt in range(config["MAX_REDDIT_API_ATTEMPTS"]):
         try:
-            reddit_json = requests.get(
-                f"https://www.reddit.com/r/aww/top.json?limit={config['MAX_POSTS_TO_PROCESS']}",
-                headers={"User-Agent": "linux:top-cat:v0.2.0"},
-            ).json()
+            response = requests.get(url, headers=headers)
+            if response.status_code == 304:
+                if config["VERBOSE"]:
+                    print(f"# /r/{subreddit}/{sort} hasn't changed", file=sys.stderr)
+                return page_cache.reuse(url)
+            reddit_json = response.json()
         except Exception:
             reddit_json = {}
         if reddit_json.get("data") is not None:
             if config["VERBOSE"]:
                 print(
-                    "# Succesfully queried the reddit api after",
+                    f"# Succesfully queried /r/{subreddit}/{sort} after",
                     attempt + 1,
                     "attempts",
                     file=sys.stderr,
@@ -222,22 +588,106 @@ def query_reddit_api(config, limit=10):
     assert (
         reddit_json.get("data") is not None
     ), "Can't seem to query the reddit api! (Maybe try again later?)"
-    # We've got the data for sure now.
-    nice_jsons = pyjq.all(
-        ".data.children[].data|{title, url, orig_url: .url, gfycat: .media.oembed.thumbnail_url}",
-        reddit_json,
+    # We've got the data for sure now. Only hang on to the bits we care about.
+    page = {
+        "posts": [normalize_reddit_post(c) for c in reddit_json["data"]["children"]],
+        "after": reddit_json["data"].get("after"),
+    }
+    if page_cache is not None:
+        page_cache.remember(url, response, page)
+    return page
+
+
+def normalize_reddit_post(child):
+    "Just keep the bits of a listing entry we actually care about"
+    return pyjq.first(
+        """.data|{
+            reddit_id: .name,
+            title,
+            url,
+            orig_url: .url,
+            gfycat: .media.oembed.thumbnail_url,
+            previews: [.preview.images[0].resolutions[]?, .preview.images[0].source | select(. != null)]
+        }""",
+        child,
     )
-    # Fix imgur and giphy urls. Some rare urls break v.redd.it
-    #   so make it durable to that issue... #FIXME: broken for id = lohoa87sas331
-    to_ret_jsons = []
-    for d in nice_jsons:
-        try:
-            to_ret_jsons.append({**d, "url": fix_url_in_dict(d)})
-        except Exception:
-            print(f'#WARNING: failed for {d["url"]}. Skipping this post...')
-    if config["VERBOSE"]:
-        pprint.pprint(to_ret_jsons)
-    return to_ret_jsons
+
+
+def iter_reddit_listing(config, subreddit, sort, fetch_page=fetch_reddit_listing_page):
+    """
+    Yields normalized posts from one listing, following the `after` cursor page by page.
+    The next page is fetched in the background while the current one is being consumed.
+    (main lists the whole thing before doing anything else anyway, see get_listing_fingerprint)
+    """
+    posts_left = config["MAX_POSTS_TO_PROCESS"]
+    with ThreadPoolExecutor(max_workers=1) as prefetcher:
+        next_page = prefetcher.submit(
+            fetch_page, config, subreddit, sort, min(posts_left, REDDIT_MAX_PAGE_SIZE)
+        )
+        while next_page is not None:
+            page = next_page.result()
+            posts = page["posts"][:posts_left]
+            posts_left -= len(posts)
+            next_page = None
+            if posts_left > 0 and posts and page.get("after"):
+                next_page = prefetcher.submit(
+                    fetch_page,
+                    config,
+                    subreddit,
+                    sort,
+                    min(posts_left, REDDIT_MAX_PAGE_SIZE),
+                    page["after"],
+                )
+            del page
+            yield from posts
+
+
+def iter_reddit_posts(config, fetch_page=fetch_reddit_listing_page):
+    "Yields posts from every subreddit/sort combo in the config. Each post only shows up once."
+    seen_reddit_ids = set()
+    for subreddit in config["SUBREDDITS"]:
+        for sort in config["LISTING_SORTS"]:
+            for post in iter_reddit_listing(config, subreddit, sort, fetch_page):
+                if post["reddit_id"] in seen_reddit_ids:
+                    continue
+                seen_reddit_ids.add(post["reddit_id"])
+                if config["VERBOSE"]:
+                    pprint.pprint(post, stream=sys.stderr)
+                yield post
+
+
+def query_reddit_api(config):
+    "Everything in the listings all at once. Handy for debugging."
+    return list(iter_reddit_posts(config))
+
+
+def get_listing_fingerprint(reddit_posts, config):
+    """
+    Cheap way to tell if anything relevant changed since last run.
+    Order matters since the top post is the one we might repost.
+    """
+    sha1 = hashlib.sha1()
+    sha1.update(
+        json.dumps([config["MODEL_TO_USE"], config["LABELS_TO_SEARCH_FOR"]]).encode()
+    )
+    for post in reddit_posts:
+        sha1.update(post["reddit_id"].encode() + b"\n")
+    return sha1.hexdigest()
+
+
+def get_run_state(db_conn, key, default=None):
+    "Stuff we remember from one run to the next, eg the listing fingerprint"
+    row = QUERIES.get_run_state(db_conn, key=key)
+    return json.loads(row[0]) if row else default
+
+
+def set_run_state(db_conn, key, value):
+    QUERIES.set_run_state(db_conn, key=key, value=json.dumps(value))
+    db_conn.commit()
+
+
+# Read (and hash) downloads in 64kb chunks
+MEDIA_CHUNK_BYTES = 65536
 
 
 def get_sha1_lowmemuse(fname):
@@ -252,59 +702,282 @@ def get_sha1_lowmemuse(fname):
     return sha1.hexdigest()
 
 
-def add_image_content_to_post_d(post, temp_dir):
-    "Add the image data to our post dictionary. Don't bother if it's already there."
-    if post.get("media_file") is None:
-        rand_chars = "".join(random.choice(string.ascii_lowercase) for i in range(20))
-        temp_fname = f"{temp_dir.name}/{rand_chars}.{post['url'].split('.')[-1]}"
-        post["media_file"] = temp_fname
-        with open(temp_fname, "wb") as m_file:
-            shutil.copyfileobj(requests.get(post["url"], stream=True).raw, m_file)
-        post["media_hash"] = get_sha1_lowmemuse(temp_fname)
+def is_video_or_gif(mime_t):
+    return mime_t.split("/")[0] == "video" or mime_t == "image/gif"
 
 
-def add_labels_for_image_to_post_d(post, labelling_function, config):
-    frames_in_video = cast_to_pil_imgs(
-        extract_frames_from_im_or_video(post["media_file"], config)
+def open_media_buffer(mime_t, expected_bytes, temp_dir, config):
+    """
+    Somewhere to stash a download. Images stay in memory unless they get really big.
+    OpenCV needs a path to read videos, so those go in a memfd if we can (linux) or else on disk.
+    """
+    in_memory_max_bytes = config["MEDIA_IN_MEMORY_MAX_BYTES"]
+    if not is_video_or_gif(mime_t):
+        return SpooledTemporaryFile(max_size=in_memory_max_bytes, dir=temp_dir.name)
+    if hasattr(os, "memfd_create") and expected_bytes <= in_memory_max_bytes:
+        return os.fdopen(os.memfd_create("top_cat_media"), "w+b")
+    return NamedTemporaryFile(dir=temp_dir.name)
+
+
+def is_memfd(media_buffer):
+    # os.fdopen'd files are named by their fd
+    return isinstance(getattr(media_buffer, "name", None), int)
+
+
+def move_media_buffer_to_disk(media_buffer, temp_dir):
+    "For a memfd that turned out bigger than we wanted to keep in memory"
+    on_disk = NamedTemporaryFile(dir=temp_dir.name)
+    media_buffer.seek(0)
+    shutil.copyfileobj(media_buffer, on_disk)
+    media_buffer.close()
+    return on_disk
+
+
+def get_media_path(media_file):
+    "OpenCV wants a path, but our media might just be an open (mem)file"
+    if isinstance(media_file, str):
+        return media_file
+    if isinstance(getattr(media_file, "name", None), str):
+        return media_file.name
+    return f"/proc/self/fd/{media_file.fileno()}"
+
+
+def download_media(url, mime_t, temp_dir, config):
+    """
+    Stream a download into a media buffer (see open_media_buffer) and hash it on the way in.
+    Bails as soon as we know it's bigger than MAX_MEDIA_BYTES.
+    """
+    sha1 = hashlib.sha1()
+    max_bytes = config["MAX_MEDIA_BYTES"]
+    with requests.get(url, stream=True) as response:
+        response.raise_for_status()
+        expected_bytes = int(response.headers.get("Content-Length") or 0)
+        if expected_bytes > max_bytes:
+            raise Exception(
+                f"'{url}' is {expected_bytes} bytes, too big to bother with"
+            )
+        media_buffer = open_media_buffer(mime_t, expected_bytes, temp_dir, config)
+        try:
+            bytes_so_far = 0
+            for chunk in response.iter_content(MEDIA_CHUNK_BYTES):
+                bytes_so_far += len(chunk)
+                if bytes_so_far > max_bytes:
+                    raise Exception(
+                        f"'{url}' is over {max_bytes} bytes, too big to bother with"
+                    )
+                if bytes_so_far > config["MEDIA_IN_MEMORY_MAX_BYTES"] and is_memfd(
+                    media_buffer
+                ):
+                    # No Content-Length to go by and it's too big for memory after all
+                    media_buffer = move_media_buffer_to_disk(media_buffer, temp_dir)
+                sha1.update(chunk)
+                media_buffer.write(chunk)
+            media_buffer.flush()
+            media_buffer.seek(0)
+        except BaseException:
+            media_buffer.close()
+            raise
+    return media_buffer, sha1.hexdigest()
+
+
+def add_image_content_to_post_d(post, temp_dir, config):
+    """
+    Add the image data to our post dictionary. Don't bother if it's already there.
+    Prefers the (smaller) media_url picked by select_media_url, falling back on the full url.
+    """
+    if post.get("media_file") is None:
+        media_urls = [post["url"]]
+        if post.get("media_url") and post["media_url"] != post["url"]:
+            media_urls.insert(0, post["media_url"])
+        for media_url in media_urls:
+            post["media_mime_type"] = mimetypes.MimeTypes().guess_type(
+                urlparse(media_url).path
+            )[0]
+            try:
+                post["media_file"], post["media_hash"] = download_media(
+                    media_url, post["media_mime_type"], temp_dir, config
+                )
+                # So we know what media_hash is the hash of
+                post["media_url"] = media_url
+                return
+            except Exception:
+                if media_url == media_urls[-1]:
+                    raise
+
+
+def get_frames_for_labelling(post, labelling_function, config):
+    max_size = (
+        get_labeller_input_size(config)
+        if config["DECODE_AT_LABELLER_INPUT_SIZE"]
+        else None
+    )
+    frames = extract_frames_from_im_or_video(
+        post["media_file"], config, post.get("media_mime_type"), max_size
     )
-    proportion_label_in_post = labelling_function(frames_in_video)
+    # Labellers that can take a numpy batch skip the round trip through PIL
+    if getattr(labelling_function, "accepts_numpy_batch", False):
+        return cast_to_rgb_batch(frames)
+    return cast_to_pil_imgs(frames)
 
+
+def set_labels_for_post_d(post, proportion_label_in_post):
+    if proportion_label_in_post is None:
+        # The labeller couldn't label it (eg a gvision api error), so it doesn't get recorded and is tried again later
+        post["labelling_failed"] = True
+        return
     # Add labels and scores to posts
     post["labels"] = list(proportion_label_in_post.keys())
     post["scores"] = list(proportion_label_in_post.values())
+    # Labellers built on label_aggregation tell us how many frames they actually used
+    post["frames_used"] = getattr(proportion_label_in_post, "frames_used", None)
+    # and which tier decided them when there's a cascade (eg deeplab's DEEPLAB_CASCADE)
+    post["labelling_tier"] = getattr(proportion_label_in_post, "tier", None)
 
 
-def extract_frames_from_im_or_video(media_file, config):
-    mime_t = mimetypes.MimeTypes().guess_type(media_file)[0]
-    if mime_t.split("/")[0] == "video" or mime_t == "image/gif":
-        # Modified from https://answers.opencv.org/question/62029/extract-a-frame-every-second-in-python/
-        to_ret = []
-        cap = cv2.VideoCapture(media_file)
-        frame_rate = cap.get(cv2.CAP_PROP_FPS)
-        frames_in_video = cap.get(cv2.CAP_PROP_FRAME_COUNT)
-        seconds_in_video = frames_in_video / frame_rate
-        if seconds_in_video > config["MAX_IMS_PER_VIDEO"]:
-            frames_to_grab = np.linspace(
-                0, frames_in_video - 1, num=config["MAX_IMS_PER_VIDEO"], dtype=int
-            )
-        else:
-            frames_to_grab = [int(f) for f in np.arange(0, frames_in_video, frame_rate)]
-        while cap.isOpened():
-            frame_id = cap.get(cv2.CAP_PROP_POS_FRAMES)
-            got_a_frame, frame = cap.read()
-            if not got_a_frame:
-                break
-            if int(frame_id) in frames_to_grab:
-                to_ret.append(frame)
-        #             filename = f"{THIS_SCRIPT_DIR}/debug/image_" +  str(int(frame_id)) + ".jpg"
-        #             cv2.imwrite(filename, frame)
+def add_labels_for_image_to_post_d(post, labelling_function, config):
+    frames_in_video = get_frames_for_labelling(post, labelling_function, config)
+    set_labels_for_post_d(post, labelling_function(frames_in_video))
+
+
+def add_labels_given_frames_to_post_ds(posts, frames_per_post, labelling_function):
+    """
+    Label a few posts at once. If the labelling function has a `label_many` it gets every post's frames
+    in one call (deeplab batches frames from different posts together), otherwise it's called once per post.
+    """
+    if hasattr(labelling_function, "label_many"):
+        labels_per_post = labelling_function.label_many(frames_per_post)
+    else:
+        labels_per_post = [labelling_function(frames) for frames in frames_per_post]
+    for post, proportion_label_in_post in zip(posts, labels_per_post):
+        set_labels_for_post_d(post, proportion_label_in_post)
+
+
+def extract_frames_from_im_or_video(media_file, config, mime_t=None, max_size=None):
+    """
+    media_file can be a path or an open file. Need the mime type if we can't guess from the path.
+    If max_size is set, frames get shrunk (longest side) to about that size as they're decoded.
+    """
+    import cv2
+
+    if mime_t is None:
+        mime_t = mimetypes.MimeTypes().guess_type(media_file)[0]
+    if is_video_or_gif(mime_t):
+        media_path = get_media_path(media_file)
+        cap = cv2.VideoCapture(media_path)
+        frame_ids = get_frame_ids_to_grab(
+            cap.get(cv2.CAP_PROP_FRAME_COUNT), cap.get(cv2.CAP_PROP_FPS), config
+        )
+        to_ret = read_frames(cap, frame_ids, config["SEEK_MIN_FRAME_GAP"], max_size)
+        if to_ret is None:
+            # Can't trust seeking in this video, so start over and read it in order
+            cap.release()
+            cap = cv2.VideoCapture(media_path)
+            to_ret = read_frames(cap, frame_ids, None, max_size)
         cap.release()
         return to_ret
     else:
-        return [Image.open(media_file)]
+        return [open_image_at_size(media_file, max_size)]
+
+
+def open_image_at_size(media_file, max_size=None):
+    """
+    Open an image, decoding it at a reduced size if it's way bigger than max_size (longest side).
+    JPEGs can be decoded at 1/2, 1/4 or 1/8 scale for (nearly) free with draft(),
+    anything still twice as big as we need gets a cheap box reduce().
+    """
+    from PIL import Image
+
+    img = Image.open(media_file)
+    if max_size is None or max(img.size) <= max_size:
+        return img
+    ratio = max_size / max(img.size)
+    img.draft("RGB", (math.ceil(img.size[0] * ratio), math.ceil(img.size[1] * ratio)))
+    reduce_factor = max(img.size) // max_size
+    if reduce_factor > 1:
+        if img.mode not in ["L", "RGB", "RGBA"]:
+            img = img.convert("RGB")
+        img = img.reduce(reduce_factor)
+    return img
+
+
+def shrink_frame(frame, max_size=None):
+    "Shrink an OpenCV frame so its longest side is max_size. Leaves smaller frames alone."
+    import cv2
+
+    if max_size is None:
+        return frame
+    height, width = frame.shape[:2]
+    if max(height, width) <= max_size:
+        return frame
+    ratio = max_size / max(height, width)
+    return cv2.resize(
+        frame,
+        (max(1, round(width * ratio)), max(1, round(height * ratio))),
+        interpolation=cv2.INTER_AREA,
+    )
+
+
+def get_frame_ids_to_grab(frames_in_video, frame_rate, config):
+    "One frame per second, or MAX_IMS_PER_VIDEO frames spread out evenly for longer videos"
+    import numpy as np
+
+    # Modified from https://answers.opencv.org/question/62029/extract-a-frame-every-second-in-python/
+    seconds_in_video = frames_in_video / frame_rate
+    if seconds_in_video > config["MAX_IMS_PER_VIDEO"]:
+        frame_ids = np.linspace(
+            0, frames_in_video - 1, num=config["MAX_IMS_PER_VIDEO"], dtype=int
+        )
+    else:
+        frame_ids = np.arange(0, frames_in_video, frame_rate)
+    return sorted(set(int(f) for f in frame_ids))
+
+
+def read_frames(cap, frame_ids, seek_min_frame_gap, max_size=None):
+    """
+    Only decode the frames we want (frame_ids must be sorted).
+    Short hops we grab() through since seeking means decoding from the last keyframe anyways,
+    for long ones we seek. Returns None if a seek didn't land where it should have
+    (going by the timestamp of the frame it decoded, POS_FRAMES just echoes back what we set).
+    seek_min_frame_gap=None means never seek. Frames get shrunk to max_size right away.
+    """
+    import cv2
+
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    frames = []
+    next_frame_id = 0
+    for frame_id in frame_ids:
+        seeked = (
+            seek_min_frame_gap is not None
+            and frame_id - next_frame_id > seek_min_frame_gap
+        )
+        if seeked:
+            if not fps or not cap.set(cv2.CAP_PROP_POS_FRAMES, frame_id):
+                return None
+            next_frame_id = frame_id
+        # grab() skips the colour conversion and copy that read() would do
+        while next_frame_id < frame_id:
+            if not cap.grab():
+                return frames
+            next_frame_id += 1
+        got_a_frame, frame = cap.read()
+        if seeked and (
+            not got_a_frame
+            # Off by more than half a frame means we got some other frame
+            or abs(cap.get(cv2.CAP_PROP_POS_MSEC) - frame_id * 1000 / fps) > 500 / fps
+        ):
+            return None
+        if not got_a_frame:
+            break
+        frames.append(shrink_frame(frame, max_size))
+        next_frame_id += 1
+    return frames
 
 
 def cast_to_pil_imgs(img_or_vid):
+    import cv2
+    import numpy as np
+    from PIL import Image
+
     if issubclass(type(img_or_vid), Image.Image):
         return [img_or_vid]
     elif type(img_or_vid) == np.ndarray:
@@ -330,51 +1003,445 @@ def cast_to_pil_imgs(img_or_vid):
         return img_or_vid
 
 
+def cast_to_rgb_batch(img_or_vid):
+    """
+    Like cast_to_pil_imgs, but gives back one contiguous (frames, height, width, 3) uint8 RGB array.
+    Each OpenCV frame gets colour converted straight into its slot in the batch, so there's one copy per frame.
+    Frames that aren't the same size as the first one get resized to match.
+    """
+    import cv2
+    import numpy as np
+    from PIL import Image
+
+    frames = img_or_vid if isinstance(img_or_vid, list) else [img_or_vid]
+    if len(frames) == 0:
+        print("# WARNING: Blank list passed", file=sys.stderr)
+        return np.empty((0, 0, 0, 3), dtype=np.uint8)
+    if issubclass(type(frames[0]), Image.Image):
+        if len(frames) == 1:
+            # Just add the batch axis, no need to copy
+            return np.asarray(
+                frames[0] if frames[0].mode == "RGB" else frames[0].convert("RGB")
+            )[np.newaxis]
+        return np.stack([np.asarray(frame.convert("RGB")) for frame in frames])
+    height, width = frames[0].shape[:2]
+    batch = np.empty((len(frames), height, width, 3), dtype=np.uint8)
+    for frame, batch_frame in zip(frames, batch):
+        if frame.shape[:2] != (height, width):
+            frame = cv2.resize(frame, (width, height), interpolation=cv2.INTER_AREA)
+        cv2.cvtColor(frame, cv2.COLOR_BGR2RGB, dst=batch_frame)
+    return batch
+
+
+def fill_in_known_post(post, known_post):
+    "We've seen this post before, so fill in what we already know about it (from get_known_posts)"
+    (post["post_id"], post["media_hash"], post["url"]), fetched_labels = known_post
+    if fetched_labels:
+        post["labels"], post["scores"] = zip(*fetched_labels)
+    else:
+        post["labels"] = ["background"]
+        post["scores"] = [1.0]
+
+
+def get_known_posts(rows):
+    """
+    Groups rows from get_posts_and_labels_given_reddit_ids/urls into
+    {reddit_id or url: ((post_id, media_hash, url), [(label, score), ...])}. The oldest post wins if there's more than one.
+    """
+    known_posts = {}
+    for key, post_id, media_hash, url, label, score in rows:
+        post_found, labels = known_posts.setdefault(
+            key, ((post_id, media_hash, url), [])
+        )
+        if post_id == post_found[0] and label is not None:
+            labels.append((label, score))
+    return known_posts
+
+
+def get_known_posts_given_urls(posts, db_conn):
+    if not posts:
+        return {}
+    return get_known_posts(
+        QUERIES.get_posts_and_labels_given_urls(
+            db_conn, urls=json.dumps([p["url"] for p in posts])
+        )
+    )
+
+
+def record_labelled_post(post, db_conn, config):
+    post["model"] = config["MODEL_TO_USE"]
+    # Posts that got their labels from the same media never had their frames hashed
+    post.setdefault("phash", None)
+    # ...and posts that came with their media_file weren't downloaded by us
+    post.setdefault("media_url", None)
+    # Not committed here, see label_and_record_batch
+    post["post_id"] = QUERIES.record_post(db_conn, **post)
+
+    # Print out each label and label's score. Also store each result in the db.)
+    if config["VERBOSE"]:
+        print("Labels for", file=sys.stderr)
+        print(post["title"], ":", post["url"], file=sys.stderr)
+        if post.get("labelling_tier"):
+            print("  (decided by the", post["labelling_tier"], "tier)", file=sys.stderr)
+        for label, score in zip(post["labels"], post["scores"]):
+            print("    ", label, "=", score, file=sys.stderr)
+    QUERIES.record_post_labels(
+        db_conn,
+        [
+            {
+                "post_id": post["post_id"],
+                "label": label,
+                "score": score,
+                "model": config["MODEL_TO_USE"],
+            }
+            for label, score in zip(post["labels"], post["scores"])
+            if label != "background"
+        ],
+    )
+
+
+def bounded_map(executor, func, items, max_in_flight):
+    """
+    Like executor.map, but only submits more work as results get used up (in order),
+    so there's never more than max_in_flight items done or in progress waiting on the consumer.
+    """
+    in_flight = deque()
+    for item in items:
+        in_flight.append(executor.submit(func, item))
+        if len(in_flight) >= max_in_flight:
+            yield in_flight.popleft().result()
+    while in_flight:
+        yield in_flight.popleft().result()
+
+
+def chunks(items, size):
+    "Lists of up to size items at a time"
+    items = iter(items)
+    while chunk := list(itertools.islice(items, size)):
+        yield chunk
+
+
+def label_and_record_new_posts(posts, labelling_function, temp_dir, db_conn, config):
+    """
+    Download, decode and label posts we haven't seen before, then record them in the order they came in.
+    Downloads and decoding happen in their own threads so they keep going while the model is busy,
+    but neither gets more than PIPELINE_QUEUE_SIZE posts ahead of what's been used up, so memory stays bounded.
+    The labelling and db writes all happen right here (sqlite connections don't like other threads).
+    Media we've already labelled with this model (same media_hash) isn't decoded or labelled again,
+    and posts that look like one we've labelled (see phash_index) aren't labelled again.
+    """
+    if not posts:
+        return
+    label_cache = Counter()
+    phash_index = load_phash_index(db_conn, config)
+
+    def download(post):
+        try:
+            add_image_content_to_post_d(post, temp_dir, config)
+        except Exception as e:
+            print(
+                f'#WARNING: failed to download {post["url"]} ({e}). Skipping this post...'
+            )
+            return None
+        return post
+
+    def decode(post):
+        if post is None:
+            return None
+        if has_labels_for_same_media(post):
+            frames = None
+        else:
+            frames = get_frames_for_labelling(post, labelling_function, config)
+            if phash_index is not None:
+                post["phash"] = get_post_phash_or_none(post, frames)
+        # Don't hang on to the media (in memory!) any longer than we need to
+        if hasattr(post["media_file"], "close"):
+            post["media_file"].close()
+        return post, frames
+
+    queue_size = int(config["PIPELINE_QUEUE_SIZE"])
+    download_pool = ThreadPoolExecutor(max_workers=int(config["DOWNLOAD_THREADS"]))
+    decode_pool = ThreadPoolExecutor(max_workers=int(config["DECODE_THREADS"]))
+    with download_pool, decode_pool:
+        downloaded_posts = bounded_map(download_pool, download, posts, queue_size)
+        decoded_posts = bounded_map(
+            decode_pool,
+            decode,
+            find_labels_for_same_media(downloaded_posts, db_conn, config, label_cache),
+            queue_size,
+        )
+        for batch in chunks(
+            filter(None, decoded_posts), int(config["POSTS_PER_LABELLING_BATCH"])
+        ):
+            label_and_record_batch(
+                batch, labelling_function, phash_index, db_conn, config, label_cache
+            )
+    if phash_index is not None and config["PHASH_INDEX_FILE"]:
+        phash_index.save(os.path.expanduser(config["PHASH_INDEX_FILE"]))
+    print_label_cache_hit_rate(label_cache)
+
+
+def print_label_cache_hit_rate(label_cache):
+    if label_cache["lookups"] or label_cache["phash_lookups"]:
+        print(
+            f"# Label cache: {label_cache['hits']}/{label_cache['posts']} new posts"
+            f" ({label_cache['hits'] / label_cache['posts']:.0%}) had media we'd already labelled"
+            f" ({label_cache['phash_hits']} of those by phash,"
+            f" out of {label_cache['phash_lookups']} looked up by phash)",
+            file=sys.stderr,
+        )
+
+
+def label_and_record_batch(
+    posts_and_frames, labelling_function, phash_index, db_conn, config, label_cache
+):
+    """
+    Posts without frames (None) get their labels from the same media instead.
+    The whole batch is recorded in one transaction (one fsync rather than one per post and label).
+    """
+    if phash_index is not None:
+        find_labels_for_lookalike_media(
+            [post for post, frames in posts_and_frames if frames is not None],
+            phash_index,
+            db_conn,
+            config,
+            label_cache,
+        )
+    posts_to_label = [
+        (post, frames)
+        for post, frames in posts_and_frames
+        if frames is not None and not has_labels_for_same_media(post)
+    ]
+    if posts_to_label:
+        add_labels_given_frames_to_post_ds(*zip(*posts_to_label), labelling_function)
+    recorded_posts = []
+    for post, _ in posts_and_frames:
+        if labelling_failed(post):
+            # Not recorded, so it gets another go next run
+            print(
+                f'#WARNING: failed to label {post["url"]}. Skipping this post...',
+                file=sys.stderr,
+            )
+        else:
+            recorded_posts.append(post)
+    with db_conn:
+        for post in recorded_posts:
+            copy_labels_for_same_media(post, db_conn, config)
+            record_labelled_post(post, db_conn, config)
+    if phash_index is not None:
+        for post in recorded_posts:
+            if post.get("phash"):
+                phash_index.add(post["phash"], post["post_id"])
+
+
+def get_post_phash_or_none(post, frames):
+    "None (so it just can't be matched up with lookalikes) rather than failing the whole run"
+    from phash_index import get_post_phash
+
+    try:
+        return get_post_phash(frames)
+    except Exception as e:
+        print(
+            f'#WARNING: failed to phash {post["url"]} ({e}). Labelling it anyways...',
+            file=sys.stderr,
+        )
+        return None
+
+
+def load_phash_index(db_conn, config):
+    "The index saved in PHASH_INDEX_FILE (if any), topped up with posts recorded since. None if it's turned off"
+    if config["REPOST_PHASH_MAX_DISTANCE"] < 0:
+        return None
+    from phash_index import PHASH_LENGTH, PhashIndex
+
+    index_file = os.path.expanduser(config["PHASH_INDEX_FILE"])
+    phash_index = PhashIndex.load(index_file) if index_file else PhashIndex()
+    if phash_index.last_post_id > (QUERIES.get_max_post_id(db_conn) or 0):
+        # Saved for some other (or a since deleted) db
+        phash_index = PhashIndex()
+    for post_id, phash in QUERIES.get_post_phashes_since(
+        db_conn, post_id=phash_index.last_post_id
+    ):
+        # (Hashes from before we kept the colour are too short to use)
+        if phash is not None and len(phash) == PHASH_LENGTH:
+            phash_index.add(phash, post_id)
+        phash_index.last_post_id = post_id
+    return phash_index
+
+
+def find_labels_for_lookalike_media(posts, phash_index, db_conn, config, label_cache):
+    """
+    Marks posts whose phash is within REPOST_PHASH_MAX_DISTANCE (and about the same colour) of a post labelled
+    with MODEL_TO_USE (or of an earlier post in posts) so they reuse its labels, like find_labels_for_same_media does.
+    """
+    from phash_index import phashes_look_alike
+
+    max_distance = config["REPOST_PHASH_MAX_DISTANCE"]
+    posts_so_far = []
+    for post in posts:
+        if post.get("phash") is None:
+            continue
+        label_cache["phash_lookups"] += 1
+        for _, post_id in phash_index.find(post["phash"], max_distance):
+            labelled_post = QUERIES.get_labelled_post(
+                db_conn, post_id=post_id, model=config["MODEL_TO_USE"]
+            )
+            if labelled_post:
+                post["labels_from_post_id"], post["frames_used"] = labelled_post
+                break
+        else:
+            post["labels_from_post"] = next(
+                (
+                    post_so_far
+                    for post_so_far in posts_so_far
+                    if phashes_look_alike(
+                        post["phash"], post_so_far["phash"], max_distance
+                    )
+                ),
+                None,
+            )
+            if post["labels_from_post"] is None:
+                del post["labels_from_post"]
+                posts_so_far.append(post)
+        label_cache["phash_hits"] += has_labels_for_same_media(post)
+        label_cache["hits"] += has_labels_for_same_media(post)
+
+
+def labelling_failed(post):
+    "Posts the labeller gave up on, or that were going to copy the labels of one"
+    return post.get("labelling_failed") or (
+        "labels_from_post" in post and labelling_failed(post["labels_from_post"])
+    )
+
+
+def has_labels_for_same_media(post):
+    return "labels_from_post_id" in post or "labels_from_post" in post
+
+
+def find_labels_for_same_media(downloaded_posts, db_conn, config, label_cache):
+    """
+    Goes through the downloaded posts (None for failed ones) marking any whose media (by media_hash)
+    was already labelled with MODEL_TO_USE, in the db or earlier on in this run. Those can skip decoding and labelling.
+    label_cache is a Counter that gets "posts", "lookups" and "hits" added up in it.
+    Has to run in the thread that owns db_conn.
+    """
+    # Earlier posts (in this run) for each media_hash
+    posts_by_media_hash = {}
+    for post in downloaded_posts:
+        label_cache["posts"] += post is not None
+        if post is not None and config["REUSE_LABELS_FOR_SAME_MEDIA"]:
+            labelled_post = QUERIES.get_labelled_post_given_media_hash(
+                db_conn, media_hash=post["media_hash"], model=config["MODEL_TO_USE"]
+            )
+            if labelled_post:
+                post["labels_from_post_id"], post["frames_used"] = labelled_post
+            elif post["media_hash"] in posts_by_media_hash:
+                # It gets labelled (and recorded) before we get to this one
+                post["labels_from_post"] = posts_by_media_hash[post["media_hash"]]
+            else:
+                posts_by_media_hash[post["media_hash"]] = post
+            label_cache["lookups"] += 1
+            label_cache["hits"] += has_labels_for_same_media(post)
+        yield post
+
+
+def copy_labels_for_same_media(post, db_conn, config):
+    "For posts that label_and_record_new_posts found an already labelled copy of"
+    if "labels_from_post_id" in post:
+        fetched_labels = QUERIES.get_labels_and_scores_for_post_and_model(
+            db_conn, post_id=post["labels_from_post_id"], model=config["MODEL_TO_USE"]
+        )
+        if fetched_labels:
+            post["labels"], post["scores"] = map(list, zip(*fetched_labels))
+        else:
+            post["labels"], post["scores"] = ["background"], [1.0]
+    elif "labels_from_post" in post:
+        for key in ["labels", "scores", "frames_used", "labelling_tier"]:
+            post[key] = post["labels_from_post"].get(key)
+
+
+def fill_in_post_found_by_url(post, known_posts_by_url, db_conn):
+    "Posts from before we tracked reddit ids (or reposts of the same url) are found by url"
+    known_post = known_posts_by_url.get(post["url"])
+    if known_post:
+        # Committed along with the next batch of labelled posts (or at the end of populate_labels_in_db_for_posts)
+        QUERIES.set_reddit_id_for_post(db_conn, post_id=known_post[0][0], **post)
+        # Posts already recorded under another reddit id (eg crossposts) keep theirs, this one gets remembered alongside
+        QUERIES.record_other_reddit_id_for_post(
+            db_conn, post_id=known_post[0][0], reddit_id=post["reddit_id"]
+        )
+        fill_in_known_post(post, known_post)
+    return known_post
+
+
 def populate_labels_in_db_for_posts(
-    reddit_response_json, labelling_function, temp_dir, db_conn, config
+    reddit_posts, labelling_function, temp_dir, db_conn, config
 ):
-    # Make sure we have the images and labels stashed for any potentially new posts
+    """
+    Make sure we have the images and labels stashed for any potentially new posts.
+    Returns the posts (in listing order) that we managed to label or already knew about.
+    """
     # Usually we just skip adding labels for a post since it's probably been in the top N
-    #    for a few hours already and had many chances to be labelled already
-    for post_i, post in enumerate(reddit_response_json):
-        image_found = QUERIES.get_post_given_url(db_conn, **post)
-        if not image_found:
-            # Did not find the url, must be a new post. (or maybe a repost...)
-            add_image_content_to_post_d(post, temp_dir)
-            add_labels_for_image_to_post_d(post, labelling_function, config)
-
-            # Check if we already have the file in the db
-            QUERIES.record_post(db_conn, **post)
-            db_conn.commit()
-            post_id = QUERIES.get_post_given_url(db_conn, **post)[0]
-            post["post_id"] = post_id
-
-            # Print out each label and label's score. Also store each result in the db.)
-            if config["VERBOSE"]:
-                print("Labels for", file=sys.stderr)
-                print(post["title"], ":", post["url"], file=sys.stderr)
-            for label, score in zip(post["labels"], post["scores"]):
-                if config["VERBOSE"]:
-                    print("    ", label, "=", score, file=sys.stderr)
-                if label != "background":
-                    QUERIES.record_post_label(
-                        db_conn,
-                        post_id=post_id,
-                        label=label,
-                        score=score,
-                        model=config["MODEL_TO_USE"],
-                    )
-                    db_conn.commit()
+    #    for a few hours already and had many chances to be labelled already.
+    # Check by reddit id first so known posts don't need any http calls at all.
+    # The whole listing gets looked up (posts and labels) in one query, so nothing starts until we have all of it.
+    #   (main has all of it already to fingerprint it)
+    posts = list(reddit_posts)
+    known_posts = get_known_posts(
+        QUERIES.get_posts_and_labels_given_reddit_ids(
+            db_conn, reddit_ids=json.dumps([p["reddit_id"] for p in posts])
+        )
+    )
+    new_posts = []
+    for post in posts:
+        if post["reddit_id"] in known_posts:
+            fill_in_known_post(post, known_posts[post["reddit_id"]])
         else:
-            post["post_id"] = image_found[0]
-            post["media_hash"] = image_found[1]
-            # Fetch labels from db
-            fetched_labels = QUERIES.get_labels_and_scores_for_post(db_conn, **post)
-            if fetched_labels:
-                post["labels"], post["scores"] = zip(*fetched_labels)
-            else:
-                post["labels"] = ["background"]
-                post["scores"] = [1.0]
+            new_posts.append(post)
+
+    # Only new posts need their urls fixed. Skip any we already have the media for.
+    resolved_posts = {
+        d["reddit_id"]: d
+        for d in resolve_post_urls(
+            [p for p in new_posts if p.get("media_file") is None], config
+        )
+    }
+    resolvable_posts = []
+    for post in new_posts:
+        if post.get("media_file") is None:
+            if post["reddit_id"] not in resolved_posts:
+                # Couldn't fix the url so we're skipping this post
+                continue
+            post["url"] = resolved_posts[post["reddit_id"]]["url"]
+            post["media_url"] = resolved_posts[post["reddit_id"]]["media_url"]
+        resolvable_posts.append(post)
+    known_posts_by_url = get_known_posts_given_urls(resolvable_posts, db_conn)
+    posts_to_label = []
+    urls_to_label = set()
+    reposts = []
+    for post in resolvable_posts:
+        if fill_in_post_found_by_url(post, known_posts_by_url, db_conn):
+            continue
+        if post["url"] in urls_to_label:
+            # Same url as a post we're about to label, we'll find it by url once that's recorded
+            reposts.append(post)
+            continue
+        posts_to_label.append(post)
+        urls_to_label.add(post["url"])
+    label_and_record_new_posts(
+        posts_to_label, labelling_function, temp_dir, db_conn, config
+    )
+    known_posts_by_url = get_known_posts_given_urls(reposts, db_conn)
+    for post in reposts:
+        if not fill_in_post_found_by_url(post, known_posts_by_url, db_conn):
+            # The first post with this url didn't make it, so try this one
+            label_and_record_new_posts(
+                [post], labelling_function, temp_dir, db_conn, config
+            )
+            known_posts_by_url.update(get_known_posts_given_urls([post], db_conn))
+    db_conn.commit()
+
+    return [p for p in posts if p.get("post_id") is not None]
 
 
 def maybe_repost_to_slack(post, label, config):
@@ -454,10 +1521,54 @@ def maybe_repost_to_social_media(reddit_response_json, top_cat_config, db_conn):
 
 
 def get_labelling_funtion(config):
+    # If there's a label_server.py running it already has the model loaded, so use that
+    if config["USE_LABEL_SERVER"]:
+        import label_server
+
+        labelling_function = label_server.get_labelling_func_from_server(
+            config,
+            # In case the server goes away partway through the run
+            fallback=LazyLabellingFunction({**config, "USE_LABEL_SERVER": False}),
+        )
+        if labelling_function is not None:
+            return labelling_function
     model_package = importlib.import_module(config["MODEL_TO_USE"])
     return model_package.get_labelling_func_given_config(config)
 
 
+class LazyLabellingFunction(object):
+    """
+    Stands in for get_labelling_funtion(config) but doesn't load the model (or import tensorflow)
+    until a post actually needs labelling. Safe to share between threads.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.lock = threading.Lock()
+        self.labelling_function = None
+
+    def load(self):
+        with self.lock:
+            if self.labelling_function is None:
+                self.labelling_function = get_labelling_funtion(self.config)
+        return self.labelling_function
+
+    def __call__(self, frames):
+        return self.load()(frames)
+
+    def close(self):
+        "Lets the labelling function clean up (eg deeplab's worker processes), if it ever got loaded"
+        with self.lock:
+            close = getattr(self.labelling_function, "close", None)
+            self.labelling_function = None
+        if close is not None:
+            close()
+
+    def __getattr__(self, name):
+        # ie label_many and accepts_numpy_batch
+        return getattr(self.load(), name)
+
+
 def main():
     temp_dir = TemporaryDirectory()
 
@@ -467,30 +1578,54 @@ def main():
     update_config_with_args(config, args)
 
     # Connect to the db. Create the sqlite file if necessary.
-    db_conn = sqlite3.connect(os.path.expanduser(config["DB_FILE"]))
+    db_conn = connect_to_db(config)
     guarantee_tables_exist(db_conn)
 
-    # Depending on the config, we will prepare wrapper around a tensorflow model (deeplabv3) XOR around the google vision api
-    labelling_function = get_labelling_funtion(config)
+    # What's new in /r/aww? We need the whole listing up front to know if anything changed,
+    #   so resolving/labelling only starts once every page is in (normalized posts are small, a few kb each).
+    #   Conditional requests let reddit tell us a page is the same as last time.
+    page_cache = ListingPageCache(get_run_state(db_conn, "listing_pages"))
+    reddit_posts = list(
+        iter_reddit_posts(
+            config, functools.partial(fetch_reddit_listing_page, page_cache=page_cache)
+        )
+    )
+    listing_fingerprint = get_listing_fingerprint(reddit_posts, config)
+    set_run_state(db_conn, "listing_pages", page_cache.pages)
+    if config["SKIP_UNCHANGED_LISTINGS"] and listing_fingerprint == get_run_state(
+        db_conn, "listing_fingerprint"
+    ):
+        # Same posts in the same order as last time, so there's nothing new to label or repost.
+        #   (Posts we had to skip last time will get another shot once the listing changes)
+        if config["VERBOSE"]:
+            print("# Listing hasn't changed since last run. All done!", file=sys.stderr)
+        return
 
-    # What's new in /r/aww?
-    reddit_response_json = query_reddit_api(config)
+    # Depending on the config, we will prepare wrapper around a tensorflow model (deeplabv3) XOR around the google vision api
+    #   Only gets loaded if there turns out to be something new to label
+    labelling_function = LazyLabellingFunction(config)
 
     # Label everything... not really necessary since we could just label
     #   the top_post but nice to have in the db regardless
-    populate_labels_in_db_for_posts(
-        reddit_response_json=reddit_response_json,
-        labelling_function=labelling_function,
-        temp_dir=temp_dir,
-        db_conn=db_conn,
-        config=config,
-    )
+    try:
+        reddit_response_json = populate_labels_in_db_for_posts(
+            reddit_posts=reddit_posts,
+            labelling_function=labelling_function,
+            temp_dir=temp_dir,
+            db_conn=db_conn,
+            config=config,
+        )
+    finally:
+        labelling_function.close()
 
     if config["VERBOSE"]:
         pprint.pprint(reddit_response_json)
 
     maybe_repost_to_social_media(reddit_response_json, config, db_conn)
 
+    # Only remember the listing once we've dealt with it, so a crashed run gets retried
+    set_run_state(db_conn, "listing_fingerprint", listing_fingerprint)
+
 
 if __name__ == "__main__":
     main()